@@ -22,8 +22,13 @@ def register():
         common.Account,
         common.Party,
         common.FiscalYear,
+        common.BalanceCheckpoint,
+        common.ReportExecution,
+        common.Move,
+        common.MoveLine,
         abreviated_journal.PrintAbreviatedJournalStart,
         general_ledger.PrintGeneralLedgerStart,
+        general_ledger.GeneralLedgerSnapshot,
         journal.PrintJournalStart,
         open_move_lines.PrintOpenMoveLinesStart,
         taxes_by_invoice.PrintTaxesByInvoiceAndPeriodStart,
@@ -6,7 +6,8 @@ from decimal import Decimal
 
 from dominate.tags import col, colgroup, div, header as header_tag, table, tbody, td, th, thead, tr
 from dominate.util import raw
-from sql.aggregate import Sum
+from sql import Literal
+from sql.aggregate import Count, Sum
 from sql.conditionals import Coalesce
 
 from trytond.exceptions import UserError
@@ -19,12 +20,11 @@ from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.account_reports.xlsx import (
     XlsxReport, save_workbook, convert_str_to_float)
 from trytond.pool import Pool, PoolMeta
-from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.wizard import Button, StateReport, StateView, Wizard
 from openpyxl import Workbook
 
-from .common import css as common_css
+from .common import BalanceRollup, css as common_css, ids_in
 
 
 class PrintAbreviatedJournalStart(ModelView):
@@ -91,6 +91,7 @@ class PrintAbreviatedJournal(Wizard):
             'level': self.start.level,
             'output_format': self.start.output_format,
             }
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             action_report, = ActionReport.search([
@@ -100,6 +101,24 @@ class PrintAbreviatedJournal(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        '''
+        Estimate the lines of the report and warn if it may take longer than
+        the default timeout
+        '''
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.abreviated_journal', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.abreviated_journal_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            Config(1).default_timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -156,8 +175,6 @@ class AbreviatedJournalReport(DominateReport):
         FiscalYear = pool.get('account.fiscalyear')
         line = MoveLine.__table__()
         move = Move.__table__()
-        table_a = Account.__table__()
-        table_c = Account.__table__()
 
         fiscalyear = (FiscalYear(data['fiscalyear']) if data.get('fiscalyear')
             else None)
@@ -176,92 +193,106 @@ class AbreviatedJournalReport(DominateReport):
         parameters['company_vat'] = (
             company and company.party.tax_identifier
             and company.party.tax_identifier.code) or ''
+        if not company:
+            company = fiscalyear.company
 
-        move_join = 'LEFT'
-        if data['display_account'] == 'bal_movement':
-            move_join = 'INNER'
+        chart = Account.html_get_chart(company)
+        account_ids = Account.html_get_level_accounts(company, data['level'])
 
-        account_ids = []
-        with Transaction().set_context(active_test=False):
-            for account in Account.search([('company', '=', data['company'])],
-                    order=[('code', 'ASC')]):
-                if not account.code or not account.parent:
-                    continue
-                if (len(account.code) == data['level']
-                        or account.type is not None
-                        and len(account.childs) == 0
-                        and len(account.code) < data['level']):
-                    account_ids.append(account.id)
-            accounts = Account.browse(account_ids)
-
-        group_by = (table_a.id,)
-        columns = group_by + (
-            Sum(Coalesce(line.debit, 0)).as_('debit'),
-            Sum(Coalesce(line.credit, 0)).as_('credit'),
-            )
         periods = Period.search([
                 ('fiscalyear', '=', fiscalyear),
                 ('type', '=', 'standard'),
                 ], order=[('start_date', 'ASC')])
-        for period in periods:
-            all_accounts = {}
-            for sub_ids in grouped_slice(account_ids):
-                red_sql = reduce_ids(table_a.id, sub_ids)
-                cursor.execute(*table_a.join(table_c,
-                        condition=(table_c.left >= table_a.left)
-                        & (table_c.right <= table_a.right)
-                        ).join(line, move_join,
-                            condition=line.account == table_c.id
-                        ).join(move, move_join,
-                            condition=move.id == line.move
-                        ).select(
-                            *columns,
-                            where=red_sql
-                            & (Coalesce(move.period, period.id) == period.id),
-                            group_by=group_by))
-
-                for row in cursor.fetchall():
-                    account_id, debit, credit = row
-                    if not isinstance(debit, Decimal):
-                        debit = Decimal(str(debit))
-                    if not isinstance(credit, Decimal):
-                        credit = Decimal(str(credit))
-                    all_accounts[account_id] = {
+        # The values of the final accounts for the whole year are read with a
+        # single query and then summed into the parents. Each period uses
+        # three columns: debit, credit and the number of lines.
+        period_index = {p.id: i for i, p in enumerate(periods)}
+        rollup = BalanceRollup({i: c[0] for i, c in chart.items()},
+            3 * len(periods), company.currency.digits)
+        rows = []
+        if periods:
+            cursor.execute(*line.join(move,
+                    condition=move.id == line.move
+                    ).select(
+                        line.account,
+                        move.period,
+                        Sum(Coalesce(line.debit, 0)).as_('debit'),
+                        Sum(Coalesce(line.credit, 0)).as_('credit'),
+                        Count(Literal('*')).as_('count'),
+                        where=ids_in(move.period, period_index)
+                        & (move.company == company.id),
+                        group_by=(line.account, move.period)))
+            rows = cursor.fetchall()
+
+        for account_id, period_id, debit, credit, count in rows:
+            if account_id not in rollup.index:
+                continue
+            # add_amount absorbs the float returned by SQLite for SUM
+            i = period_index[period_id]
+            rollup.add_amount(account_id, 3 * i, debit)
+            rollup.add_amount(account_id, 3 * i + 1, credit)
+            rollup.add_cents(account_id, 3 * i + 2, count)
+        rollup.rollup()
+
+        values = {i: (rollup.get(i), rollup.get_cents(i))
+            for i in account_ids}
+        for i, period in enumerate(periods):
+            for account_id in account_ids:
+                amounts, cents = values[account_id]
+                debit, credit = amounts[3 * i:3 * i + 2]
+                if (not cents[3 * i + 2]
+                        and data['display_account'] != 'bal_all'):
+                    continue
+                code, name = chart[account_id][1:3]
+                records.append({
+                        'month': period.rec_name,
+                        'period_date': period.start_date,
+                        'code': code,
+                        'name': name,
                         'debit': debit,
                         'credit': credit,
-                        }
-            for account in accounts:
-                if account.id in all_accounts:
-                    records.append({
-                            'month': period.rec_name,
-                            'period_date': period.start_date,
-                            'code': account.code,
-                            'name': account.name,
-                            'debit': all_accounts[account.id]['debit'],
-                            'credit': all_accounts[account.id]['credit'],
-                            })
-                elif data['display_account'] == 'bal_all':
-                    records.append({
-                            'month': period.rec_name,
-                            'period_date': period.start_date,
-                            'code': account.code,
-                            'name': account.name,
-                            'debit': Decimal(0),
-                            'credit': Decimal(0),
-                            })
+                        })
         return records, parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the lines to estimate the cost of the report'
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        periods = Period.search([
+                ('fiscalyear', '=', data['fiscalyear']),
+                ('type', '=', 'standard'),
+                ])
+        return line.join(move, condition=move.id == line.move
+            ).select(line.id,
+                where=ids_in(move.period, [p.id for p in periods])
+                & (move.company == data['company']))
+
     @classmethod
     def execute(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Execution = pool.get('account_reports.execution')
+
+        start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             records, parameters = cls.prepare(data)
-        return super().execute(ids, {
+        result = super().execute(ids, {
                 'name': 'account_reports.abreviated_journal',
                 'model': 'account.move.line',
                 'records': records,
                 'parameters': parameters,
                 'output_format': data.get('output_format', 'pdf'),
                 })
+        if data.get('company'):
+            Execution.log(cls.__name__, Company(data['company']),
+                data.get('estimated_rows'),
+                (datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def title(cls, action, data, records):
@@ -400,9 +431,19 @@ class AbreviatedJournalXlsxReport(XlsxReport, metaclass=PoolMeta):
 
     @classmethod
     def get_content(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Execution = pool.get('account_reports.execution')
+
+        start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             records, parameters = AbreviatedJournalReport.prepare(data)
-        return cls._build_workbook(records, parameters)
+        content = cls._build_workbook(records, parameters)
+        if data.get('company'):
+            Execution.log(cls.__name__, Company(data['company']),
+                data.get('estimated_rows'),
+                (datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
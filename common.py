@@ -1,17 +1,47 @@
 # This file is part of account_reports for tryton.  The COPYRIGHT file
 # at the top level of this repository contains the full copyright notices and
 # license terms.
+import json
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
 from decimal import Decimal
-from datetime import datetime
-from sql.aggregate import Sum
+from datetime import datetime, timedelta
+from io import BytesIO
+from dominate import document
+from dominate.tags import style
+from dominate.util import raw
+from sql import Literal, Null, Union
+from sql.aggregate import Min, Sum
 from sql.conditionals import Coalesce
-from sql.operators import In
+from sql.functions import CharLength, CurrentTimestamp, Substring
+from sql.operators import Exists
 
-from trytond.model import fields
+from trytond import backend
+from trytond.cache import Cache
+from trytond.exceptions import UserError, UserWarning
+from trytond.i18n import gettext
+from trytond.model import Index, ModelSQL, fields
+from trytond.model.fields import SQL_OPERATORS
 from trytond.pool import Pool, PoolMeta
-from trytond.tools import reduce_ids, file_open
+from trytond.tools import file_open, grouped_slice
 from trytond.transaction import Transaction
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+try:
+    import weasyprint
+except ImportError:
+    weasyprint = None
+
 
 class TimeoutException(Exception):
     pass
@@ -39,9 +69,509 @@ class TimeoutChecker:
             self._callback()
 
 
+class ReportRow:
+    '''
+    The base of the compact rows of the reports.
+
+    The rows store only the values they display in slots and they are read
+    and written like the dicts they replace.
+    '''
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def values(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(**dict(zip(cls.__slots__, values)))
+
+
+class LedgerRow(ReportRow):
+    'A move line of the general ledger or the open move lines'
+    __slots__ = ('sequence', 'line', 'date', 'maturity_date', 'number', 'ref',
+        'description', 'move_description', 'reconciliation_date', 'debit',
+        'credit', 'balance', 'party')
+
+
+class JournalRow(ReportRow):
+    'A move line of the journal'
+    __slots__ = ('date', 'month', 'move_number', 'move_line_description',
+        'account_name', 'account_kind', 'party_name', 'debit', 'credit')
+
+
+class AccountInfo(ReportRow):
+    'The values of an account used by the reports'
+    __slots__ = ('id', 'code', 'name', 'kind', 'party_required', 'parent')
+
+
+class PartyInfo(ReportRow):
+    'The values of a party used by the reports'
+    __slots__ = ('id', 'code', 'name', 'tax_identifier')
+
+
+class PeriodInfo(ReportRow):
+    'The values of a period used by the reports'
+    __slots__ = ('id', 'name', 'fiscalyear', 'start_date', 'end_date',
+        'state')
+
+
+class TaxRow(ReportRow):
+    'An invoice tax of the taxes by invoice'
+    __slots__ = ('invoice', 'state', 'number', 'invoice_date', 'move_date',
+        'account_code', 'party', 'tax_identifier', 'tax_name', 'company_base',
+        'company_amount', 'company_total_amount')
+
+
+def ids_in(column, ids):
+    '''
+    Return the condition for column to be one of the ids.
+
+    On databases with arrays the ids are bound as a single array parameter,
+    so a large set of ids is filtered by one query with a stable plan.
+    '''
+    return SQL_OPERATORS['in'](column, list(ids))
+
+
+def merge_date_ranges(periods):
+    '''
+    Merge the dates of the periods into the minimal list of contiguous
+    (start_date, end_date) ranges sorted by date.
+    '''
+    ranges = []
+    for period in sorted(periods, key=lambda p: p.start_date):
+        if ranges and period.start_date <= ranges[-1][1] + timedelta(days=1):
+            if period.end_date > ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], period.end_date)
+        else:
+            ranges.append((period.start_date, period.end_date))
+    return ranges
+
+
+def date_ranges_where(column, ranges):
+    '''
+    Return the condition for column to be in one of the date ranges or None
+    if there is no range.
+    '''
+    where = None
+    for start_date, end_date in ranges:
+        condition = (column >= start_date) & (column <= end_date)
+        where = condition if where is None else (where | condition)
+    return where
+
+
+def date_ranges_domain(name, ranges):
+    'Return the domain for the field name to be in one of the date ranges'
+    return ['OR'] + [[(name, '>=', start_date), (name, '<=', end_date)]
+        for start_date, end_date in ranges]
+
+
+class MinorUnits:
+    '''
+    Convert the amounts to integer minor units of the currency, scaled by its
+    digits, and back to Decimal.
+
+    The loops of the reports sum the integers, which is exact, and convert
+    the sums to Decimal only for the output.
+    '''
+    def __init__(self, digits=2):
+        self.digits = digits
+        self._factor = 10 ** digits
+
+    def to_cents(self, value):
+        if not value:
+            return 0
+        if isinstance(value, float):
+            # SQLite uses float for SUM
+            return round(value * self._factor)
+        if not isinstance(value, Decimal):
+            value = Decimal(value)
+        return int(value.scaleb(self.digits).to_integral_value())
+
+    def to_decimal(self, cents):
+        return Decimal(cents).scaleb(-self.digits)
+
+    def amount(self, value):
+        '''
+        Return the value as Decimal with the digits of the currency when the
+        database does not return a Decimal.
+        '''
+        if isinstance(value, Decimal):
+            return value
+        return self.to_decimal(self.to_cents(value))
+
+
+class CentsTotals(MinorUnits):
+    '''
+    Named sums of amounts kept as integer minor units.
+    '''
+    def __init__(self, names=(), digits=2):
+        super().__init__(digits)
+        self._cents = dict.fromkeys(names, 0)
+
+    def add(self, name, value):
+        self._cents[name] = self._cents.get(name, 0) + self.to_cents(value)
+
+    def __getitem__(self, name):
+        return self.to_decimal(self._cents.get(name, 0))
+
+    def to_dict(self):
+        return {n: self.to_decimal(c) for n, c in self._cents.items()}
+
+
+class BalanceRollup(MinorUnits):
+    '''
+    Sum the values of the accounts into all their parents.
+
+    The values are kept as integer cents with one row per account and one
+    column per value. The parent mapping is precomputed as one pair of index
+    arrays per depth level so the propagation is a few vectorized additions
+    when numpy is installed and plain integer additions otherwise.
+    '''
+    def __init__(self, parents, columns, digits=2):
+        # parents is a dictionary of account id and parent id
+        super().__init__(digits)
+        self.ids = list(parents)
+        self.index = {id_: i for i, id_ in enumerate(self.ids)}
+        self.columns = columns
+        parent_index = [self.index.get(parents[id_], -1) for id_ in self.ids]
+
+        depths = [None] * len(self.ids)
+        for i in range(len(self.ids)):
+            path = []
+            j = i
+            while j != -1 and depths[j] is None:
+                path.append(j)
+                j = parent_index[j]
+                if len(path) > len(self.ids):
+                    # Protect against loops in the parent mapping
+                    break
+            depth = depths[j] if j != -1 and depths[j] is not None else -1
+            for j in reversed(path):
+                depth += 1
+                depths[j] = depth
+
+        levels = {}
+        for i, parent in enumerate(parent_index):
+            if parent != -1:
+                levels.setdefault(depths[i], ([], []))
+                levels[depths[i]][0].append(i)
+                levels[depths[i]][1].append(parent)
+        # Deepest levels first so each parent is complete before it is added
+        # to its own parent
+        self._levels = [levels[d] for d in sorted(levels, reverse=True)]
+        if numpy is not None:
+            self._levels = [(numpy.array(c, dtype=numpy.intp),
+                    numpy.array(p, dtype=numpy.intp))
+                for c, p in self._levels]
+            self._values = numpy.zeros((len(self.ids), columns),
+                dtype=numpy.int64)
+        else:
+            self._values = [[0] * columns for _ in self.ids]
+
+    def add_cents(self, account_id, column, cents):
+        '''
+        Add an integer in cents, or a count, to the column of an account.
+        '''
+        self._values[self.index[account_id]][column] += int(cents)
+
+    def add_amount(self, account_id, column, value):
+        '''
+        Add an amount in currency units to the column of an account.
+        '''
+        self.add_cents(account_id, column, self.to_cents(value))
+
+    def rollup(self):
+        values = self._values
+        for children, parents in self._levels:
+            if numpy is not None:
+                numpy.add.at(values, parents, values[children])
+            else:
+                for child, parent in zip(children, parents):
+                    row = values[parent]
+                    for column, value in enumerate(values[child]):
+                        row[column] += value
+
+    def get_cents(self, account_id):
+        return [int(x) for x in self._values[self.index[account_id]]]
+
+    def get(self, account_id):
+        '''
+        Return the values of the account as Decimal.
+        '''
+        return [self.to_decimal(x) for x in self.get_cents(account_id)]
+
+
+class ReportContext:
+    '''
+    The lookup maps of the accounts, parties and periods of a report.
+
+    It is created once per execution and passed to the helpers. The records
+    are read in bulk the first time they are asked for and kept for the
+    lifetime of the report, so each one is read at most once.
+    '''
+
+    def __init__(self):
+        self._accounts = {}
+        self._parties = {}
+        self._periods = {}
+        self._fiscalyear_periods = {}
+
+    @staticmethod
+    def _load(cache, ids, read):
+        '''
+        Read the missing ids in bulk and return the rows of all the ids by
+        id.
+        '''
+        ids = {int(i) for i in ids if i is not None}
+        rows = {i: cache[i] for i in ids if i in cache}
+        for sub_ids in grouped_slice(sorted(ids - rows.keys())):
+            for info in read(list(sub_ids)):
+                rows[info.id] = cache[info.id] = info
+        return rows
+
+    def _get(self, cache, id_, read):
+        if id_ is None:
+            return None
+        id_ = int(id_)
+        if id_ not in cache:
+            self._load(cache, [id_], read)
+        return cache[id_]
+
+    @staticmethod
+    def _ordered(rows, ids):
+        return [rows[int(i)] if i is not None else None for i in ids]
+
+    @staticmethod
+    def _read_accounts(ids):
+        pool = Pool()
+        Account = pool.get('account.account')
+        for values in Account.read(ids, ['code', 'name', 'party_required',
+                    'parent', 'type.receivable', 'type.payable']):
+            type_ = values['type.'] or {}
+            kind = 'other'
+            if type_.get('receivable'):
+                kind = 'receivable'
+            elif type_.get('payable'):
+                kind = 'payable'
+            yield AccountInfo(id=values['id'], code=values['code'],
+                name=values['name'], kind=kind,
+                party_required=values['party_required'],
+                parent=values['parent'])
+
+    @staticmethod
+    def _read_parties(ids):
+        pool = Pool()
+        Party = pool.get('party.party')
+        for values in Party.read(ids, ['code', 'name',
+                    'tax_identifier.code']):
+            identifier = values['tax_identifier.'] or {}
+            yield PartyInfo(id=values['id'], code=values['code'],
+                name=values['name'],
+                tax_identifier=identifier.get('code'))
+
+    @staticmethod
+    def _read_periods(ids):
+        pool = Pool()
+        Period = pool.get('account.period')
+        for values in Period.read(ids, ['name', 'fiscalyear', 'start_date',
+                    'end_date', 'state']):
+            yield PeriodInfo(**values)
+
+    def accounts(self, ids):
+        'Load the accounts of ids and return them in the same order'
+        return self._ordered(
+            self._load(self._accounts, ids, self._read_accounts), ids)
+
+    def accounts_with_parents(self, ids):
+        '''
+        Load the accounts of ids and all their parents, reading one level
+        of the chart at a time, and return the accounts of ids.
+        '''
+        accounts = rows = self._load(self._accounts, ids, self._read_accounts)
+        while rows:
+            parents = {r.parent for r in rows.values()
+                if r.parent is not None} - self._accounts.keys()
+            rows = self._load(self._accounts, parents, self._read_accounts)
+        return self._ordered(accounts, ids)
+
+    def account(self, id_):
+        return self._get(self._accounts, id_, self._read_accounts)
+
+    def parties(self, ids):
+        'Load the parties of ids and return them in the same order'
+        return self._ordered(
+            self._load(self._parties, ids, self._read_parties), ids)
+
+    def party(self, id_):
+        return self._get(self._parties, id_, self._read_parties)
+
+    def periods(self, ids):
+        'Load the periods of ids and return them in the same order'
+        return self._ordered(
+            self._load(self._periods, ids, self._read_periods), ids)
+
+    def period(self, id_):
+        return self._get(self._periods, id_, self._read_periods)
+
+    def get_periods(self, fiscalyear, start_period, end_period):
+        '''
+        Return the periods of FiscalYear.get_periods, searched once for each
+        fiscal year and range.
+        '''
+        key = (fiscalyear.id, start_period and start_period.id,
+            end_period and end_period.id)
+        if key not in self._fiscalyear_periods:
+            periods = fiscalyear.get_periods(start_period, end_period)
+            self._fiscalyear_periods[key] = periods
+            self.periods(periods)
+        return self._fiscalyear_periods[key]
+
+
+def _write_pdf(html):
+    'Render the HTML document to PDF, in a worker of the process pool'
+    return weasyprint.HTML(string=html).write_pdf()
+
+
+class SectionPdfMixin:
+    '''
+    Render the PDF of a DominateReport as independent sections in a pool of
+    processes.
+
+    The sections are the body rendered with a subset of the records. Their
+    PDF are merged and stamped with the header, rendered once, and with page
+    numbers continued across the sections.
+    '''
+    # Space in CSS pixels between the stamped header and the body of the
+    # sections
+    section_header_gap = 12
+
+    @classmethod
+    def sections(cls, data):
+        'Return the records of the report split in independent sections'
+        return [data['records']]
+
+    @classmethod
+    def execute_sections(cls, ids, data):
+        '''
+        Return the result of execute with the PDF rendered by sections, or
+        None if the report must be rendered as a whole.
+        '''
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+        Config = pool.get('account.configuration')
+
+        config = Config(1)
+        workers = config.pdf_workers
+        if (not workers or workers < 2
+                or data.get('output_format') != 'pdf'
+                or not pypdf or not weasyprint):
+            return None
+        sections = cls.sections(data)
+        if len(sections) < 2:
+            return None
+
+        action, = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ], limit=1)
+        content = cls.render_sections(action, data, sections, workers)
+        return ('pdf', content, bool(action.direct_print), action.name)
+
+    @classmethod
+    def _section_html(cls, action, data, css, content):
+        doc = document(title=cls.title(action, data, []))
+        with doc.head:
+            style(raw(css))
+        doc.add(content)
+        return doc.render()
+
+    @staticmethod
+    def _content_height(document):
+        'Return the height in CSS pixels of the content of the first page'
+        page_box = document.pages[0]._page_box
+        return max((box.position_y + box.margin_height()
+                for box in page_box.descendants() if box is not page_box),
+            default=0)
+
+    @staticmethod
+    def _terminate_workers(executor):
+        'Stop the workers of the executor, shutdown lets them finish the jobs'
+        if hasattr(executor, 'terminate_workers'):
+            executor.terminate_workers()
+            return
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+
+    @classmethod
+    def render_sections(cls, action, data, sections, workers):
+        header_html = cls._section_html(action, data,
+            cls.css_header(action, data, [])
+            + '\n@page { margin: 0; }\n',
+            cls.header(action, data, []))
+        # The header is rendered first as its height, which depends on the
+        # filters of the report, is the top margin of the sections
+        header = weasyprint.HTML(string=header_html).render()
+        header_pdf = header.write_pdf()
+        margin_top = math.ceil(
+            cls._content_height(header) + cls.section_header_gap)
+        # The page numbers are stamped once the sections are merged
+        section_css = (cls.css_body(action, data, [])
+            + '\n@page { margin-top: %spx; @bottom-right { content: none; } }\n'
+            % margin_top)
+        htmls = [cls._section_html(action, data, section_css,
+                cls.body(action, dict(data, records=records), []))
+            for records in sections]
+
+        # Spawn the workers as forking would copy the database connections
+        executor = ProcessPoolExecutor(max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        try:
+            section_pdfs = list(executor.map(_write_pdf, htmls,
+                    timeout=Transaction().context.get('timeout_report')))
+        except TimeoutError:
+            cls._terminate_workers(executor)
+            raise UserError(gettext('account_reports.msg_timeout_exception'))
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        writer = pypdf.PdfWriter()
+        for section_pdf in section_pdfs:
+            writer.append(pypdf.PdfReader(BytesIO(section_pdf)))
+        # One empty page per page of the sections with the numbers of the
+        # common CSS
+        numbers_html = cls._section_html(action, data,
+            cls.css(action, data, []),
+            raw('<div style="page-break-after: always"></div>'
+                * (len(writer.pages) - 1) + '<div></div>'))
+        numbers = pypdf.PdfReader(BytesIO(_write_pdf(numbers_html))).pages
+        header_page = pypdf.PdfReader(BytesIO(header_pdf)).pages[0]
+        for page, number in zip(writer.pages, numbers):
+            page.merge_page(header_page)
+            page.merge_page(number)
+        content = BytesIO()
+        writer.write(content)
+        return content.getvalue()
+
+
 class Configuration(metaclass=PoolMeta):
     __name__ = 'account.configuration'
     default_timeout = fields.Integer('Timeout (s)')
+    pdf_workers = fields.Integer('PDF Workers',
+        help='The number of processes rendering the sections of the large PDF '
+        'reports in parallel.\n'
+        'Leave empty to render them in a single process.')
 
 
 class FiscalYear(metaclass=PoolMeta):
@@ -61,6 +591,248 @@ class FiscalYear(metaclass=PoolMeta):
         periods = Period.search(domain)
         return periods
 
+    @classmethod
+    def close(cls, fiscalyears):
+        pool = Pool()
+        BalanceCheckpoint = pool.get('account_reports.balance_checkpoint')
+        super().close(fiscalyears)
+        BalanceCheckpoint.build(fiscalyears)
+
+    @classmethod
+    def reopen(cls, fiscalyears):
+        pool = Pool()
+        BalanceCheckpoint = pool.get('account_reports.balance_checkpoint')
+        super().reopen(fiscalyears)
+        BalanceCheckpoint.clear(fiscalyears)
+
+
+class BalanceCheckpoint(ModelSQL):
+    'Balance Checkpoint'
+    __name__ = 'account_reports.balance_checkpoint'
+    fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
+        required=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    date = fields.Date('Date', required=True)
+    account = fields.Many2One('account.account', 'Account', required=True,
+        ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', ondelete='CASCADE')
+    debit = fields.Numeric('Debit', required=True)
+    credit = fields.Numeric('Credit', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t, (t.company, Index.Range()), (t.date, Index.Range())),
+                Index(t, (t.fiscalyear, Index.Range())),
+                })
+
+    @classmethod
+    def get_checkpoint(cls, company, date):
+        '''
+        Return the fiscal year id and the date of the last checkpoint of the
+        company at or before date, or None if there is none.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        query = table.select(table.fiscalyear, table.date,
+            where=(table.company == company.id) & (table.date <= date),
+            order_by=table.date.desc)
+        query.limit = 1
+        cursor.execute(*query)
+        return cursor.fetchone()
+
+    @classmethod
+    def get_amounts_query(cls, company, date, checkpoint):
+        '''
+        Return the query of account, party, debit and credit rows which sum
+        to the balances at date: the rows of the checkpoint and the lines
+        after it.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        table = cls.__table__()
+        line = Line.__table__()
+        move = Move.__table__()
+        fiscalyear, checkpoint_date = checkpoint
+        return Union(
+            table.select(
+                table.account.as_('account'), table.party.as_('party'),
+                table.debit.as_('debit'), table.credit.as_('credit'),
+                where=table.fiscalyear == fiscalyear),
+            line.join(move, condition=move.id == line.move).select(
+                line.account.as_('account'), line.party.as_('party'),
+                Coalesce(line.debit, 0).as_('debit'),
+                Coalesce(line.credit, 0).as_('credit'),
+                where=(move.company == company.id)
+                & (move.date > checkpoint_date)
+                & (move.date <= date)),
+            all_=True)
+
+    @classmethod
+    def build(cls, fiscalyears):
+        'Store the cumulative balances at the end of the fiscal years'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        table = cls.__table__()
+        line = Line.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cls.clear(fiscalyears)
+        for fiscalyear in sorted(fiscalyears, key=lambda f: f.end_date):
+            company = fiscalyear.company
+            checkpoint = cls.get_checkpoint(company, fiscalyear.start_date)
+            if checkpoint:
+                amounts = cls.get_amounts_query(company, fiscalyear.end_date,
+                    checkpoint)
+            else:
+                amounts = line.join(move, condition=move.id == line.move
+                    ).select(
+                        line.account.as_('account'), line.party.as_('party'),
+                        Coalesce(line.debit, 0).as_('debit'),
+                        Coalesce(line.credit, 0).as_('credit'),
+                        where=(move.company == company.id)
+                        & (move.date <= fiscalyear.end_date))
+            cursor.execute(*table.insert([
+                        table.create_uid, table.create_date,
+                        table.fiscalyear, table.company, table.date,
+                        table.account, table.party, table.debit, table.credit,
+                        ],
+                    amounts.select(
+                        Literal(transaction.user), CurrentTimestamp(),
+                        Literal(fiscalyear.id), Literal(company.id),
+                        Literal(fiscalyear.end_date),
+                        amounts.account, amounts.party,
+                        Sum(amounts.debit), Sum(amounts.credit),
+                        group_by=[amounts.account, amounts.party])))
+
+    @classmethod
+    def clear(cls, fiscalyears):
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.delete(
+                where=ids_in(table.fiscalyear, [f.id for f in fiscalyears])))
+
+
+class ReportExecution(ModelSQL):
+    'Report Execution'
+    __name__ = 'account_reports.execution'
+    report = fields.Char('Report', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    estimated_rows = fields.Integer('Estimated Rows')
+    duration = fields.Float('Duration (s)')
+    timed_out = fields.Boolean('Timed Out')
+    # Number of previous executions used to calibrate the estimates
+    _calibration_size = 10
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(
+            Index(t, (t.report, Index.Equality()),
+                (t.company, Index.Range())))
+
+    @staticmethod
+    def estimate_rows(query):
+        '''
+        Return the estimated number of rows of the query.
+
+        PostgreSQL gives the estimate of the planner without running the
+        query. Other backends can not estimate without running it, so None is
+        returned and the report is neither checked nor logged.
+        '''
+        cursor = Transaction().connection.cursor()
+        if backend.name == 'postgresql':
+            sql, params = tuple(query)
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan, = cursor.fetchone()
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+        return None
+
+    @classmethod
+    def seconds_per_row(cls, report, company):
+        '''
+        Return the seconds per estimated row of the last executions of the
+        report for the company, or None if there is no previous execution.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        query = table.select(table.estimated_rows, table.duration,
+            where=(table.report == report) & (table.company == company.id)
+            & (table.estimated_rows > 0),
+            order_by=table.id.desc)
+        query.limit = cls._calibration_size
+        cursor.execute(*query)
+        rows, duration = 0, 0.
+        for estimated_rows, seconds in cursor:
+            rows += estimated_rows
+            duration += seconds
+        if not rows:
+            return None
+        return duration / rows
+
+    @classmethod
+    def check(cls, report, company, rows, timeout):
+        '''
+        Warn the user when the previous executions of the report predict that
+        the rows will take longer than the timeout.
+        '''
+        Warning = Pool().get('res.user.warning')
+        if rows is None or not timeout:
+            return
+        rate = cls.seconds_per_row(report, company)
+        if not rate:
+            return
+        estimate = int(rows * rate)
+        if estimate > timeout:
+            key = Warning.format('%s.estimate' % report, [company])
+            if Warning.check(key):
+                raise UserWarning(key, gettext(
+                        'account_reports.msg_report_estimate',
+                        rows=rows, estimate=estimate, timeout=timeout))
+
+    @classmethod
+    def log(cls, report, company, rows, duration, timed_out=False):
+        '''
+        Store the actual duration of an execution of the report.
+
+        The timed out executions are stored in a separate transaction so they
+        are kept when the report raises its error, and so are the executions
+        of the reports called in a read-only transaction.
+        '''
+        if rows is None:
+            return
+        if timed_out or Transaction().readonly:
+            with Transaction().new_transaction() as transaction:
+                cls._log(report, company, rows, duration, timed_out)
+                transaction.commit()
+        else:
+            cls._log(report, company, rows, duration, timed_out)
+
+    @classmethod
+    def _log(cls, report, company, rows, duration, timed_out):
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        cursor.execute(*table.insert([
+                    table.create_uid, table.create_date,
+                    table.report, table.company, table.estimated_rows,
+                    table.duration, table.timed_out,
+                    ], [[
+                    transaction.user, CurrentTimestamp(),
+                    report, company.id, rows, duration, timed_out,
+                    ]]))
+
 
 class AccountTemplate(metaclass=PoolMeta):
     __name__ = 'account.account.template'
@@ -74,6 +846,7 @@ class AccountTemplate(metaclass=PoolMeta):
 
 class Account(metaclass=PoolMeta):
     __name__ = 'account.account'
+    _html_chart_cache = Cache('account.account.html_chart', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -81,11 +854,98 @@ class Account(metaclass=PoolMeta):
         # hide because used in odt report
         cls.general_ledger_balance.states['invisible'] = True
 
+    @classmethod
+    def on_modification(cls, mode, accounts, field_names=None):
+        super().on_modification(mode, accounts, field_names=field_names)
+        cls._html_chart_cache.clear()
+
+    @classmethod
+    def html_get_chart(cls, company):
+        '''
+        Return the chart of accounts of the company as a dictionary with the
+        account id as key and a tuple of (parent, code, name, kind) as value.
+        Kind is 'receivable', 'payable' or 'other'.
+
+        The chart is read with a single query, including the inactive
+        accounts, and kept in cache until an account is modified.
+        '''
+        pool = Pool()
+        AccountType = pool.get('account.account.type')
+        account = cls.__table__()
+        account_type = AccountType.__table__()
+        company_id = int(company)
+
+        chart = cls._html_chart_cache.get(company_id)
+        if chart is not None:
+            return chart
+
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*account.join(account_type, 'LEFT',
+                condition=account.type == account_type.id
+                ).select(account.id, account.parent, account.code,
+                    account.name, account_type.receivable,
+                    account_type.payable,
+                    where=account.company == company_id))
+        chart = {}
+        for id_, parent, code, name, receivable, payable in cursor:
+            kind = 'other'
+            if receivable:
+                kind = 'receivable'
+            elif payable:
+                kind = 'payable'
+            chart[id_] = (parent, code, name, kind)
+        cls._html_chart_cache.set(company_id, chart)
+        return chart
+
+    @classmethod
+    def html_get_level_accounts(cls, company, level):
+        '''
+        Return the ids of the accounts with a code of level characters and of
+        the final accounts with a shorter code.
+        '''
+        account = cls.__table__()
+        child = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        code_length = CharLength(account.code)
+        cursor.execute(*account.select(account.id,
+                where=(account.company == int(company))
+                & (account.parent != Null)
+                & (account.code != Null)
+                & ((code_length == level)
+                    | ((account.type != Null)
+                        & (code_length < level)
+                        & ~Exists(child.select(child.id,
+                                where=child.parent == account.id)))),
+                order_by=account.code.asc))
+        return [id_ for id_, in cursor]
+
+    @classmethod
+    def html_get_final_account_ids(cls, accounts, company):
+        '''
+        Return the ids of the accounts without children, of the company if
+        no account is given.
+        '''
+        account = cls.__table__()
+        child = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        if not accounts:
+            accounts = cls.search([
+                    ('company', '=', company),
+                    ])
+        if not accounts:
+            return []
+        cursor.execute(*account.select(account.id,
+                where=ids_in(account.id, [a.id for a in accounts])
+                & ~Exists(child.select(child.id,
+                        where=child.parent == account.id))))
+        return [id_ for id_, in cursor]
+
     @classmethod
     def html_read_account_vals(cls, accounts, company, with_moves=False,
             exclude_party_moves=False):
         pool = Pool()
         Account = pool.get('account.account')
+        BalanceCheckpoint = pool.get('account_reports.balance_checkpoint')
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
         line = MoveLine.__table__()
@@ -93,66 +953,290 @@ class Account(metaclass=PoolMeta):
         table_a = Account.__table__()
         table_c = Account.__table__()
 
-        in_max = 3000
         values = {}
         transaction = Transaction()
         cursor = transaction.connection.cursor()
         move_join = 'INNER' if with_moves else 'LEFT'
-        if not accounts:
-            accounts = Account.search([
-                    ('company', '=', company),
-                    ])
-        account_ids = [a.id for a in accounts if not a.childs]
+        account_ids = cls.html_get_final_account_ids(accounts, company)
+        if not account_ids:
+            return values
+        periods = transaction.context.get('periods', False)
+        date = transaction.context.get('date')
+        checkpoint = None
+        if date and not periods:
+            checkpoint = BalanceCheckpoint.get_checkpoint(company, date)
+        if checkpoint:
+            # The balances at date are the ones of the checkpoint plus the
+            # lines after it
+            line = BalanceCheckpoint.get_amounts_query(company, date,
+                checkpoint)
+            from_ = table_a.join(table_c,
+                condition=(table_c.left >= table_a.left)
+                & (table_c.right <= table_a.right)
+                ).join(line, condition=line.account == table_c.id)
+            where = ids_in(table_a.id, account_ids)
+        else:
+            from_ = table_a.join(table_c,
+                condition=(table_c.left >= table_a.left)
+                & (table_c.right <= table_a.right)
+                ).join(line, move_join,
+                    condition=line.account == table_c.id
+                ).join(move, move_join,
+                    condition=move.id == line.move)
+            where = ids_in(table_a.id, account_ids)
+            if periods:
+                where &= ids_in(Coalesce(move.period, 0), list(periods) + [0])
+            if date:
+                where &= (move.date <= date)
+                where &= (move.company == company.id)
+        if exclude_party_moves:
+            # This "where" not use account kind (before a change use it)
+            # because there are some companies that the accounts kind and
+            # party_required use in a different way that "standard".
+            # For example if you check the prty_required an account with
+            # the kind equal to 'other'
+            where = (where & (line.party == None))
+
         group_by = (table_a.id,)
         columns = (group_by + (Sum(Coalesce(line.debit, 0)).as_('debit'),
                 Sum(Coalesce(line.credit, 0)).as_('credit'),
                 (Sum(Coalesce(line.debit, 0)) -
                     Sum(Coalesce(line.credit, 0))).as_('balance')))
-        for i in range(0, len(account_ids), in_max):
-            sub_ids = account_ids[i:i + in_max]
-            red_sql = reduce_ids(table_a.id, sub_ids)
-            where = red_sql
-            periods = transaction.context.get('periods', False)
-            if periods:
-                periods.append(0)
-                where = (where & In(Coalesce(move.period, 0), periods))
-            date = transaction.context.get('date')
-            if date:
-                where &= (move.date <= date)
-                where &= (move.date <= date)
-                where &= (move.company == company.id)
-            if exclude_party_moves:
-                # This "where" not use account kind (before a change use it)
-                # because there are some companies that the accounts kind and
-                # party_required use in a different way that "standard".
-                # For example if you check the prty_required an account with
-                # the kind equal to 'other'
-                where = (where & (line.party == None))
-
-            cursor.execute(*table_a.join(table_c,
-                    condition=(table_c.left >= table_a.left)
-                    & (table_c.right <= table_a.right)
-                    ).join(line, move_join,
-                        condition=line.account == table_c.id
-                    ).join(move, move_join,
-                        condition=move.id == line.move
-                    ).select(*columns, where=where, group_by=group_by))
-
-            for account, debit, credit, balance in cursor.fetchall():
-                # SQLite uses float for SUM
-                if not isinstance(credit, Decimal):
-                    credit = Decimal(str(credit))
-                if not isinstance(debit, Decimal):
-                    debit = Decimal(str(debit))
-                if not isinstance(balance, Decimal):
-                    balance = Decimal(str(balance))
-                values[account] = {
-                    'credit': credit,
-                    'debit': debit,
-                    'balance': balance,
+        cursor.execute(*from_.select(*columns, where=where, group_by=group_by))
+
+        units = MinorUnits(company.currency.digits)
+        for account, debit, credit, balance in cursor.fetchall():
+            credit = units.amount(credit)
+            debit = units.amount(debit)
+            balance = units.amount(balance)
+            values[account] = {
+                'credit': credit,
+                'debit': debit,
+                'balance': balance,
+                }
+        return values
+
+    @classmethod
+    def html_read_account_vals_by_period(cls, accounts, company,
+            exclude_party_moves=False):
+        '''
+        Compute credit and debit of the final accounts for each period.
+
+        All the periods are computed with a single grouped query so the moves
+        are only scanned once. Returns a dictionary with the account id as key
+        and a dictionary of period id and values as value.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+
+        values = {}
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        account_ids = cls.html_get_final_account_ids(accounts, company)
+        if not account_ids:
+            return values
+        group_by = (account.id, move.period)
+        columns = group_by + (Sum(Coalesce(line.debit, 0)).as_('debit'),
+            Sum(Coalesce(line.credit, 0)).as_('credit'))
+        where = (ids_in(account.id, account_ids)
+            & (move.company == company.id))
+        periods = transaction.context.get('periods')
+        if periods:
+            where &= ids_in(move.period, periods)
+        date = transaction.context.get('date')
+        if date:
+            where &= (move.date <= date)
+        if exclude_party_moves:
+            where &= (line.party == Null)
+
+        cursor.execute(*account.join(line,
+                condition=line.account == account.id
+                ).join(move,
+                    condition=move.id == line.move
+                ).select(*columns, where=where, group_by=group_by))
+
+        units = MinorUnits(company.currency.digits)
+        for account_id, period_id, debit, credit in cursor:
+            credit = units.amount(credit)
+            debit = units.amount(debit)
+            values.setdefault(account_id, {})[period_id] = {
+                'credit': credit,
+                'debit': debit,
+                }
+        return values
+
+    @classmethod
+    def html_read_account_vals_by_digits(cls, accounts, company, digits,
+            with_moves=False, exclude_party_moves=False):
+        '''
+        Compute credit, debit and balance of the final accounts grouped by the
+        first digits of their code.
+
+        The grouping is done by the database so only one row per group is
+        returned. The name of each group is the one of the account with that
+        code or, if it does not exist, the one of its nearest parent. The type
+        of each group is the one of its first final account by code.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+
+        values = {}
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        move_join = 'INNER' if with_moves else 'LEFT'
+        account_ids = cls.html_get_final_account_ids(accounts, company)
+        if not account_ids:
+            return values
+        chart = cls.html_get_chart(company)
+        kinds = {chart[a][1]: chart[a][3] for a in account_ids if a in chart}
+        code = Substring(account.code, 1, digits)
+        columns = (code.as_('code'),
+            Sum(Coalesce(line.debit, 0)).as_('debit'),
+            Sum(Coalesce(line.credit, 0)).as_('credit'),
+            Min(account.code).as_('first_code'))
+        where = ids_in(account.id, account_ids)
+        periods = transaction.context.get('periods', False)
+        if periods:
+            where &= ids_in(Coalesce(move.period, 0), list(periods) + [0])
+        date = transaction.context.get('date')
+        if date:
+            where &= (move.date <= date)
+            where &= (move.company == company.id)
+        if exclude_party_moves:
+            where &= (line.party == Null)
+
+        cursor.execute(*account.join(line, move_join,
+                    condition=line.account == account.id
+                ).join(move, move_join,
+                    condition=move.id == line.move
+                ).select(*columns, where=where, group_by=(code,)))
+
+        units = MinorUnits(company.currency.digits)
+        for code_, debit, credit, first_code in cursor:
+            credit = units.amount(credit)
+            debit = units.amount(debit)
+            if code_ not in values:
+                values[code_] = {
+                    'name': None,
+                    'credit': Decimal(0),
+                    'debit': Decimal(0),
+                    'balance': Decimal(0),
+                    'type': kinds.get(first_code, 'other'),
+                    }
+            group = values[code_]
+            group['credit'] += credit
+            group['debit'] += debit
+            group['balance'] += debit - credit
+
+        cls._html_set_group_names(company, digits, values)
+        return values
+
+    @classmethod
+    def html_read_account_vals_by_digits_and_period(cls, accounts, company,
+            digits, with_moves=False):
+        '''
+        Compute credit and debit of the final accounts grouped by the first
+        digits of their code and by period.
+
+        Returns a dictionary with the code as key and a dictionary with the
+        name and type of the group, as html_read_account_vals_by_digits, and
+        the dictionary of period id and values as 'periods'. Without moves
+        a group has no period.
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        MoveLine = pool.get('account.move.line')
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        account = cls.__table__()
+
+        values = {}
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        account_ids = cls.html_get_final_account_ids(accounts, company)
+        if not account_ids:
+            return values
+        chart = cls.html_get_chart(company)
+        kinds = {chart[a][1]: chart[a][3] for a in account_ids if a in chart}
+
+        where = move.company == company.id
+        periods = transaction.context.get('periods')
+        if periods:
+            where &= ids_in(move.period, periods)
+        date = transaction.context.get('date')
+        if date:
+            where &= (move.date <= date)
+        lines = line.join(move, condition=move.id == line.move
+            ).select(line.account, move.period, line.debit, line.credit,
+                where=where)
+
+        code = Substring(account.code, 1, digits)
+        cursor.execute(*account.join(lines,
+                'INNER' if with_moves else 'LEFT',
+                condition=lines.account == account.id
+                ).select(code.as_('code'), lines.period,
+                    Sum(Coalesce(lines.debit, 0)).as_('debit'),
+                    Sum(Coalesce(lines.credit, 0)).as_('credit'),
+                    Min(account.code).as_('first_code'),
+                    where=ids_in(account.id, account_ids),
+                    group_by=(code, lines.period)))
+
+        units = MinorUnits(company.currency.digits)
+        first_codes = {}
+        for code_, period_id, debit, credit, first_code in cursor:
+            group = values.setdefault(code_, {
+                    'name': None,
+                    'type': 'other',
+                    'periods': {},
+                    })
+            if period_id is not None:
+                group['periods'][period_id] = {
+                    'debit': units.amount(debit),
+                    'credit': units.amount(credit),
                     }
+            if (first_code is not None
+                    and (code_ not in first_codes
+                        or first_code < first_codes[code_])):
+                first_codes[code_] = first_code
+                group['type'] = kinds.get(first_code, 'other')
+
+        cls._html_set_group_names(company, digits, values)
         return values
 
+    @classmethod
+    def _html_set_group_names(cls, company, digits, values):
+        '''
+        Set the name of the groups of values by the first digits of the code
+        to the one of the account with that code or of its nearest parent.
+        '''
+        table_p = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        # Get the names from the accounts with a code of at most digits
+        # characters, the deepest ones win when some codes are repeated
+        names = {}
+        cursor.execute(*table_p.select(table_p.code, table_p.name,
+                where=(table_p.company == company.id)
+                & (table_p.parent != Null)
+                & (CharLength(table_p.code) <= digits),
+                order_by=table_p.left.asc))
+        for code_, name in cursor:
+            names[code_] = name
+        for code_, group in values.items():
+            for length in range(len(code_ or ''), 0, -1):
+                if code_[:length] in names:
+                    group['name'] = names[code_[:length]]
+                    break
+
 
 class Party(metaclass=PoolMeta):
     __name__ = 'party.party'
@@ -164,6 +1248,7 @@ class Party(metaclass=PoolMeta):
         '''
         res = {}
         pool = Pool()
+        BalanceCheckpoint = pool.get('account_reports.balance_checkpoint')
         Move = pool.get('account.move')
         MoveLine = pool.get('account.move.line')
         Account = pool.get('account.account')
@@ -175,24 +1260,35 @@ class Party(metaclass=PoolMeta):
         line = MoveLine.__table__()
         account = Account.__table__()
 
+        checkpoint = None
+        if context.get('date'):
+            checkpoint = BalanceCheckpoint.get_checkpoint(company,
+                context['date'])
+        if checkpoint:
+            # The balances at date are the ones of the checkpoint plus the
+            # lines after it
+            line = BalanceCheckpoint.get_amounts_query(company,
+                context['date'], checkpoint)
+            line_query = Literal(True)
+        elif context.get('date'):
+            # Cumulate data from previous fiscalyears
+            line_query = line.move.in_(move.select(move.id,
+                        where=((move.date <= context.get('date'))
+                            & (move.company == company.id))))
+        else:
+            line_query, _ = MoveLine.query_get(line)
         order_by = (line.account,)
         group_by = (line.party, line.account,)
         columns = (group_by + (Sum(Coalesce(line.debit, 0)).as_('debit'),
                 Sum(Coalesce(line.credit, 0)).as_('credit'),
                 (Sum(Coalesce(line.debit, 0)) -
                     Sum(Coalesce(line.credit, 0))).as_('balance')))
-        line_query, _ = MoveLine.query_get(line)
-        if context.get('date'):
-            # Cumulate data from previous fiscalyears
-            line_query = line.move.in_(move.select(move.id,
-                        where=((move.date <= context.get('date'))
-                            & (move.company == company.id))))
         where = (line_query &
             (account.company == company.id))
         if accounts:
-            where = where & line.account.in_([a.id for a in accounts])
+            where = where & ids_in(line.account, [a.id for a in accounts])
         if parties:
-            where = where & line.party.in_([p.id for p in parties])
+            where = where & ids_in(line.party, [p.id for p in parties])
         else:
             where = where & (line.party != None)
         cursor.execute(*line.join(account,
@@ -200,14 +1296,11 @@ class Party(metaclass=PoolMeta):
                 ).select(*columns, where=where, order_by=order_by,
                     group_by=group_by))
 
+        units = MinorUnits(company.currency.digits)
         for party, account, debit, credit, balance in cursor.fetchall():
-            # SQLite uses float for SUM
-            if not isinstance(credit, Decimal):
-                credit = Decimal(str(credit))
-            if not isinstance(debit, Decimal):
-                debit = Decimal(str(debit))
-            if not isinstance(balance, Decimal):
-                balance = Decimal(str(balance))
+            credit = units.amount(credit)
+            debit = units.amount(debit)
+            balance = units.amount(balance)
 
             if account not in res:
                 res[account] = {}
@@ -217,3 +1310,86 @@ class Party(metaclass=PoolMeta):
                 'balance': balance,
                 }
         return res
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._sql_indexes.update(cls._report_sql_indexes())
+
+    @classmethod
+    def _report_sql_indexes(cls):
+        t = cls.__table__()
+        return {
+            # Index for the moves of the company by date
+            Index(
+                t,
+                (t.company, Index.Range()),
+                (t.date, Index.Range()),
+                (t.id, Index.Range(cardinality='high'))),
+            # Index for the moves of the company by period
+            Index(
+                t,
+                (t.company, Index.Range()),
+                (t.period, Index.Range())),
+            }
+
+
+class MoveLine(metaclass=PoolMeta):
+    __name__ = 'account.move.line'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._sql_indexes.update(cls._report_sql_indexes())
+
+    @classmethod
+    def _report_sql_indexes(cls):
+        t = cls.__table__()
+        return {
+            # Index for the ledgers and open items by account and party
+            Index(
+                t,
+                (t.account, Index.Range()),
+                (t.party, Index.Range()),
+                (t.move, Index.Range(cardinality='high'))),
+            }
+
+
+def report_indexes_status():
+    '''
+    Return the status of the indexes declared for the reports as a list of
+    (table, index, status) where status is 'missing' if the index does not
+    exist in the database, 'unused' if PostgreSQL has never scanned it since
+    its statistics were reset, or 'used'.
+    '''
+    pool = Pool()
+    cursor = Transaction().connection.cursor()
+    status = []
+    for model_name in ['account.move', 'account.move.line']:
+        Model = pool.get(model_name)
+        table_h = Model.__table_handler__()
+        scans = {}
+        if backend.name == 'postgresql':
+            cursor.execute('SELECT indexrelname, idx_scan '
+                'FROM pg_stat_user_indexes WHERE relname = %s',
+                (Model._table,))
+            scans = dict(cursor)
+        for index in Model._report_sql_indexes():
+            translator = table_h.index_translator_for(index)
+            if not translator:
+                continue
+            name = translator.definition(index)[0]
+            # Same name as the one given by TableHandler.set_indexes
+            name = 'idx_' + table_h.convert_name(
+                '_'.join([Model._table, name]), reserved=len('idx_'))
+            if name not in table_h._indexes:
+                status.append((Model._table, name, 'missing'))
+            elif scans.get(name) == 0:
+                status.append((Model._table, name, 'unused'))
+            else:
+                status.append((Model._table, name, 'used'))
+    return status
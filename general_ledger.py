@@ -1,18 +1,25 @@
 # This file is part of account_reports for tryton.  The COPYRIGHT file
 # at the top level of this repository contains the full copyright notices and
 # license terms.
+import hashlib
+import json
 from datetime import timedelta, datetime
 from decimal import Decimal
+from sql import Null
+from sql.aggregate import Count, Max
+from sql.conditionals import Case, Coalesce
 from trytond.pool import Pool, PoolMeta
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
 from trytond.transaction import Transaction
-from trytond.model import ModelView, fields
+from trytond.model import Index, ModelSQL, ModelView, fields
 from trytond.wizard import Wizard, StateView, StateReport, Button
 from trytond.pyson import Eval, Bool, If
 from trytond.tools import grouped_slice
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.modules.account_reports.common import (
-    TimeoutException, TimeoutChecker, css as common_css)
+    LedgerRow, MinorUnits, ReportContext, SectionPdfMixin, TimeoutException,
+    TimeoutChecker, css as common_css, ids_in)
 from trytond.modules.account_reports.tools import vat_label
 from trytond.modules.account_reports.xlsx import (
     XlsxReport, save_workbook, convert_str_to_float)
@@ -105,6 +112,10 @@ class PrintGeneralLedgerStart(ModelView):
         'the process will be stopped automatically.')
     show_description = fields.Boolean('Show Description',
         help='If checked show description from Account Move Line')
+    incremental = fields.Boolean('Incremental',
+        help='If checked the ledger of the previous run with the same '
+        'filters is reused and only the accounts with lines created or '
+        'modified since then are computed again.')
 
     @staticmethod
     def default_fiscalyear():
@@ -138,6 +149,10 @@ class PrintGeneralLedgerStart(ModelView):
     def default_show_description():
         return False
 
+    @staticmethod
+    def default_incremental():
+        return False
+
     @fields.depends('fiscalyear')
     def on_change_fiscalyear(self):
         self.start_period = None
@@ -179,7 +194,9 @@ class PrintGeneralLedger(Wizard):
             'output_format': self.start.output_format,
             'timeout': self.start.timeout,
             'show_description': self.start.show_description,
+            'incremental': self.start.incremental,
             }
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             action_report, = ActionReport.search([
@@ -188,6 +205,20 @@ class PrintGeneralLedger(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        'Estimate the lines of the report and warn if it may time out'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.general_ledger', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.general_ledger_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            self.start.timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -208,7 +239,175 @@ class PrintGeneralLedger(Wizard):
             }
 
 
-class GeneralLedgerReport(DominateReport):
+class GeneralLedgerSnapshot(ModelSQL):
+    'General Ledger Snapshot'
+    __name__ = 'account_reports.general_ledger.snapshot'
+    key = fields.Char('Key', required=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        ondelete='CASCADE')
+    records = fields.Text('Records')
+    max_line = fields.Integer('Max Line')
+    line_count = fields.Integer('Line Count')
+    watermark = fields.Timestamp('Watermark')
+    # The dates and ids of the lines are set when their transaction starts,
+    # so the lines of a transaction committed after the snapshot may be older
+    # than its watermark. The lines of this trailing window are always read
+    # again.
+    _refresh_lag = timedelta(hours=1)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.key, Index.Equality())))
+
+    @staticmethod
+    def get_key(data):
+        '''
+        Return the key of the filters of the general ledger data
+        '''
+        filters = {k: data.get(k) for k in [
+                'company', 'fiscalyear', 'start_period', 'end_period',
+                'start_date', 'end_date', 'accounts', 'all_accounts',
+                'parties', 'show_description']}
+        return hashlib.sha256(json.dumps(filters, sort_keys=True,
+                cls=JSONEncoder).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_state(cls, company):
+        '''
+        Return the max line id, the number of lines and the last write date
+        of the lines and moves of the company.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        line = Line.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).select(Max(line.id), Count(line.id),
+                    Max(Coalesce(line.write_date, line.create_date)),
+                    Max(Coalesce(move.write_date, move.create_date)),
+                    where=move.company == company.id))
+        max_line, line_count, line_date, move_date = cursor.fetchone()
+        dates = []
+        for date in (line_date, move_date):
+            # SQLite returns a string for MAX of timestamps
+            if isinstance(date, str):
+                date = datetime.fromisoformat(date)
+            if date:
+                dates.append(date)
+        return max_line or 0, line_count or 0, max(dates) if dates else None
+
+    def get_touched_accounts(self, records):
+        '''
+        Return the ids of the accounts with lines created, modified or
+        deleted since the snapshot or None if they can not be known.
+
+        The lines created with an id lower than the max line of the snapshot
+        change the line count, and the lines modified by a transaction that
+        started before the snapshot are in the trailing window of its
+        watermark.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        line = Line.__table__()
+        move = Move.__table__()
+        party = Party.__table__()
+        account = Account.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_count = self.get_state(self.company)[1]
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).select(Count(line.id),
+                    where=(move.company == self.company.id)
+                    & (line.id > self.max_line)))
+        new_count, = cursor.fetchone()
+        if line_count != self.line_count + new_count:
+            # Some lines have been deleted or created below the max line
+            return None
+        if self.watermark is None:
+            return None
+        cursor.execute(*account.select(account.id,
+                where=(account.company == self.company.id)
+                & (Coalesce(account.write_date, account.create_date)
+                    > self.watermark)))
+        if cursor.fetchone():
+            # The codes and names of the accounts may have changed
+            return None
+
+        since = self.watermark - self._refresh_lag
+
+        touched = party.select(party.id,
+            where=Coalesce(party.write_date, party.create_date)
+            > since)
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).select(line.id, line.account,
+                    where=(move.company == self.company.id)
+                    & ((line.id > self.max_line)
+                        | (Coalesce(line.write_date, line.create_date)
+                            > since)
+                        | (Coalesce(move.write_date, move.create_date)
+                            > since)
+                        | line.party.in_(touched))))
+        account_ids = set()
+        line_ids = set()
+        for line_id, account_id in cursor:
+            account_ids.add(account_id)
+            line_ids.add(line_id)
+
+        # The previous accounts of the modified lines
+        codes = set()
+        for key, record in records.items():
+            for line_info in record['lines']:
+                if line_info['line'] and line_info['line'] in line_ids:
+                    codes.add(key[0])
+                    break
+        if codes:
+            cursor.execute(*account.select(account.id,
+                    where=(account.company == self.company.id)
+                    & account.code.in_(list(codes))))
+            account_ids.update(a for a, in cursor)
+        return account_ids
+
+    @classmethod
+    def dump_records(cls, records):
+        values = []
+        for key, record in records.items():
+            record = record.copy()
+            record['lines'] = [l.values() for l in record['lines']]
+            values.append([list(key), record])
+        return json.dumps(values, cls=JSONEncoder, separators=(',', ':'))
+
+    @classmethod
+    def load_records(cls, value):
+        records = {}
+        for key, record in json.loads(value, object_hook=JSONDecoder()):
+            record['lines'] = [LedgerRow.from_values(l)
+                for l in record['lines']]
+            records[tuple(key)] = record
+        return records
+
+    @classmethod
+    def store(cls, data, company, records, state):
+        max_line, line_count, watermark = state
+        key = cls.get_key(data)
+        cls.delete(cls.search([('key', '=', key)]))
+        cls.create([{
+                    'key': key,
+                    'company': company.id,
+                    'records': cls.dump_records(records),
+                    'max_line': max_line,
+                    'line_count': line_count,
+                    'watermark': watermark,
+                    }])
+
+
+class GeneralLedgerReport(SectionPdfMixin, DominateReport):
     __name__ = 'account_reports.general_ledger'
     page_orientation = 'landscape'
 
@@ -298,13 +497,74 @@ class GeneralLedgerReport(DominateReport):
         return (ref if ref else (line.move_origin.rec_name if line.move_origin
                 and hasattr(line.move_origin, 'rec_name') else None))
 
+    @classmethod
+    def prepare_incremental(cls, data, checker):
+        '''
+        Return the records and parameters of the general ledger reusing the
+        records of the previous run with the same filters. Only the accounts
+        with lines created or modified since that run are computed again.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Snapshot = pool.get('account_reports.general_ledger.snapshot')
+
+        data = data.copy()
+        data.pop('incremental')
+        company = Company(data['company'])
+        state = Snapshot.get_state(company)
+        snapshots = Snapshot.search([
+                ('key', '=', Snapshot.get_key(data)),
+                ], limit=1)
+        touched = None
+        if snapshots:
+            snapshot, = snapshots
+            records = Snapshot.load_records(snapshot.records)
+            touched = snapshot.get_touched_accounts(records)
+        if touched is None:
+            records, parameters = cls.prepare(data, checker)
+            Snapshot.store(data, company, records, state)
+            return records, parameters
+        if data.get('accounts'):
+            # The accounts outside of the filter are not in the ledger
+            touched &= set(data['accounts'])
+
+        # Only the parameters are computed when no account is touched
+        refreshed, parameters = cls.prepare(
+            dict(data, refresh_accounts=list(touched)), checker)
+        if touched:
+            Account = pool.get('account.account')
+            codes = {a.code or str(a.id) for a in Account.browse(touched)}
+            records = {k: v for k, v in records.items() if k[0] not in codes}
+            records.update(refreshed)
+            records = cls._renumber(records)
+            Snapshot.store(data, company, records, state)
+        return dict(sorted(records.items())), parameters
+
+    @staticmethod
+    def _renumber(records):
+        '''
+        Number again the lines of the records in their printed order, as the
+        refreshed accounts start their sequence at 1.
+        '''
+        records = dict(sorted(records.items()))
+        sequence = 0
+        for record in records.values():
+            for line in record['lines']:
+                sequence += 1
+                line.sequence = sequence
+        return records
+
     @classmethod
     def prepare(cls, data, checker):
+        if data.get('incremental'):
+            return cls.prepare_incremental(data, checker)
         pool = Pool()
         Company = pool.get('company.company')
         FiscalYear = pool.get('account.fiscalyear')
         Period = pool.get('account.period')
         Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        Move = pool.get('account.move')
         Party = pool.get('party.party')
         Line = pool.get('account.move.line')
         Invoice = pool.get('account.invoice')
@@ -323,6 +583,8 @@ class GeneralLedgerReport(DominateReport):
                 and currentKey[1] else 'None')
             return (currentKey[0].code, party or 'None')
 
+        # The accounts, parties and periods are read once for the report
+        lookup = ReportContext()
         fiscalyear = (FiscalYear(data['fiscalyear']) if data.get('fiscalyear')
             else None)
         start_period = None
@@ -381,53 +643,54 @@ class GeneralLedgerReport(DominateReport):
         parameters['accounts'] = accounts_subtitle
         parameters['parties'] = parties_subtitle
         parameters['show_description'] = data.get('show_description', True)
-
-        where = ''
+        show_description = parameters['show_description']
+
+        if 'refresh_accounts' in data:
+            # Only the accounts touched since a previous run are computed
+            accounts = Account.browse(data['refresh_accounts'])
+            if not accounts:
+                return {}, parameters
+
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
         if accounts:
-            where += "aml.account in (%s) " % (
-                ",".join([str(a.id) for a in accounts]))
+            where = ids_in(line.account, [a.id for a in accounts])
         else:
-            where += "aa.parent is not null "
+            where = (account.parent != Null)
 
         if start_date:
-            where += "and am.company = %s " % company.id
-            where += "and am.date >= '%s' " % start_date
-            where += "and am.date <= '%s' " % end_date
+            where &= (move.company == company.id)
+            where &= (move.date >= start_date)
+            where &= (move.date <= end_date)
         else:
-            filter_periods = fiscalyear.get_periods(start_period, end_period)
-            where += "and am.period in (%s) " % (
-                ",".join([str(a.id) for a in filter_periods]))
+            filter_periods = lookup.get_periods(fiscalyear, start_period,
+                end_period)
+            where &= ids_in(move.period, [a.id for a in filter_periods])
 
         if parties:
-            where += " and aml.party in (%s)" % (
-                ",".join([str(a.id) for a in parties]))
+            where &= ids_in(line.party, [a.id for a in parties])
 
         cursor = Transaction().connection.cursor()
-        cursor.execute("""
-            SELECT
-                aml.id
-            FROM
-                account_move_line aml,
-                account_move am,
-                account_account aa,
-                account_account_type aat
-            WHERE
-                am.id = aml.move AND
-                aa.id = aml.account AND
-                aa.type = aat.id AND
-                %s
-            ORDER BY
-                aml.account,
-                -- Sort by party only when account is of
-                -- type 'receivable' or 'payable'
-                -- or party_requierd is True
-                CASE WHEN aat.receivable or aat.payable or
-                    aa.party_required THEN aml.party ELSE 0 END,
-                am.date,
-                am.id,
-                am.description,
-                aml.id
-            """ % where)
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).join(account, condition=account.id == line.account
+                ).join(account_type, condition=account_type.id == account.type
+                ).select(line.id,
+                    where=where,
+                    order_by=[
+                        line.account,
+                        # Sort by party only when account is of type
+                        # 'receivable' or 'payable' or party_required is True
+                        Case((account_type.receivable
+                                | account_type.payable
+                                | account.party_required, line.party),
+                            else_=0),
+                        move.date,
+                        move.id,
+                        move.description,
+                        line.id,
+                        ]))
         line_ids = [x[0] for x in cursor.fetchall()]
 
         if not start_date:
@@ -447,19 +710,21 @@ class GeneralLedgerReport(DominateReport):
         parties_general_ledger = set() # (account_id, party_id)
         lastKey = None
         sequence = 0
-        accounts_w_moves = []
-        balance = _ZERO
+        accounts_w_moves = set()
+        # The balances and totals are summed as integer cents
+        units = MinorUnits(company.currency.digits)
+        totals = {}
+        balance = 0
         # Add the asked period/date lines in records
         for group_lines in grouped_slice(line_ids):
             checker.check()
             init_balance = _ZERO
             init_party_balance = _ZERO
             for line in Line.browse(group_lines):
-                if line.account not in accounts_w_moves:
-                    accounts_w_moves.append(line.account.id)
+                accounts_w_moves.add(line.account.id)
                 currentKey = (line.account, line.party)
                 if lastKey != currentKey:
-                    balance = _ZERO
+                    balance = 0
                     lastKey = currentKey
                     account_id = currentKey[0].id
                     party_id = (currentKey[1].id if len(currentKey) > 1
@@ -472,12 +737,14 @@ class GeneralLedgerReport(DominateReport):
 
                 credit = line.credit
                 debit = line.debit
-                balance += line.debit - line.credit
+                debit_cents = units.to_cents(debit)
+                credit_cents = units.to_cents(credit)
+                balance += debit_cents - credit_cents
                 if init_party_balance:
-                    balance += init_party_balance
+                    balance += units.to_cents(init_party_balance)
                     init_party_balance = _ZERO
                 elif init_balance:
-                    balance += init_balance
+                    balance += units.to_cents(init_balance)
                     init_balance = _ZERO
                 sequence += 1
 
@@ -515,21 +782,28 @@ class GeneralLedgerReport(DominateReport):
                 if line.account.party_required and not party:
                     party = line.party
 
-                rline = {
-                    'sequence': sequence,
-                    'line': line,
-                    'ref': ref,
-                    'credit': credit,
-                    'debit': debit,
-                    'balance': balance,
-                    'party': party
-                    }
+                # Only the displayed values are kept, not the line instance
+                rline = LedgerRow(
+                    sequence=sequence,
+                    line=line.id,
+                    date=line.date,
+                    number=(line.move.number
+                        or (line.party.name if line.party else '')),
+                    ref=ref,
+                    credit=credit,
+                    debit=debit,
+                    balance=units.to_decimal(balance),
+                    party=party.id if party else None)
+                if show_description:
+                    rline.description = line.description
+                    rline.move_description = line.move_description_used
 
                 key = _get_key(currentKey)
+                total = totals.setdefault(key, [0, 0])
+                total[0] += debit_cents
+                total[1] += credit_cents
                 if records.get(key):
                     records[key]['lines'].append(rline)
-                    records[key]['total_debit'] += debit
-                    records[key]['total_credit'] += credit
                 else:
                     previous_balance = init_values.get(
                         line.account.id, {}).get('balance', _ZERO)
@@ -547,20 +821,23 @@ class GeneralLedgerReport(DominateReport):
                         'total_debit': debit,
                         'total_credit': credit,
                         }
+        for key, (debit_cents, credit_cents) in totals.items():
+            records[key]['total_debit'] = units.to_decimal(debit_cents)
+            records[key]['total_credit'] = units.to_decimal(credit_cents)
 
         # Control if there are some party moves with initial value, but not
         # values in the current period control moves and must be to set.
         missing_init_parties = list(
             set(init_parties) - set([p[1] for p in parties_general_ledger]))
         if missing_init_parties:
-            account_ids = [k for k, _ in init_party_values.items()]
-            accounts = dict((a.id, a) for a in Account.browse(account_ids))
+            lookup.accounts(list(init_party_values))
+            lookup.parties(missing_init_parties)
             for k, v in init_party_values.items():
-                account = accounts[k]
+                account = lookup.account(k)
                 for p, z in v.items():
                     if p not in missing_init_parties:
                         continue
-                    party = Party(p) if p else None
+                    party = lookup.party(p)
                     if not party:
                         continue
                     currentKey = (account, party)
@@ -570,15 +847,12 @@ class GeneralLedgerReport(DominateReport):
                     if balance == _ZERO:
                         continue
                     sequence += 1
-                    rline = {
-                        'sequence': sequence,
-                        'line': None,
-                        'ref': None,
-                        'credit': credit,
-                        'debit': debit,
-                        'balance': balance,
-                        'party': party
-                        }
+                    rline = LedgerRow(
+                        sequence=sequence,
+                        credit=credit,
+                        debit=debit,
+                        balance=balance,
+                        party=party.id)
                     key = _get_key(currentKey)
                     if records.get(key):
                         records[key]['lines'].append(rline)
@@ -604,8 +878,9 @@ class GeneralLedgerReport(DominateReport):
             init_values_account_wo_moves = {
                 k: init_values[k] for k in init_values
                 if k not in accounts_w_moves}
+            lookup.accounts(list(init_values_account_wo_moves))
             for account_id, values in init_values_account_wo_moves.items():
-                account = Account(account_id)
+                account = lookup.account(account_id)
                 balance = values.get('balance', _ZERO)
                 credit = values.get('credit', _ZERO)
                 debit = values.get('debit', _ZERO)
@@ -633,11 +908,10 @@ class GeneralLedgerReport(DominateReport):
             # with and without initla blaance or blaane need to be printed.
             # Control if there is a missing account move in the
             # init_party_values list.
-            account_ids = [k for k, _ in init_party_values.items()]
-            accounts = dict((a.id, a) for a in Account.browse(account_ids))
-
+            lookup.accounts(list(init_party_values))
+            lookup.parties({p for v in init_party_values.values() for p in v})
             for k, v in init_party_values.items():
-                account = accounts[k]
+                account = lookup.account(k)
                 for p, z in v.items():
                     # check if (account, party) is in current general ledger
                     if (k, p) in parties_general_ledger:
@@ -645,7 +919,7 @@ class GeneralLedgerReport(DominateReport):
                     balance = z.get('balance', _ZERO)
                     if balance == 0:
                         continue
-                    party = Party(p)
+                    party = lookup.party(p)
                     currentKey = (account, party)
                     sequence += 1
                     credit = z.get('credit', _ZERO)
@@ -667,23 +941,73 @@ class GeneralLedgerReport(DominateReport):
 
         return dict(sorted(records.items())), parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the lines to estimate the cost of the report'
+        pool = Pool()
+        Account = pool.get('account.account')
+        FiscalYear = pool.get('account.fiscalyear')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+
+        if data.get('accounts'):
+            where = ids_in(line.account, data['accounts'])
+        else:
+            where = (account.parent != Null)
+        if data.get('start_date'):
+            where &= (move.company == data['company'])
+            where &= (move.date >= data['start_date'])
+            where &= (move.date <= data['end_date'])
+        else:
+            fiscalyear = FiscalYear(data['fiscalyear'])
+            start_period = (Period(data['start_period'])
+                if data.get('start_period') else None)
+            end_period = (Period(data['end_period'])
+                if data.get('end_period') else None)
+            periods = fiscalyear.get_periods(start_period, end_period)
+            where &= ids_in(move.period, [p.id for p in periods])
+        if data.get('parties'):
+            where &= ids_in(line.party, data['parties'])
+        return line.join(move, condition=move.id == line.move
+            ).join(account, condition=account.id == line.account
+            ).select(line.id, where=where)
+
     @classmethod
     def timeout_exception(cls):
         raise TimeoutException
 
+    @classmethod
+    def sections(cls, data):
+        'Split the records by account group, the first digit of the code'
+        sections = {}
+        for key, record in data['records'].items():
+            sections.setdefault(key[0][:1], {})[key] = record
+        return list(sections.values())
+
     @classmethod
     def execute(cls, ids, data):
-        Config = Pool().get('account.configuration')
+        pool = Pool()
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, cls.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = cls.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -692,14 +1016,21 @@ class GeneralLedgerReport(DominateReport):
             context['timeout_report'] = (
                 timeout - int((end_prepare - start_prepare).total_seconds()))
 
+        report_data = {
+            'name': 'account_reports.general_ledger',
+            'model': 'account.account',
+            'records': records,
+            'parameters': parameters,
+            'output_format': data.get('output_format', 'pdf'),
+            }
         with Transaction().set_context(**context):
-            return super(GeneralLedgerReport, cls).execute(ids, {
-                'name': 'account_reports.general_ledger',
-                'model': 'account.account',
-                'records': records,
-                'parameters': parameters,
-                'output_format': data.get('output_format', 'pdf'),
-                })
+            result = cls.execute_sections(ids, report_data)
+            if result is None:
+                result = super(GeneralLedgerReport, cls).execute(ids,
+                    report_data)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def header(cls, action, data, records):
@@ -759,6 +1090,21 @@ class GeneralLedgerReport(DominateReport):
             cell['colspan'] = str(colspan)
         row.add(cell)
 
+    @classmethod
+    def _line_description(cls, line_info, show_description):
+        description = ''
+        if line_info['ref']:
+            description += line_info['ref']
+        if (line_info['ref'] and show_description
+                and (line_info['description']
+                    or line_info['move_description'])):
+            description += ' // '
+        if show_description and line_info['description']:
+            description += ' %s ' % line_info['description']
+        elif show_description and line_info['move_description']:
+            description += ' %s ' % line_info['move_description']
+        return description
+
     @classmethod
     def show_detail_lines(cls, record, show_description):
         rows = []
@@ -766,26 +1112,10 @@ class GeneralLedgerReport(DominateReport):
             for line_info in record['lines']:
                 row = tr()
                 if line_info['line']:
-                    line = line_info['line']
-                    number = ''
-                    if line.move and line.move.number:
-                        number = line.move.number
-                    else:
-                        number = (line.move and line.move.number or '')
-                        number += (line.party and line.party.name or '')
-                    description = ''
-                    if line_info['ref']:
-                        description += line_info['ref']
-                    if (line_info['ref'] and show_description
-                            and line and (line.description or line.move_description_used)):
-                        description += ' // '
-                    if show_description and line and line.description:
-                        description += ' %s ' % line.description
-                    elif show_description and line and line.move_description_used:
-                        description += ' %s ' % line.move_description_used
-
-                    cls._add_cell(row, html_render(line.date))
-                    cls._add_cell(row, number)
+                    description = cls._line_description(line_info,
+                        show_description)
+                    cls._add_cell(row, html_render(line_info['date']))
+                    cls._add_cell(row, line_info['number'])
                     cls._add_cell(row, description)
                     cls._add_cell(row, html_render(line_info['debit']),
                         style_value='text-align: right;',
@@ -903,20 +1233,32 @@ class GeneralLedgerReport(DominateReport):
 class GeneralLedgerXlsxReport(XlsxReport, metaclass=PoolMeta):
     __name__ = 'account_reports.general_ledger_xlsx'
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        # The incremental ledger stores its snapshot
+        cls.__rpc__['execute'] = RPC(False)
+
     @classmethod
     def get_content(cls, ids, data):
         pool = Pool()
+        Company = pool.get('company.company')
         Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, GeneralLedgerReport.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = GeneralLedgerReport.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -926,7 +1268,10 @@ class GeneralLedgerXlsxReport(XlsxReport, metaclass=PoolMeta):
                 timeout - int((end_prepare - start_prepare).total_seconds()))
 
         with Transaction().set_context(**context):
-            return cls._build_workbook(records, parameters)
+            content = cls._build_workbook(records, parameters)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
@@ -988,26 +1333,11 @@ class GeneralLedgerXlsxReport(XlsxReport, metaclass=PoolMeta):
             if record['lines']:
                 for line_info in record['lines']:
                     if line_info['line']:
-                        line = line_info['line']
-                        if line.move and line.move.number:
-                            number = line.move.number
-                        else:
-                            number = line.party and line.party.name or ''
-                        description = ''
-                        if line_info['ref']:
-                            description += line_info['ref']
-                        if (line_info['ref'] and show_description
-                                and line and (line.description
-                                    or line.move_description_used)):
-                            description += ' // '
-                        if show_description and line and line.description:
-                            description += ' %s ' % line.description
-                        elif (show_description and line
-                                and line.move_description_used):
-                            description += ' %s ' % line.move_description_used
+                        description = GeneralLedgerReport._line_description(
+                            line_info, show_description)
                         ws.append([
-                            html_render(line.date),
-                            number,
+                            html_render(line_info['date']),
+                            line_info['number'],
                             description,
                             xls(line_info['debit']),
                             xls(line_info['credit']),
@@ -2,14 +2,17 @@
 # at the top level of this repository contains the full copyright notices and
 # license terms.
 from datetime import datetime
+from decimal import Decimal
 
 from dominate.tags import div, header as header_tag, table, tbody, td, th, thead, tr
+from sql import Union, With
 
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.model import ModelView, fields
 from trytond.modules.account.exceptions import FiscalYearNotFoundError
-from trytond.modules.account_reports.common import TimeoutChecker, TimeoutException
+from trytond.modules.account_reports.common import (
+    TimeoutChecker, TimeoutException, date_ranges_where, merge_date_ranges)
 from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.html_report.engine import render as html_render
 from trytond.modules.html_report.i18n import _
@@ -66,6 +69,9 @@ class PrintInvoicePaymentDatesStart(ModelView):
             ('html', 'HTML'),
             ('xlsx', 'Excel'),
             ], 'Output Format', required=True)
+    analytics = fields.Boolean('Payment Analytics',
+        help='Print only a summary of the payment days and the late payments '
+        'by party and by payment term.')
     company = fields.Many2One('company.company', 'Company', required=True)
     timeout = fields.Integer('Timeout', required=True, help='If report '
         'calculation should take more than the specified timeout (in seconds) '
@@ -86,6 +92,10 @@ class PrintInvoicePaymentDatesStart(ModelView):
     def default_invoice_type():
         return 'out'
 
+    @staticmethod
+    def default_analytics():
+        return False
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
@@ -130,10 +140,23 @@ class PrintInvoicePaymentDates(Wizard):
             'periods': [x.id for x in self.start.periods],
             'output_format': self.start.output_format,
             'invoice_type': self.start.invoice_type,
+            'analytics': self.start.analytics,
             'timeout': self.start.timeout,
             }
+        self.check_estimate(data)
         return action, data
 
+    def check_estimate(self, data):
+        'Estimate the invoices of the report and warn if it may time out'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.invoice_payment_dates',
+            type='report')
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(Report.__name__, self.start.company,
+            data['estimated_rows'], self.start.timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -142,6 +165,7 @@ class InvoicePaymentDatesReport(DominateReport):
     __name__ = 'account_reports.invoice_payment_dates'
     page_orientation = 'landscape'
     side_margin = 0.3
+    _batch_size = 1000
 
     @classmethod
     def __setup__(cls):
@@ -234,9 +258,131 @@ table.invoice-payment-dates .col-payment-days {
         container = div()
         if data.get('output_format') != 'pdf':
             container.add(cls.header(action, data, records))
-        container.add(cls.show_detail(data['records'], data['parameters']))
+        if data['parameters'].get('analytics'):
+            analytics = data['parameters']['analytics']
+            container.add(cls.show_analytics(_('Party'),
+                    analytics['parties']))
+            container.add(cls.show_analytics(_('Payment Type'),
+                    analytics['payment_types']))
+        else:
+            container.add(cls.show_detail(data['records'],
+                    data['parameters']))
         return container
 
+    @classmethod
+    def show_analytics(cls, title, rows):
+        analytics_table = table(cls='border invoice-payment-dates')
+        with analytics_table:
+            with thead():
+                with tr():
+                    th(title, cls='col-party')
+                    th(_('Due Dates'), cls='col-amount right')
+                    th(_('Paid'), cls='col-amount right')
+                    th(_('Due Amount'), cls='col-due-amount right')
+                    th(_('Average Days'), cls='col-payment-days right')
+                    th(_('Weighted Days'), cls='col-payment-days right')
+                    th(_('Median Days'), cls='col-payment-days right')
+                    th(_('90% Days'), cls='col-payment-days right')
+                    th(_('Late Due Dates'), cls='col-payment-days right')
+            with tbody():
+                for row in rows:
+                    with tr():
+                        td(row['name'], cls='col-party')
+                        td(row['count'], cls='col-amount right')
+                        td(row['paid'], cls='col-amount right')
+                        td(html_render(row['due_amount'],
+                            digits=row['currency_digits']),
+                            cls='col-due-amount right')
+                        for key in ('average_days', 'weighted_days',
+                                'median_days', 'p90_days'):
+                            value = row[key]
+                            td(html_render(value, digits=1)
+                                if value is not None else '',
+                                cls='col-payment-days right')
+                        td('%s%%' % html_render(row['late_ratio'] * 100,
+                                digits=1)
+                            if row['late_ratio'] is not None else '',
+                            cls='col-payment-days right')
+        return analytics_table
+
+    @staticmethod
+    def _percentile(values, percent):
+        '''
+        Return the percentile of the sorted values using linear
+        interpolation between the closest ranks.
+        '''
+        if not values:
+            return None
+        position = (len(values) - 1) * percent / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return (Decimal(values[lower])
+            + (Decimal(values[upper]) - Decimal(values[lower]))
+            * (Decimal(str(position)) - lower))
+
+    @classmethod
+    def _get_payment_analytics(cls, records, digits=2, date=None):
+        '''
+        Return the payment behaviour of the records grouped by party and by
+        payment type.
+
+        For each group, it returns the number of due dates and paid ones, the
+        due amount, the average, amount weighted, median and 90th percentile
+        of payment days, and the ratio of late due dates. A due date is late
+        when it was paid after the due date or when it is still unpaid and
+        the due date is before date, the date of the report. The ratio is
+        computed over the paid due dates and the unpaid ones already due.
+
+        The invoices may be in different currencies, so the amounts are the
+        company amounts of the lines, with the digits of the company
+        currency.
+        '''
+        if date is None:
+            date = Pool().get('ir.date').today()
+
+        def summarize(key):
+            groups = {}
+            for record in records:
+                groups.setdefault(record[key] or '', []).append(record)
+            result = []
+            for name in sorted(groups):
+                group = groups[name]
+                paid = [r for r in group if r['payment_days'] != '']
+                days = sorted(r['payment_days'] for r in paid)
+                weight = sum((r['company_amount'] for r in paid), Decimal(0))
+                # The unpaid due dates not yet due can not be late
+                with_due_date = [r for r in group if r['due_date']
+                    and (r['payment_date'] or r['due_date'] < date)]
+                late = [r for r in with_due_date
+                    if (r['payment_date'] or date) > r['due_date']]
+                result.append({
+                        'name': name,
+                        'count': len(group),
+                        'paid': len(paid),
+                        'due_amount': sum(
+                            (r['company_amount'] for r in group), Decimal(0)),
+                        'currency_digits': digits,
+                        'average_days': (Decimal(sum(days)) / len(days)
+                            if days else None),
+                        'weighted_days': (sum(r['payment_days']
+                                * r['company_amount'] for r in paid) / weight
+                            if weight else None),
+                        'median_days': cls._percentile(days, 50),
+                        'p90_days': cls._percentile(days, 90),
+                        'late_ratio': (Decimal(len(late))
+                            / len(with_due_date) if with_due_date else None),
+                        })
+            return result
+
+        return {
+            'parties': summarize('party'),
+            'payment_types': summarize('payment_type'),
+            }
+
+    @staticmethod
+    def _format_date(value):
+        return value.strftime('%d/%m/%Y') if value else ''
+
     @classmethod
     def show_detail(cls, records, parameters):
         detail_table = table(cls='border invoice-payment-dates')
@@ -268,7 +414,7 @@ table.invoice-payment-dates .col-payment-days {
                             td(record['number'], cls='col-number no-wrap')
                             td(record['reference'],
                                 cls='col-reference no-wrap')
-                            td(record['invoice_date'],
+                            td(cls._format_date(record['invoice_date']),
                                 cls='col-invoice-date no-wrap')
                             td(record['party'], cls='col-party')
                             td(record['state'], cls='col-state')
@@ -285,12 +431,12 @@ table.invoice-payment-dates .col-payment-days {
                             td(html_render(record['total_amount'],
                                 digits=record['currency_digits']),
                                 cls='col-amount right')
-                            td(record['due_date'],
+                            td(cls._format_date(record['due_date']),
                                 cls='col-due-date no-wrap')
                             td(html_render(record['due_amount'],
                                 digits=record['currency_digits']),
                                 cls='col-due-amount right')
-                            td(record['payment_date'],
+                            td(cls._format_date(record['payment_date']),
                                 cls='col-payment-date no-wrap')
                             td(record['payment_days'],
                                 cls='col-payment-days right')
@@ -300,18 +446,14 @@ table.invoice-payment-dates .col-payment-days {
         return detail_table
 
     @classmethod
-    def prepare(cls, data, checker):
+    def _get_dates(cls, data):
+        '''
+        Return the periods, the start and end dates and the merged date ranges
+        of the periods of data.
+        '''
         pool = Pool()
-        Company = pool.get('company.company')
         FiscalYear = pool.get('account.fiscalyear')
         Period = pool.get('account.period')
-        MoveLine = pool.get('account.move.line')
-        AdditionalMove = pool.get('account.invoice-additional-account.move')
-        Invoice = pool.get('account.invoice')
-        Party = pool.get('party.party')
-        PaymentTerm = pool.get('account.invoice.payment_term')
-        Currency = pool.get('currency.currency')
-        Reconciliation = pool.get('account.move.reconciliation')
 
         fiscalyear = (FiscalYear(data['fiscalyear']) if data.get('fiscalyear')
             else None)
@@ -323,6 +465,60 @@ table.invoice-payment-dates .col-payment-days {
         elif not start_date and not end_date and fiscalyear:
             periods = Period.search([('fiscalyear', '=', fiscalyear.id)])
 
+        date_ranges = []
+        if periods and not start_date and not end_date:
+            # The selected periods may not be contiguous
+            date_ranges = merge_date_ranges(periods)
+            start_date = date_ranges[0][0]
+            end_date = date_ranges[-1][1]
+        return periods, start_date, end_date, date_ranges
+
+    @staticmethod
+    def _get_invoice_where(invoice, data, start_date, end_date, date_ranges):
+        'Return the condition of the invoices of the report'
+        if date_ranges:
+            date_condition = date_ranges_where(invoice.invoice_date,
+                date_ranges)
+        else:
+            date_condition = None
+            if start_date:
+                date_condition = (invoice.invoice_date >= start_date)
+            if end_date:
+                end_condition = (invoice.invoice_date <= end_date)
+                date_condition = (end_condition if date_condition is None
+                    else (date_condition & end_condition))
+
+        where = ((invoice.company == data['company'])
+            & (invoice.type == data['invoice_type'])
+            & invoice.state.in_(('posted', 'paid')))
+        if date_condition is not None:
+            where &= date_condition
+        return where
+
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the invoices to estimate the cost of the report'
+        Invoice = Pool().get('account.invoice')
+        invoice = Invoice.__table__()
+        _, start_date, end_date, date_ranges = cls._get_dates(data)
+        return invoice.select(invoice.id,
+            where=cls._get_invoice_where(invoice, data, start_date, end_date,
+                date_ranges))
+
+    @classmethod
+    def prepare(cls, data, checker):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Date = pool.get('ir.date')
+        MoveLine = pool.get('account.move.line')
+        AdditionalMove = pool.get('account.invoice-additional-account.move')
+        Invoice = pool.get('account.invoice')
+        Party = pool.get('party.party')
+        PaymentTerm = pool.get('account.invoice.payment_term')
+        Currency = pool.get('currency.currency')
+        Reconciliation = pool.get('account.move.reconciliation')
+
+        periods, start_date, end_date, date_ranges = cls._get_dates(data)
         if periods:
             periods_subtitle = []
             for x in periods:
@@ -337,15 +533,6 @@ table.invoice-payment-dates .col-payment-days {
             'in': 'Supplier Invoices',
             }.get(data['invoice_type'], '')
 
-        if periods and not start_date and not end_date:
-            if len(periods) == 1:
-                period = periods[0]
-                start_date = period.start_date
-                end_date = period.end_date
-            else:
-                start_date = min(p.start_date for p in periods)
-                end_date = max(p.end_date for p in periods)
-
         parameters = {
             'company': company.rec_name if company else '',
             'invoice_type': invoice_type,
@@ -363,72 +550,23 @@ table.invoice-payment-dates .col-payment-days {
         currency = Currency.__table__()
         reconciliation = Reconciliation.__table__()
 
-        if periods and not start_date and not end_date:
-            if len(periods) == 1:
-                period = periods[0]
-                date_condition = ((invoice.invoice_date >= period.start_date)
-                    & (invoice.invoice_date <= period.end_date))
-            else:
-                date_condition = None
-                for period in periods:
-                    period_condition = ((invoice.invoice_date >= period.start_date)
-                        & (invoice.invoice_date <= period.end_date))
-                    date_condition = (period_condition if date_condition is None
-                        else (date_condition | period_condition))
-        else:
-            date_condition = None
-            if start_date:
-                date_condition = (invoice.invoice_date >= start_date)
-            if end_date:
-                end_condition = (invoice.invoice_date <= end_date)
-                date_condition = (end_condition if date_condition is None
-                    else (date_condition & end_condition))
-
-        base_where = ((invoice.company == company.id)
-            & (invoice.type == data['invoice_type'])
-            & invoice.state.in_(('posted', 'paid')))
-        if date_condition is not None:
-            base_where &= date_condition
-
-        def build_query(invoice_join):
-            query = (invoice
-                .join(invoice_join, condition=((invoice.move == line.move)
-                    & (invoice.account == line.account)))
-                .join(payment_term, type_='LEFT',
-                    condition=(payment_term.id == invoice.payment_term))
-                .join(party, type_='LEFT', condition=(party.id == invoice.party))
-                .join(currency, condition=(currency.id == invoice.currency))
-                .join(reconciliation, type_='LEFT',
-                    condition=(reconciliation.id == line.reconciliation))
-                .select(
-                    invoice.id.as_('invoice'),
-                    line.id.as_('line'),
-                    line.maturity_date.as_('maturity_date'),
-                    line.debit.as_('debit'),
-                    line.credit.as_('credit'),
-                    line.second_currency.as_('second_currency'),
-                    line.amount_second_currency.as_('amount_second_currency'),
-                    reconciliation.date.as_('payment_date'),
-                    invoice.number.as_('number'),
-                    invoice.reference.as_('reference'),
-                    invoice.invoice_date.as_('invoice_date'),
-                    invoice.state.as_('state'),
-                    invoice.currency.as_('invoice_currency'),
-                    invoice.untaxed_amount_cache.as_('untaxed_amount'),
-                    invoice.tax_amount_cache.as_('tax_amount'),
-                    invoice.total_amount_cache.as_('total_amount'),
-                    invoice.description.as_('description'),
-                    party.name.as_('party'),
-                    payment_term.name.as_('payment_type'),
-                    currency.digits.as_('currency_digits'),
-                    where=base_where))
-            return query
-
-        query = build_query(line)
-        query |= (invoice
-            .join(additional_move, condition=additional_move.invoice == invoice.id)
-            .join(line, condition=((additional_move.move == line.move)
-                & (invoice.account == line.account)))
+        base_where = cls._get_invoice_where(invoice, data, start_date,
+            end_date, date_ranges)
+
+        # Candidate (invoice, move, account) triples: the invoice move and
+        # the additional moves. Only ids are united so the descriptive
+        # columns are joined once.
+        candidates = With('invoice', 'move', 'account', query=Union(
+                invoice.select(invoice.id, invoice.move, invoice.account,
+                    where=base_where),
+                invoice.join(additional_move,
+                    condition=additional_move.invoice == invoice.id
+                    ).select(invoice.id, additional_move.move,
+                        invoice.account, where=base_where)))
+        query = (candidates
+            .join(invoice, condition=invoice.id == candidates.invoice)
+            .join(line, condition=((line.move == candidates.move)
+                & (line.account == candidates.account)))
             .join(payment_term, type_='LEFT',
                 condition=(payment_term.id == invoice.payment_term))
             .join(party, type_='LEFT', condition=(party.id == invoice.party))
@@ -436,97 +574,100 @@ table.invoice-payment-dates .col-payment-days {
             .join(reconciliation, type_='LEFT',
                 condition=(reconciliation.id == line.reconciliation))
             .select(
-                invoice.id.as_('invoice'),
-                line.id.as_('line'),
-                line.maturity_date.as_('maturity_date'),
-                line.debit.as_('debit'),
-                line.credit.as_('credit'),
-                line.second_currency.as_('second_currency'),
-                line.amount_second_currency.as_('amount_second_currency'),
-                reconciliation.date.as_('payment_date'),
-                invoice.number.as_('number'),
-                invoice.reference.as_('reference'),
-                invoice.invoice_date.as_('invoice_date'),
-                invoice.state.as_('state'),
-                invoice.currency.as_('invoice_currency'),
-                invoice.untaxed_amount_cache.as_('untaxed_amount'),
-                invoice.tax_amount_cache.as_('tax_amount'),
-                invoice.total_amount_cache.as_('total_amount'),
-                invoice.description.as_('description'),
-                party.name.as_('party'),
-                payment_term.name.as_('payment_type'),
-                currency.digits.as_('currency_digits'),
-                where=base_where))
+                line.maturity_date,
+                line.debit,
+                line.credit,
+                line.second_currency,
+                line.amount_second_currency,
+                reconciliation.date,
+                invoice.number,
+                invoice.reference,
+                invoice.invoice_date,
+                invoice.state,
+                invoice.currency,
+                invoice.untaxed_amount_cache,
+                invoice.tax_amount_cache,
+                invoice.total_amount_cache,
+                invoice.description,
+                party.name,
+                payment_term.name,
+                currency.digits,
+                with_=[candidates],
+                order_by=(
+                    invoice.invoice_date, invoice.number, invoice.id,
+                    line.maturity_date.nulls_last, line.id)))
 
         records = []
         cursor = Transaction().connection.cursor()
-        cursor.execute(*query.select(
-                query.invoice, query.line, query.maturity_date,
-                query.debit, query.credit, query.second_currency,
-                query.amount_second_currency, query.payment_date,
-                query.number, query.reference, query.invoice_date,
-                query.state, query.invoice_currency, query.untaxed_amount,
-                query.tax_amount, query.total_amount, query.description,
-                query.party, query.payment_type, query.currency_digits,
-                order_by=(
-                    query.invoice_date, query.number, query.invoice,
-                    query.maturity_date.nulls_last, query.line)))
-        for (
-                _invoice_id, _line_id, maturity_date, debit, credit,
-                second_currency, amount_second_currency, payment_date,
-                number, reference, invoice_date, state, invoice_currency,
-                untaxed_amount, tax_amount, total_amount, description,
-                party_name, payment_type, currency_digits) in cursor:
-            amount = debit - credit
-            if (second_currency
-                    and second_currency == invoice_currency
-                    and amount_second_currency is not None):
-                amount = amount_second_currency
-            payment_days = ''
-            if payment_date and invoice_date:
-                payment_days = (payment_date - invoice_date).days
-            records.append({
-                    'number': number or '',
-                    'reference': reference or '',
-                    'invoice_date': (invoice_date
-                        and invoice_date.strftime('%d/%m/%Y')
-                        or ''),
-                    'party': party_name or '',
-                    'state': state or '',
-                    'payment_type': payment_type or '',
-                    'untaxed_amount': untaxed_amount,
-                    'tax_amount': tax_amount,
-                    'total_amount': total_amount,
-                    'description': description or '',
-                    'due_date': (maturity_date
-                        and maturity_date.strftime('%d/%m/%Y')
-                        or ''),
-                    'due_amount': abs(amount),
-                    'payment_date': (payment_date
-                        and payment_date.strftime('%d/%m/%Y')
-                        or ''),
-                    'payment_days': payment_days,
-                    'currency_digits': currency_digits,
-                    })
+        cursor.execute(*query)
+        # The dates are kept as date objects and formatted when rendered
+        while True:
+            rows = cursor.fetchmany(cls._batch_size)
+            if not rows:
+                break
+            for (maturity_date, debit, credit, second_currency,
+                    amount_second_currency, payment_date, number, reference,
+                    invoice_date, state, invoice_currency, untaxed_amount,
+                    tax_amount, total_amount, description, party_name,
+                    payment_type, currency_digits) in rows:
+                amount = debit - credit
+                if (second_currency
+                        and second_currency == invoice_currency
+                        and amount_second_currency is not None):
+                    amount = amount_second_currency
+                payment_days = ''
+                if payment_date and invoice_date:
+                    payment_days = (payment_date - invoice_date).days
+                records.append({
+                        'number': number or '',
+                        'reference': reference or '',
+                        'invoice_date': invoice_date,
+                        'party': party_name or '',
+                        'state': state or '',
+                        'payment_type': payment_type or '',
+                        'untaxed_amount': untaxed_amount,
+                        'tax_amount': tax_amount,
+                        'total_amount': total_amount,
+                        'description': description or '',
+                        'due_date': maturity_date,
+                        'due_amount': abs(amount),
+                        'company_amount': abs(debit - credit),
+                        'payment_date': payment_date,
+                        'payment_days': payment_days,
+                        'currency_digits': currency_digits,
+                        })
+            checker.check()
 
         parameters['records_found'] = bool(records)
+        if data.get('analytics'):
+            # Only the summary is rendered
+            parameters['analytics'] = cls._get_payment_analytics(records,
+                company.currency.digits, Date.today())
+            records = []
         if not records:
             records = [{}]
         return records, parameters
 
     @classmethod
     def execute(cls, ids, data):
-        Config = Pool().get('account.configuration')
+        pool = Pool()
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, cls.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = cls.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -537,10 +678,13 @@ table.invoice-payment-dates .col-payment-days {
                 timeout - int((end_prepare - start_prepare).total_seconds()))
 
         with Transaction().set_context(**context):
-            return super(InvoicePaymentDatesReport, cls).execute(ids, {
+            result = super(InvoicePaymentDatesReport, cls).execute(ids, {
                     'name': 'account_reports.invoice_payment_dates',
                     'model': 'account.invoice',
                     'records': records,
                     'parameters': parameters,
                     'output_format': data.get('output_format', 'pdf'),
                     })
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return result
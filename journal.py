@@ -12,13 +12,19 @@ from trytond.modules.account_reports.xlsx import (
     XlsxReport, save_workbook, convert_str_to_float)
 from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.html_report.i18n import _
+import datetime
 from datetime import timedelta
-from sql import Null
+from sql import Literal, Null
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Extract
 from trytond.modules.account.exceptions import FiscalYearNotFoundError
 from openpyxl import Workbook
 from dominate.tags import div, h1, p, table, thead, tbody, tr, td, th
 
-from .common import css as common_css
+from .common import (
+    CentsTotals, JournalRow, MinorUnits, TimeoutChecker, TimeoutException,
+    css as common_css, ids_in)
 
 ZERO = Decimal('0.00')
 
@@ -71,7 +77,12 @@ class PrintJournalStart(ModelView):
             ('html', 'HTML'),
             ('xlsx', 'Excel'),
             ], 'Output Format', required=True)
+    totals_only = fields.Boolean('Totals Only',
+        help='Print only the totals of each month without the move lines.')
     company = fields.Many2One('company.company', 'Company', required=True)
+    timeout = fields.Integer('Timeout (s)', required=True, help='If report '
+        'calculation should take more than the specified timeout (in seconds) '
+        'the process will be stopped automatically.')
 
     @staticmethod
     def default_fiscalyear():
@@ -92,6 +103,16 @@ class PrintJournalStart(ModelView):
     def default_output_format():
         return 'pdf'
 
+    @staticmethod
+    def default_totals_only():
+        return False
+
+    @staticmethod
+    def default_timeout():
+        Config = Pool().get('account.configuration')
+        config = Config(1)
+        return config.default_timeout or 30
+
     @fields.depends('fiscalyear')
     def on_change_fiscalyear(self):
         self.start_period = None
@@ -125,7 +146,10 @@ class PrintJournal(Wizard):
             'end_period': end_period,
             'journals': [x.id for x in self.start.journals],
             'output_format': self.start.output_format,
+            'totals_only': self.start.totals_only,
+            'timeout': self.start.timeout,
             }
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             action_report, = ActionReport.search([
@@ -134,6 +158,20 @@ class PrintJournal(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        'Estimate the lines of the report and warn if it may time out'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.journal', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.journal_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            self.start.timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -141,6 +179,7 @@ class PrintJournal(Wizard):
 class JournalReport(DominateReport):
     __name__ = 'account_reports.journal'
     page_orientation = 'landscape'
+    _lines_batch_size = 1000
 
     @classmethod
     def css(cls, action, data, records):
@@ -172,10 +211,70 @@ class JournalReport(DominateReport):
         )
 
     @classmethod
-    def _get_open_close_moves(cls, _type, description, fiscalyear, accounts,
-            init_values, init_party_values, line):
+    def _get_open_close_balances(cls, company, date):
+        '''
+        Return the non-zero balances at date grouped by account and party as
+        a list of dictionaries with the account and party names.
+
+        Only the pairs with balance are returned by a single aggregate query
+        so the parties and accounts without moves are never read.
+        '''
         pool = Pool()
+        Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
         Party = pool.get('party.party')
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+
+        balance = Sum(Coalesce(line.debit, 0)) - Sum(Coalesce(line.credit, 0))
+        group_by = (account.id, account.code, account.name,
+            account_type.receivable, account_type.payable,
+            party.id, party.name, party.code)
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).join(account, condition=account.id == line.account
+                ).join(account_type, condition=account_type.id == account.type
+                ).join(party, 'LEFT', condition=party.id == line.party
+                ).select(*(group_by + (balance,)),
+                    where=(move.date <= date)
+                    & (move.company == company.id)
+                    & (account.parent != Null),
+                    group_by=group_by,
+                    having=balance != 0,
+                    order_by=(account.code.asc, account.id.asc,
+                        Case((party.id == Null, 0), else_=1).asc,
+                        party.name.asc, party.id.asc)))
+
+        units = MinorUnits(company.currency.digits)
+        balances = []
+        for (_, account_code, account_name, receivable, payable, party_id,
+                party_name, party_code, balance_) in cursor:
+            account_kind = 'other'
+            if receivable:
+                account_kind = 'receivable'
+            elif payable:
+                account_kind = 'payable'
+            if account_code:
+                account_name = '%s - %s' % (account_code, account_name)
+            if party_id and not party_name:
+                party_name = '[%s]' % party_code
+            balances.append({
+                    'account_name': account_name,
+                    'account_kind': account_kind,
+                    'party_name': party_name or '',
+                    'balance': units.amount(balance_),
+                    })
+        return balances
+
+    @classmethod
+    def _get_open_close_moves(cls, _type, description, fiscalyear, balances,
+            line):
+        pool = Pool()
         Line = pool.get('account.move.line')
         Sequence = pool.get('ir.sequence.strict')
 
@@ -208,70 +307,174 @@ class JournalReport(DominateReport):
             sequence_sufix,
         )
 
+        if _type == 'open':
+            date = fiscalyear.start_date
+        else:
+            date = fiscalyear.end_date
         moves = []
-        for account in accounts:
-            account_type = 'other'
-            if account.type.receivable:
-                account_type = 'receivable'
-            elif account.type.payable:
-                account_type = 'payable'
-
-            main_value = {}
+        for values in balances:
+            balance = values['balance']
+            value = JournalRow(
+                date=date.strftime("%Y-%m-%d"),
+                month=date.month,
+                move_number=move_number,
+                move_line_description=description,
+                account_name=values['account_name'],
+                account_kind=values['account_kind'],
+                party_name=values['party_name'])
             if _type == 'open':
-                main_value['date'] = fiscalyear.start_date.strftime("%Y-%m-%d")
-                main_value['month'] = fiscalyear.start_date.month
-                main_value['move_number'] = move_number
-                main_value['move_line_description'] = description
+                value['debit'] = balance if balance >= 0 else 0
+                value['credit'] = -balance if balance < 0 else 0
             else:
-                main_value['date'] = fiscalyear.end_date.strftime("%Y-%m-%d")
-                main_value['month'] = fiscalyear.end_date.month
-                main_value['move_number'] = move_number
-                main_value['move_line_description'] = description
-            main_value['account_name'] = account.rec_name
-            main_value['account_kind'] = account_type
-
-            value = {}
-            value.update(main_value)
-            value['party_name'] = ''
-            account_values = init_values.get(account.id, None)
-            if account_values:
-                balance = account_values.get('balance', 0)
-                if balance:
-                    if _type == 'open':
-                        value['debit'] = balance if balance >= 0 else 0
-                        value['credit'] = -balance if balance < 0 else 0
-                    else:
-                        value['debit'] = -balance if balance < 0 else 0
-                        value['credit'] = balance if balance >= 0 else 0
-                    moves.append(value)
-
-            parties = init_party_values.get(account.id, None)
-            if parties:
-                for party_id, values in parties.items():
-                    balance = values.get('balance', 0)
-                    if balance:
-                        value = {}
-                        value.update(main_value)
-                        if _type == 'open':
-                            value['debit'] = balance if balance >= 0 else 0
-                            value['credit'] = -balance if balance < 0 else 0
-                        else:
-                            value['debit'] = -balance if balance < 0 else 0
-                            value['credit'] = balance if balance >= 0 else 0
-                        value['party_name'] = Party(party_id).rec_name
-                        moves.append(value)
+                value['debit'] = -balance if balance < 0 else 0
+                value['credit'] = balance if balance >= 0 else 0
+            moves.append(value)
         return moves
 
     @classmethod
-    def prepare(cls, data):
+    def _get_lines_query(cls, journals, periods, reverse=False):
+        '''
+        Return the query of the lines of the journal ordered as they are
+        printed, or in the opposite order if reverse is set.
+        '''
         pool = Pool()
-        Company = pool.get('company.company')
-        FiscalYear = pool.get('account.fiscalyear')
         Account = pool.get('account.account')
+        AccountType = pool.get('account.account.type')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
         Party = pool.get('party.party')
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        account_type = AccountType.__table__()
+        party = Party.__table__()
+
+        where = cls._get_lines_where(move, journals, periods)
+        order_by = [move.date, move.number, line.id]
+        if reverse:
+            order_by = [c.desc for c in order_by]
+        else:
+            order_by = [c.asc for c in order_by]
+        return line.join(move, condition=move.id == line.move
+            ).join(account, condition=account.id == line.account
+            ).join(account_type, 'LEFT',
+                condition=account_type.id == account.type
+            ).join(party, 'LEFT', condition=party.id == line.party
+            ).select(
+                line.id, move.date, move.id, move.number,
+                account.code, account.name,
+                account_type.receivable, account_type.payable,
+                line.description, line.debit, line.credit, party.name,
+                where=where,
+                order_by=order_by)
+
+    @classmethod
+    def _get_lines_where(cls, move, journals, periods):
+        where = Literal(True)
+        if journals:
+            where &= ids_in(move.journal, [x.id for x in journals])
+        if periods:
+            where &= ids_in(move.period, [x.id for x in periods])
+        return where
+
+    @classmethod
+    def _get_month_totals(cls, journals, periods, digits=2):
+        '''
+        Return the debit and credit of the lines of the journal for each month
+        as a list of dictionaries in date order.
+        '''
+        units = MinorUnits(digits)
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        line = Line.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        year = Extract('YEAR', move.date)
+        month = Extract('MONTH', move.date)
+        cursor.execute(*line.join(move, condition=move.id == line.move
+                ).select(year, month,
+                    Sum(Coalesce(line.debit, 0)), Sum(Coalesce(line.credit, 0)),
+                    where=cls._get_lines_where(move, journals, periods),
+                    group_by=(year, month),
+                    order_by=(year.asc, month.asc)))
+        totals = []
+        for year_, month_, debit, credit in cursor:
+            totals.append({
+                    'year': int(year_),
+                    'month': int(month_),
+                    'debit': units.amount(debit),
+                    'credit': units.amount(credit),
+                    })
+        return totals
+
+    @classmethod
+    def _add_month_total(cls, month_totals, date, moves, first=False,
+            digits=2):
+        '''
+        Add the amounts of the open or close moves to the total of the month
+        of date.
+        '''
+        if not moves:
+            return
+        key = (date.year, date.month)
+        totals = [t for t in month_totals if (t['year'], t['month']) == key]
+        if totals:
+            total, = totals
+        else:
+            total = {
+                'year': date.year,
+                'month': date.month,
+                'debit': ZERO,
+                'credit': ZERO,
+                }
+            if first:
+                month_totals.insert(0, total)
+            else:
+                month_totals.append(total)
+        sums = CentsTotals(['debit', 'credit'], digits)
+        for name in ('debit', 'credit'):
+            sums.add(name, total[name])
+            for move in moves:
+                sums.add(name, move[name])
+        total.update(sums.to_dict())
+
+    @classmethod
+    def _get_line_record(cls, row, units):
+        (_, date, move_id, move_number, account_code, account_name,
+            receivable, payable, description, debit, credit,
+            party_name) = row
+        account_type = 'other'
+        if receivable:
+            account_type = 'receivable'
+        elif payable:
+            account_type = 'payable'
+        if account_code:
+            account_name = '%s - %s' % (account_code, account_name)
+        # SQLite may return float or string for some columns
+        debit = units.amount(debit)
+        credit = units.amount(credit)
+        if isinstance(date, str):
+            date = datetime.date.fromisoformat(date)
+        return JournalRow(
+            date=date,
+            month=date.month,
+            account_name=account_name,
+            move_number=move_number or '(#%s)' % move_id,
+            move_line_description=description,
+            debit=debit,
+            credit=credit,
+            party_name=party_name or '',
+            account_kind=account_type)
+
+    @classmethod
+    def prepare(cls, data, checker=None):
+        pool = Pool()
+        Company = pool.get('company.company')
+        FiscalYear = pool.get('account.fiscalyear')
         Journal = pool.get('account.journal')
         Period = pool.get('account.period')
-        Line = pool.get('account.move.line')
 
         parameters = {}
         fiscalyear = FiscalYear(data['fiscalyear'])
@@ -302,37 +505,44 @@ class JournalReport(DominateReport):
         else:
             parameters['journals'] = ''
 
-        if journals:
-            journal_ids = ','.join([str(x.id) for x in journals])
-            journals_domain = 'am.journal IN (%s) AND' % journal_ids
-        else:
-            journals_domain = ''
-
         periods = fiscalyear.get_periods(start_period, end_period)
-        if periods:
-            period_ids = ','.join([str(x.id) for x in periods])
-            periods_domain = 'am.period IN (%s) AND' % period_ids
-        else:
-            periods_domain = ''
 
         cursor = Transaction().connection.cursor()
-        cursor.execute("""
-            SELECT
-                aml.id
-            FROM
-                account_move am,
-                account_move_line aml
-            WHERE
-                %s
-                %s
-                am.id=aml.move
-            ORDER BY
-                am.date, am.number, aml.id
-        """ % (
-                journals_domain,
-                periods_domain,
-                ))
-        ids = [x[0] for x in cursor.fetchall()]
+        digits = fiscalyear.company.currency.digits
+        units = MinorUnits(digits)
+        lines = []
+        first_line = last_line = None
+        if data.get('totals_only'):
+            # Only the first and last lines are needed to number the
+            # open/close moves
+            for reverse in (False, True):
+                query = cls._get_lines_query(journals, periods,
+                    reverse=reverse)
+                query.limit = 1
+                cursor.execute(*query)
+                row = cursor.fetchone()
+                if row and reverse:
+                    last_line = row[0]
+                elif row:
+                    first_line = row[0]
+        else:
+            cursor.execute(*cls._get_lines_query(journals, periods))
+            # The lines are fetched in batches so no ORM instance is created
+            # for them, but all their compact rows are kept until the report
+            # is rendered. Only the first and last line ids are kept to
+            # number the open/close moves.
+            while True:
+                rows = cursor.fetchmany(cls._lines_batch_size)
+                if not rows:
+                    break
+                if first_line is None:
+                    first_line = rows[0][0]
+                last_line = rows[-1][0]
+                for row in rows:
+                    lines.append(cls._get_line_record(row, units))
+                if checker:
+                    checker.check()
+        month_totals = cls._get_month_totals(journals, periods, digits)
 
         open_moves = []
         close_moves = []
@@ -350,17 +560,6 @@ class JournalReport(DominateReport):
             fiscalyear_before = (fiscalyear_before and fiscalyear_before[0] or
                 None)
 
-            with Transaction().set_context(active_test=False):
-                accounts = Account.search([
-                        ('company', '=', company),
-                        ('parent', '!=', None),
-                        ('type', '!=', Null),
-                        ('active', 'in', [True, False]),
-                        ])
-                parties = Party.search([
-                        ('active', 'in', [True, False]),
-                        ])
-
             if fiscalyear_before and fiscalyear_before.state == 'closed':
                 # check if the first month is the same of the start month on
                 #    fiscal year before
@@ -369,69 +568,97 @@ class JournalReport(DominateReport):
                         fiscalyear_before.start_date.month):
                     initial_balance_date = (
                         start_period.start_date - timedelta(days=1))
-                    with Transaction().set_context(date=initial_balance_date):
-                        init_values = Account.html_read_account_vals(accounts,
-                            fiscalyear_before.company, with_moves=True,
-                            exclude_party_moves=True)
-                        init_party_values = (
-                            Party.html_get_account_values_by_party(
-                                parties, accounts, fiscalyear.company))
-
+                    balances = cls._get_open_close_balances(
+                        fiscalyear_before.company, initial_balance_date)
                     open_moves.extend(cls._get_open_close_moves('open',
                         data.get('open_move_description'), fiscalyear,
-                        accounts, init_values, init_party_values, ids[0]))
+                        balances, first_line))
 
             if fiscalyear.state =='closed':
                 # check if the last month is the same of the end month on
                 #    fiscal year
                 if (end_period.end_date and end_period.end_date.month ==
                         fiscalyear.end_date.month):
-                    with Transaction().set_context(date=end_period.end_date):
-                        init_values = Account.html_read_account_vals(accounts,
-                            fiscalyear.company, with_moves=True,
-                            exclude_party_moves=True)
-                        init_party_values = (
-                            Party.html_get_account_values_by_party(
-                                parties, accounts, fiscalyear.company))
-
+                    balances = cls._get_open_close_balances(
+                        fiscalyear.company, end_period.end_date)
                     close_moves.extend(cls._get_open_close_moves('close',
                             data.get('close_move_description'), fiscalyear,
-                            accounts, init_values, init_party_values, ids[-1]))
+                            balances, last_line))
+
+        cls._add_month_total(month_totals, fiscalyear.start_date, open_moves,
+            first=True, digits=digits)
+        cls._add_month_total(month_totals, fiscalyear.end_date, close_moves,
+            digits=digits)
+        parameters['month_totals'] = month_totals
+        totals = CentsTotals(['total_debit', 'total_credit'], digits)
+        for total in month_totals:
+            totals.add('total_debit', total['debit'])
+            totals.add('total_credit', total['credit'])
+        parameters.update(totals.to_dict())
+        parameters['totals_only'] = bool(data.get('totals_only'))
 
         records = []
-        records.extend(open_moves)
-        for line in Line.browse(ids):
-            account_type = 'other'
-            if line.account.type.receivable:
-                account_type = 'receivable'
-            elif line.account.type.payable:
-                account_type = 'payable'
-
-            records.append({
-                    'date': line.date,
-                    'month': line.date.month,
-                    'account_name': line.account.rec_name,
-                    'move_number': line.move.number or '(#%s)' % line.move.id,
-                    'move_line_description': line.description,
-                    'debit': line.debit,
-                    'credit': line.credit,
-                    'party_name': line.party and line.party.name or '',
-                    'account_kind': account_type,
-                    })
-        records.extend(close_moves)
+        if not data.get('totals_only'):
+            records.extend(open_moves)
+            records.extend(lines)
+            records.extend(close_moves)
         return records, parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the lines to estimate the cost of the report'
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Journal = pool.get('account.journal')
+        Period = pool.get('account.period')
+        fiscalyear = FiscalYear(data['fiscalyear'])
+        start_period = (Period(data['start_period'])
+            if data.get('start_period') else None)
+        end_period = (Period(data['end_period'])
+            if data.get('end_period') else None)
+        if data.get('open_close_account_moves'):
+            journals = []
+        else:
+            journals = Journal.browse(data.get('journals', []))
+        return cls._get_lines_query(journals,
+            fiscalyear.get_periods(start_period, end_period))
+
+    @classmethod
+    def timeout_exception(cls):
+        raise TimeoutException
+
     @classmethod
     def execute(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
+
+        config = Config(1)
+        timeout = data.get('timeout') or config.default_timeout or 300
+        checker = TimeoutChecker(timeout, cls.timeout_exception)
+        company = Company(data['company'])
+
+        start_prepare = datetime.datetime.now()
         with Transaction().set_context(active_test=False):
-            records, parameters = cls.prepare(data)
-        return super().execute(ids, {
+            try:
+                records, parameters = cls.prepare(data, checker)
+            except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
+                raise UserError(gettext(
+                        'account_reports.msg_timeout_exception'))
+        result = super().execute(ids, {
             'name': 'account_reports.journal',
             'model': 'account.move.line',
             'records': records,
             'parameters': parameters,
             'output_format': data.get('output_format', 'pdf'),
             })
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def title(cls, action, data, records):
@@ -461,20 +688,23 @@ class JournalReport(DominateReport):
                         th(_('Description')), th(_('Debit'), style='text-align: right'),
                         th(_('Credit'), style='text-align: right'))
                 with tbody():
+                    month_totals = iter(parameters.get('month_totals', []))
+
+                    def month_total_row(total):
+                        if total is None:
+                            return
+                        tr(td("", colspan="3"),
+                            td(_('Total month %s') % total['month']),
+                            td("{:.2f}".format(total['debit']), style='text-align: right'),
+                            td("{:.2f}".format(total['credit']), style='text-align: right'),
+                            cls="month-total")
+
                     current_month = None
-                    month_debit = ZERO
-                    month_credit = ZERO
                     for i, record in enumerate(records):
                         if record['month'] != current_month:
                             if current_month is not None:
-                                tr(td("", colspan="3"),
-                                    td(_('Total month %s') % current_month),
-                                    td("{:.2f}".format(month_debit), style='text-align: right'),
-                                    td("{:.2f}".format(month_credit), style='text-align: right'),
-                                    cls="month-total")
+                                month_total_row(next(month_totals, None))
                             current_month = record['month']
-                            month_debit = ZERO
-                            month_credit = ZERO
                         account_party = record['account_name']
                         if record['party_name']:
                             account_party += " / " + record['party_name']
@@ -484,25 +714,18 @@ class JournalReport(DominateReport):
                             td(record.get('move_line_description') or ''),
                             td("{:.2f}".format(record['debit']), style='text-align: right'),
                             td("{:.2f}".format(record['credit']), style='text-align: right'))
-                        month_debit += record['debit']
-                        month_credit += record['credit']
                         next_record = (
                             records[i + 1] if i + 1 < len(records) else None)
                         if (next_record is None
                                 or next_record['move_number']
                                 != record['move_number']):
                             tr(td("", colspan="6"), cls="move-separator")
-                    if current_month is not None:
-                        tr(td("", colspan="3"),
-                            td(_('Total month %s') % current_month),
-                            td("{:.2f}".format(month_debit), style='text-align: right'),
-                            td("{:.2f}".format(month_credit), style='text-align: right'),
-                            cls="month-total")
-                    total_debit = sum(r['debit'] for r in records)
-                    total_credit = sum(r['credit'] for r in records)
+                    # The last month or, in totals only mode, all of them
+                    for total in month_totals:
+                        month_total_row(total)
                     tr(td("", colspan="3"), td(_('Total')),
-                        td("{:.2f}".format(total_debit), style='text-align: right'),
-                        td("{:.2f}".format(total_credit), style='text-align: right'),
+                        td("{:.2f}".format(parameters.get('total_debit', ZERO)), style='text-align: right'),
+                        td("{:.2f}".format(parameters.get('total_credit', ZERO)), style='text-align: right'),
                         cls="summary")
             with div(cls="footer"):
                 p(_("When move number is between parentheses it means that it "
@@ -516,9 +739,30 @@ class JournalXlsxReport(XlsxReport, metaclass=PoolMeta):
 
     @classmethod
     def get_content(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
+
+        config = Config(1)
+        timeout = data.get('timeout') or config.default_timeout or 300
+        checker = TimeoutChecker(timeout, JournalReport.timeout_exception)
+        company = Company(data['company'])
+
+        start_prepare = datetime.datetime.now()
         with Transaction().set_context(active_test=False):
-            records, parameters = JournalReport.prepare(data)
-        return cls._build_workbook(records, parameters)
+            try:
+                records, parameters = JournalReport.prepare(data, checker)
+            except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
+                raise UserError(gettext(
+                        'account_reports.msg_timeout_exception'))
+        content = cls._build_workbook(records, parameters)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
@@ -540,18 +784,21 @@ class JournalXlsxReport(XlsxReport, metaclass=PoolMeta):
 
         ws.append([_('Date'), _('Move'), _('Account / Party'),
             _('Description'), _('Debit'), _('Credit')])
+        month_totals = iter(parameters.get('month_totals', []))
+
+        def month_total_row(total):
+            if total is None:
+                return
+            ws.append(["", "", "", _('Total month %s') % total['month'],
+                convert_str_to_float("{:.2f}".format(total['debit'])),
+                convert_str_to_float("{:.2f}".format(total['credit']))])
+
         current_month = None
-        month_debit = ZERO
-        month_credit = ZERO
         for record in records:
             if record['month'] != current_month:
                 if current_month is not None:
-                    ws.append(["", "", "", _('Total month %s') % current_month,
-                        convert_str_to_float("{:.2f}".format(month_debit)),
-                        convert_str_to_float("{:.2f}".format(month_credit))])
+                    month_total_row(next(month_totals, None))
                 current_month = record['month']
-                month_debit = ZERO
-                month_credit = ZERO
             account_party = record['account_name']
             if record['party_name']:
                 account_party += " / " + record['party_name']
@@ -563,15 +810,11 @@ class JournalXlsxReport(XlsxReport, metaclass=PoolMeta):
                 convert_str_to_float("{:.2f}".format(record['debit'])),
                 convert_str_to_float("{:.2f}".format(record['credit'])),
                 ])
-            month_debit += record['debit']
-            month_credit += record['credit']
-        if current_month is not None:
-            ws.append(["", "", "", _('Total month %s') % current_month,
-                convert_str_to_float("{:.2f}".format(month_debit)),
-                convert_str_to_float("{:.2f}".format(month_credit))])
-        total_debit = sum(r['debit'] for r in records)
-        total_credit = sum(r['credit'] for r in records)
+        for total in month_totals:
+            month_total_row(total)
         ws.append(["", "", "", _('Total'),
-            convert_str_to_float("{:.2f}".format(total_debit)),
-            convert_str_to_float("{:.2f}".format(total_credit))])
+            convert_str_to_float("{:.2f}".format(
+                    parameters.get('total_debit', ZERO))),
+            convert_str_to_float("{:.2f}".format(
+                    parameters.get('total_credit', ZERO)))])
         return save_workbook(wb)
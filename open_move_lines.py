@@ -1,16 +1,22 @@
 # This file is part of account_reports for tryton.  The COPYRIGHT file
 # at the top level of this repository contains the full copyright notices and
 # license terms.
-from datetime import datetime
+import calendar
+from datetime import datetime, timedelta
 from decimal import Decimal
 
 from dominate.tags import div, header as header_tag, table, tbody, td, th, thead, tr
 from openpyxl import Workbook
+from sql import Literal, Null, Window
+from sql.aggregate import Sum
+from sql.conditionals import Case, Coalesce
 
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.model import ModelView, fields
-from trytond.modules.account_reports.common import TimeoutChecker, TimeoutException, css as common_css
+from trytond.modules.account_reports.common import (
+    CentsTotals, LedgerRow, MinorUnits, SectionPdfMixin, TimeoutChecker,
+    TimeoutException, css as common_css, ids_in)
 from trytond.modules.account_reports.tools import vat_label
 from trytond.modules.account_reports.xlsx import XlsxReport, convert_str_to_float, save_workbook
 from trytond.modules.html_report.dominate_report import DominateReport
@@ -53,6 +59,13 @@ class PrintOpenMoveLinesStart(ModelView):
         'the process will be stopped automatically.')
     show_description = fields.Boolean('Show Description',
         help='If checked show description from Account Move Line')
+    month_end_series = fields.Boolean('Month-End Series',
+        help='If checked the open amounts of each party are shown at the end '
+        'of each month of the year of the cut-off date, up to the cut-off '
+        'date.')
+    aging = fields.Boolean('Aging',
+        help='If checked only the open amounts of each party are shown, '
+        'grouped by days past the maturity date at the cut-off date.')
 
     @staticmethod
     def default_company():
@@ -77,6 +90,14 @@ class PrintOpenMoveLinesStart(ModelView):
     def default_show_description():
         return False
 
+    @staticmethod
+    def default_aging():
+        return False
+
+    @staticmethod
+    def default_month_end_series():
+        return False
+
 
 class PrintOpenMoveLines(Wizard):
     'Print Open Move Lines'
@@ -98,7 +119,11 @@ class PrintOpenMoveLines(Wizard):
             'output_format': self.start.output_format,
             'timeout': self.start.timeout,
             'show_description': self.start.show_description,
+            'aging': self.start.aging,
             }
+        if self.start.month_end_series:
+            data['cutoff_dates'] = self._month_end_dates(self.start.date)
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             action_report, = ActionReport.search([
@@ -107,9 +132,33 @@ class PrintOpenMoveLines(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        'Estimate the lines of the report and warn if it may time out'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.open_move_lines', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.open_move_lines_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            self.start.timeout)
+
     def transition_print_(self):
         return 'end'
 
+    @staticmethod
+    def _month_end_dates(date):
+        'Return the month ends of the year of date before it and date'
+        dates = []
+        for month in range(1, date.month):
+            dates.append(date.replace(month=month,
+                    day=calendar.monthrange(date.year, month)[1]))
+        dates.append(date)
+        return dates
+
     def default_start(self, fields):
         Party = Pool().get('party.party')
         account_ids = []
@@ -128,8 +177,10 @@ class PrintOpenMoveLines(Wizard):
             }
 
 
-class OpenMoveLinesReport(DominateReport):
+class OpenMoveLinesReport(SectionPdfMixin, DominateReport):
     __name__ = 'account_reports.open_move_lines'
+    _lines_batch_size = 1000
+    _aging_days = (30, 60, 90, 120)
 
     @classmethod
     def __setup__(cls):
@@ -186,32 +237,260 @@ class OpenMoveLinesReport(DominateReport):
                 and hasattr(line.move_origin, 'rec_name') else None))
 
     @classmethod
-    def _resolved_party(cls, line, invoice_model):
-        party = None
-        if line.account.party_required and line.origin:
-            invoice = getattr(line.origin, 'invoice', None)
-            if invoice and isinstance(invoice, invoice_model):
-                party = invoice.party
-        if line.account.party_required and not party and line.move_origin:
-            if isinstance(line.move_origin, invoice_model):
-                party = line.move_origin.party
-        return party or line.party
+    def _line_ref(cls, line):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        try:
+            BankLine = pool.get('account.bank.statement.line')
+        except Exception:
+            BankLine = None
+
+        if line.origin and isinstance(line.origin, InvoiceLine):
+            ref = cls._ref_origin_invoice_line(line)
+        elif line.move_origin and isinstance(line.move_origin, Invoice):
+            ref = cls._ref_origin_invoice(line)
+        elif line.origin and BankLine and isinstance(line.origin, BankLine):
+            ref = cls._ref_origin_bank_line(line)
+        elif line.origin:
+            ref = cls._ref_origin(line)
+        else:
+            ref = cls._ref(line)
+        if not ref:
+            ref = cls._ref(line)
+        return ref
+
+    @staticmethod
+    def _invoice_ref(number, reference, party_name, party_code):
+        ref = []
+        if number:
+            ref.append('%s' % number)
+        if reference:
+            ref.append('[%s]' % reference)
+        party = party_name or ('[%s]' % party_code if party_code else '')
+        if party:
+            ref.append(party)
+        return ' '.join(ref)
 
     @classmethod
-    def prepare(cls, data, checker):
+    def _row_ref(cls, row):
+        '''
+        Return the reference of the line from the columns of the query or
+        None if it depends on the record name of an origin.
+        '''
+        if row['invoice_line']:
+            if row['origin_invoice']:
+                ref = cls._invoice_ref(row['origin_invoice_number'],
+                    row['origin_invoice_reference'],
+                    row['origin_invoice_party_name'],
+                    row['origin_invoice_party_code'])
+            else:
+                ref = ''
+        elif row['move_invoice']:
+            ref = cls._invoice_ref(row['move_invoice_number'],
+                row['move_invoice_reference'],
+                row['move_invoice_party_name'],
+                row['move_invoice_party_code'])
+        elif row['bank_line']:
+            ref = row['bank_line_description']
+            if not ref:
+                return None
+        elif row['origin']:
+            return None
+        else:
+            ref = ''
+        if not ref:
+            # Same fallbacks as _ref but the description of the origins is
+            # only known by the records
+            if row['description']:
+                return row['description']
+            elif row['origin']:
+                return None
+            elif row['move_description']:
+                return row['move_description']
+            elif row['move_origin']:
+                return None
+        return ref or None
+
+    @classmethod
+    def _get_open_lines_query(cls, company, cutoff_date, accounts, parties,
+            aging=False, cutoff_dates=None):
+        '''
+        Return the query of the lines open at the cut-off date.
+
+        The party of the lines of the accounts that require a party is the
+        party of the invoice of their origin (an invoice line or tax), or of
+        their move origin, if any.
+        The origins are joined on the id part of the reference so the origin
+        tables are probed by primary key.
+        With aging the open amounts are summed per account, party and bucket
+        of days past the maturity date instead.
+        With cutoff_dates the open amounts are summed per account and party
+        at each of the dates, cutoff_date being the last one.
+        '''
         pool = Pool()
         Account = pool.get('account.account')
-        Company = pool.get('company.company')
         Invoice = pool.get('account.invoice')
         InvoiceLine = pool.get('account.invoice.line')
-        Party = pool.get('party.party')
+        InvoiceTax = pool.get('account.invoice.tax')
         Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Party = pool.get('party.party')
+        Reconciliation = pool.get('account.move.reconciliation')
         try:
             BankLine = pool.get('account.bank.statement.line')
         except Exception:
             BankLine = None
+        line = Line.__table__()
+        move = Move.__table__()
+        account = Account.__table__()
+        reconciliation = Reconciliation.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice_tax = InvoiceTax.__table__()
+        origin_invoice = Invoice.__table__()
+        origin_invoice_party = Party.__table__()
+        move_invoice = Invoice.__table__()
+        move_invoice_party = Party.__table__()
+        party = Party.__table__()
+
+        def origin_of(column, field, table, Model):
+            return (column.like(Model.__name__ + ',%')
+                & (table.id == field.sql_id(column, Model)))
+
+        resolved_party = Case(
+            ((account.party_required & (origin_invoice.party != Null)),
+                origin_invoice.party),
+            ((account.party_required & (move_invoice.party != Null)),
+                move_invoice.party),
+            else_=line.party)
+
+        from_ = line.join(move, condition=move.id == line.move
+            ).join(account, condition=account.id == line.account
+            ).join(reconciliation, 'LEFT',
+                condition=reconciliation.id == line.reconciliation
+            ).join(invoice_line, 'LEFT',
+                condition=origin_of(line.origin, Line.origin, invoice_line,
+                    InvoiceLine)
+            ).join(invoice_tax, 'LEFT',
+                condition=origin_of(line.origin, Line.origin, invoice_tax,
+                    InvoiceTax)
+            ).join(origin_invoice, 'LEFT',
+                condition=origin_invoice.id == Coalesce(
+                    invoice_line.invoice, invoice_tax.invoice)
+            ).join(origin_invoice_party, 'LEFT',
+                condition=origin_invoice_party.id == origin_invoice.party
+            ).join(move_invoice, 'LEFT',
+                condition=origin_of(move.origin, Move.origin, move_invoice,
+                    Invoice)
+            ).join(move_invoice_party, 'LEFT',
+                condition=move_invoice_party.id == move_invoice.party
+            ).join(party, 'LEFT', condition=party.id == resolved_party)
+        if BankLine and not aging and not cutoff_dates:
+            bank_line = BankLine.__table__()
+            from_ = from_.join(bank_line, 'LEFT',
+                condition=origin_of(line.origin, Line.origin, bank_line,
+                    BankLine))
+            bank_columns = [
+                bank_line.id.as_('bank_line'),
+                bank_line.description.as_('bank_line_description'),
+                ]
+        else:
+            bank_columns = [
+                Literal(None).as_('bank_line'),
+                Literal(None).as_('bank_line_description'),
+                ]
+
+        first_cutoff_date = min(cutoff_dates) if cutoff_dates else cutoff_date
+        where = ((move.company == company.id)
+            & (move.date <= cutoff_date)
+            & (account.reconcile == Literal(True))
+            & ((line.reconciliation == Null)
+                | (reconciliation.date > first_cutoff_date)))
+        if accounts:
+            where &= ids_in(line.account, [a.id for a in accounts])
+        if parties:
+            where &= ids_in(line.party, [p.id for p in parties])
+
+        amount = Coalesce(line.debit, 0) - Coalesce(line.credit, 0)
+        if cutoff_dates:
+            # A single scan compares the dates of each line with every
+            # cut-off date
+            balances = [Sum(Case(((move.date <= date)
+                            & ((line.reconciliation == Null)
+                                | (reconciliation.date > date)), amount),
+                        else_=0)).as_('balance_%s' % i)
+                for i, date in enumerate(cutoff_dates)]
+            return from_.select(
+                account.id.as_('account'), account.code.as_('code'),
+                account.name.as_('account_name'),
+                resolved_party.as_('party'), party.name.as_('party_name'),
+                *balances,
+                where=where,
+                group_by=[account.id, account.code, account.name,
+                    resolved_party, party.name])
+        if aging:
+            due_date = Coalesce(line.maturity_date, move.date)
+            bucket = Case(
+                *((due_date >= cutoff_date - timedelta(days=days), i)
+                    for i, days in enumerate((0,) + cls._aging_days)),
+                else_=len(cls._aging_days) + 1)
+            buckets = [Sum(Case((bucket == i, amount), else_=0)).as_(
+                    'bucket_%s' % i)
+                for i in range(len(cls._aging_days) + 2)]
+            return from_.select(
+                account.id.as_('account'), account.code.as_('code'),
+                account.name.as_('account_name'),
+                resolved_party.as_('party'), party.name.as_('party_name'),
+                *buckets,
+                where=where,
+                group_by=[account.id, account.code, account.name,
+                    resolved_party, party.name])
+
+        order_by = [move.date, move.id, line.id]
+        balance = Sum(amount, window=Window([line.account, resolved_party],
+                order_by=[c.asc for c in order_by],
+                frame='ROWS', start=None, end=0))
+        return from_.select(
+            line.id.as_('id'),
+            account.id.as_('account'), account.code.as_('code'),
+            account.name.as_('account_name'),
+            resolved_party.as_('party'), party.name.as_('party_name'),
+            move.date.as_('date'), line.maturity_date.as_('maturity_date'),
+            move.id.as_('move'), move.number.as_('number'),
+            line.description.as_('description'),
+            move.description.as_('move_description'),
+            line.origin.as_('origin'), move.origin.as_('move_origin'),
+            reconciliation.date.as_('reconciliation_date'),
+            line.debit.as_('debit'), line.credit.as_('credit'),
+            balance.as_('balance'),
+            invoice_line.id.as_('invoice_line'),
+            origin_invoice.id.as_('origin_invoice'),
+            origin_invoice.number.as_('origin_invoice_number'),
+            origin_invoice.reference.as_('origin_invoice_reference'),
+            origin_invoice_party.name.as_('origin_invoice_party_name'),
+            origin_invoice_party.code.as_('origin_invoice_party_code'),
+            move_invoice.id.as_('move_invoice'),
+            move_invoice.number.as_('move_invoice_number'),
+            move_invoice.reference.as_('move_invoice_reference'),
+            move_invoice_party.name.as_('move_invoice_party_name'),
+            move_invoice_party.code.as_('move_invoice_party_code'),
+            *bank_columns,
+            where=where,
+            order_by=[line.account.asc, resolved_party.asc]
+            + [c.asc for c in order_by])
+
+    @classmethod
+    def prepare(cls, data, checker):
+        pool = Pool()
+        Account = pool.get('account.account')
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        Line = pool.get('account.move.line')
 
         cutoff_date = data['date']
+        cutoff_dates = sorted(data.get('cutoff_dates') or [])
+        if cutoff_dates:
+            cutoff_date = cutoff_dates[-1]
         with Transaction().set_context(active_test=False):
             accounts = Account.browse(data.get('accounts', []))
             parties = Party.browse(data.get('parties', []))
@@ -247,98 +526,159 @@ class OpenMoveLinesReport(DominateReport):
             'accounts': accounts_subtitle,
             'parties': parties_subtitle,
             'show_description': data.get('show_description', True),
+            'aging': data.get('aging', False) and not cutoff_dates,
+            'cutoff_dates': [d.strftime('%d/%m/%Y') for d in cutoff_dates],
             }
+        show_description = parameters['show_description']
 
-        domain = [
-            ('move.company', '=', company.id),
-            ('move.date', '<=', cutoff_date),
-            ('account.reconcile', '=', True),
-            ['OR',
-                ('reconciliation', '=', None),
-                ('reconciliation.date', '>', cutoff_date),
-                ],
-            ]
-        if accounts:
-            domain.append(('account', 'in', [a.id for a in accounts]))
-        if parties:
-            domain.append(('party', 'in', [p.id for p in parties]))
-
-        with Transaction().set_context(active_test=False):
-            line_ids = [line.id for line in Line.search(domain, order=[
-                        ('account', 'ASC'),
-                        ('party', 'ASC'),
-                        ('move.date', 'ASC'),
-                        ('move', 'ASC'),
-                        ('id', 'ASC'),
-                        ])]
+        cursor = Transaction().connection.cursor()
+        query = cls._get_open_lines_query(company, cutoff_date, accounts,
+            parties, aging=parameters['aging'], cutoff_dates=cutoff_dates)
+        cursor.execute(*query)
+        columns = [c[0] for c in cursor.description]
+        digits = company.currency.digits
+        units = MinorUnits(digits)
 
         records = {}
-        last_key = None
-        balance = _ZERO
+        if cutoff_dates:
+            for row in cursor:
+                row = dict(zip(columns, row))
+                balances = []
+                for i in range(len(cutoff_dates)):
+                    balances.append(units.amount(row['balance_%s' % i]))
+                if not any(balances):
+                    continue
+                code = row['code'] or str(row['account'])
+                records[(code, row['party_name'] or '')] = {
+                    'account': row['account_name'],
+                    'code': code,
+                    'party': row['party_name'] or '',
+                    'balances': balances,
+                    }
+            return dict(sorted(records.items())), parameters
+
+        if parameters['aging']:
+            for row in cursor:
+                row = dict(zip(columns, row))
+                cents = [units.to_cents(row['bucket_%s' % i])
+                    for i in range(len(cls._aging_days) + 2)]
+                if not any(cents):
+                    continue
+                code = row['code'] or str(row['account'])
+                records[(code, row['party_name'] or '')] = {
+                    'account': row['account_name'],
+                    'code': code,
+                    'party': row['party_name'] or '',
+                    'buckets': [units.to_decimal(c) for c in cents],
+                    'total_balance': units.to_decimal(sum(cents)),
+                    }
+            return dict(sorted(records.items())), parameters
+
+        # The lines whose reference or move description depend on the
+        # record name or the description of an origin are read afterwards
+        pending = {}
+        totals = {}
         sequence = 0
-        for group_lines in grouped_slice(line_ids):
+        while True:
+            rows = cursor.fetchmany(cls._lines_batch_size)
+            if not rows:
+                break
             checker.check()
-            for line in Line.browse(group_lines):
-                party = cls._resolved_party(line, Invoice)
-                current_key = (line.account, party)
-                if current_key != last_key:
-                    balance = _ZERO
-                    last_key = current_key
-                balance += line.debit - line.credit
+            for row in rows:
+                row = dict(zip(columns, row))
                 sequence += 1
+                debit = row['debit'] or _ZERO
+                credit = row['credit'] or _ZERO
+                # SQLite uses float for SUM
+                balance = units.amount(row['balance'])
 
-                if line.origin and isinstance(line.origin, InvoiceLine):
-                    ref = cls._ref_origin_invoice_line(line)
-                elif line.move_origin and isinstance(line.move_origin, Invoice):
-                    ref = cls._ref_origin_invoice(line)
-                elif line.origin and BankLine and isinstance(line.origin, BankLine):
-                    ref = cls._ref_origin_bank_line(line)
-                elif line.origin:
-                    ref = cls._ref_origin(line)
+                if row['number']:
+                    number = row['number']
                 else:
-                    ref = cls._ref(line)
-                if not ref:
-                    ref = cls._ref(line)
-
-                key = (
-                    line.account.code or str(line.account.id),
-                    party.name if party else '',
-                    )
+                    number = '(#%s)' % row['move']
+                ref = cls._row_ref(row)
+                line_info = LedgerRow(
+                    sequence=sequence,
+                    date=row['date'],
+                    maturity_date=row['maturity_date'],
+                    number=number,
+                    ref=ref,
+                    description=row['description'],
+                    move_description=row['move_description'],
+                    reconciliation_date=row['reconciliation_date'],
+                    debit=debit,
+                    credit=credit,
+                    balance=balance)
+                if ((ref is None and (row['origin'] or row['move_origin']))
+                        or (show_description
+                            and not row['move_description']
+                            and row['move_origin'])):
+                    pending[row['id']] = line_info
+
+                code = row['code'] or str(row['account'])
+                key = (code, row['party_name'] or '')
                 record = records.setdefault(key, {
-                        'account': line.account.name,
-                        'code': line.account.code or str(line.account.id),
-                        'party': party.name if party else '',
+                        'account': row['account_name'],
+                        'code': code,
+                        'party': row['party_name'] or '',
                         'lines': [],
                         'total_debit': _ZERO,
                         'total_credit': _ZERO,
                         'total_balance': _ZERO,
                         })
-                record['lines'].append({
-                        'sequence': sequence,
-                        'line': line,
-                        'ref': ref,
-                        'debit': line.debit,
-                        'credit': line.credit,
-                        'balance': balance,
-                        })
-                record['total_debit'] += line.debit
-                record['total_credit'] += line.credit
-                record['total_balance'] += line.debit - line.credit
+                record['lines'].append(line_info)
+                sums = totals.get(key)
+                if sums is None:
+                    sums = totals[key] = CentsTotals(
+                        ['total_debit', 'total_credit'], digits)
+                sums.add('total_debit', debit)
+                sums.add('total_credit', credit)
+
+        for key, sums in totals.items():
+            records[key].update(sums.to_dict())
+            records[key]['total_balance'] = (
+                sums['total_debit'] - sums['total_credit'])
+
+        for sub_ids in grouped_slice(list(pending.keys())):
+            checker.check()
+            for line in Line.browse(sub_ids):
+                line_info = pending[line.id]
+                if line_info['ref'] is None:
+                    line_info['ref'] = cls._line_ref(line)
+                line_info['move_description'] = line.move_description_used
         return dict(sorted(records.items())), parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the lines to estimate the cost of the report'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        return cls._get_open_lines_query(Company(data['company']),
+            data['date'], Account.browse(data.get('accounts', [])),
+            Party.browse(data.get('parties', [])))
+
     @classmethod
     def execute(cls, ids, data):
-        Config = Pool().get('account.configuration')
+        pool = Pool()
+        Company = pool.get('company.company')
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, cls.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = cls.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -347,19 +687,40 @@ class OpenMoveLinesReport(DominateReport):
             context['timeout_report'] = (
                 timeout - int((end_prepare - start_prepare).total_seconds()))
 
+        report_data = {
+            'name': 'account_reports.open_move_lines',
+            'model': 'account.move.line',
+            'records': records,
+            'parameters': parameters,
+            'output_format': data.get('output_format', 'pdf'),
+            }
         with Transaction().set_context(**context):
-            return super(OpenMoveLinesReport, cls).execute(ids, {
-                    'name': 'account_reports.open_move_lines',
-                    'model': 'account.move.line',
-                    'records': records,
-                    'parameters': parameters,
-                    'output_format': data.get('output_format', 'pdf'),
-                    })
+            result = cls.execute_sections(ids, report_data)
+            if result is None:
+                result = super(OpenMoveLinesReport, cls).execute(ids,
+                    report_data)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def timeout_exception(cls):
         raise TimeoutException
 
+    @classmethod
+    def sections(cls, data):
+        '''
+        Split the records by account, the aging and the series are not split
+        as they end with the totals of all the records.
+        '''
+        parameters = data['parameters']
+        if parameters.get('aging') or parameters.get('cutoff_dates'):
+            return [data['records']]
+        sections = {}
+        for key, record in data['records'].items():
+            sections.setdefault(key[0], {})[key] = record
+        return list(sections.values())
+
     @classmethod
     def header(cls, action, data, records):
         p = data['parameters']
@@ -398,35 +759,35 @@ class OpenMoveLinesReport(DominateReport):
             cell['colspan'] = str(colspan)
         row.add(cell)
 
+    @classmethod
+    def _line_description(cls, line_info, show_description):
+        description = ''
+        if line_info['ref']:
+            description += line_info['ref']
+        if (line_info['ref'] and show_description
+                and (line_info['description']
+                    or line_info['move_description'])):
+            description += ' // '
+        if show_description and line_info['description']:
+            description += line_info['description']
+        elif show_description and line_info['move_description']:
+            description += line_info['move_description']
+        return description
+
     @classmethod
     def show_detail_lines(cls, record, show_description):
         rows = []
         for line_info in record['lines']:
             row = tr()
-            line = line_info['line']
-            number = ''
-            if line.move and line.move.number:
-                number = line.move.number
-            elif line.move:
-                number = '(#%s)' % line.move.id
-            description = ''
-            if line_info['ref']:
-                description += line_info['ref']
-            if (line_info['ref'] and show_description
-                    and (line.description or line.move_description_used)):
-                description += ' // '
-            if show_description and line.description:
-                description += line.description
-            elif show_description and line.move_description_used:
-                description += line.move_description_used
-
-            cls._add_cell(row, html_render(line.date))
-            cls._add_cell(row, html_render(line.maturity_date)
-                if line.maturity_date else '')
-            cls._add_cell(row, number)
+            description = cls._line_description(line_info, show_description)
+
+            cls._add_cell(row, html_render(line_info['date']))
+            cls._add_cell(row, html_render(line_info['maturity_date'])
+                if line_info['maturity_date'] else '')
+            cls._add_cell(row, line_info['number'])
             cls._add_cell(row, description)
-            cls._add_cell(row, html_render(line.reconciliation.date)
-                if line.reconciliation else '')
+            cls._add_cell(row, html_render(line_info['reconciliation_date'])
+                if line_info['reconciliation_date'] else '')
             cls._add_cell(row, html_render(line_info['debit']),
                 style_value='text-align: right;', cls_name='no-wrap')
             cls._add_cell(row, html_render(line_info['credit']),
@@ -472,6 +833,77 @@ class OpenMoveLinesReport(DominateReport):
                         style_value='text-align: right;', cls_name='no-wrap')
         return detail_table
 
+    @classmethod
+    def _aging_labels(cls):
+        labels = [_('Current')]
+        previous = 0
+        for days in cls._aging_days:
+            labels.append('%s-%s' % (previous + 1, days))
+            previous = days
+        labels.append('+%s' % previous)
+        return labels
+
+    @classmethod
+    def show_aging(cls, records):
+        labels = cls._aging_labels()
+        totals = [_ZERO] * len(labels)
+        aging_table = table()
+        with aging_table:
+            with tr():
+                th(_('Account'))
+                th(_('Party'))
+                for label in labels:
+                    th(label, style='text-align: right;')
+                th(_('Balance'), style='text-align: right;')
+            for record in records.values():
+                with tr() as row:
+                    cls._add_cell(row, record['code'])
+                    cls._add_cell(row, record['party'] or record['account'])
+                    for i, value in enumerate(record['buckets']):
+                        totals[i] += value
+                        cls._add_cell(row, html_render(value),
+                            style_value='text-align: right;',
+                            cls_name='no-wrap')
+                    cls._add_cell(row, html_render(record['total_balance']),
+                        style_value='text-align: right;',
+                        cls_name='no-wrap bold')
+            with tr(cls='bold bottom') as total_row:
+                cls._add_cell(total_row, _('Total'), cls_name='left bold',
+                    colspan=2)
+                for value in totals:
+                    cls._add_cell(total_row, html_render(value),
+                        style_value='text-align: right;', cls_name='no-wrap')
+                cls._add_cell(total_row, html_render(sum(totals)),
+                    style_value='text-align: right;', cls_name='no-wrap')
+        return aging_table
+
+    @classmethod
+    def show_series(cls, records, cutoff_dates):
+        totals = [_ZERO] * len(cutoff_dates)
+        series_table = table()
+        with series_table:
+            with tr():
+                th(_('Account'))
+                th(_('Party'))
+                for date in cutoff_dates:
+                    th(date, style='text-align: right;')
+            for record in records.values():
+                with tr() as row:
+                    cls._add_cell(row, record['code'])
+                    cls._add_cell(row, record['party'] or record['account'])
+                    for i, value in enumerate(record['balances']):
+                        totals[i] += value
+                        cls._add_cell(row, html_render(value),
+                            style_value='text-align: right;',
+                            cls_name='no-wrap')
+            with tr(cls='bold bottom') as total_row:
+                cls._add_cell(total_row, _('Total'), cls_name='left bold',
+                    colspan=2)
+                for value in totals:
+                    cls._add_cell(total_row, html_render(value),
+                        style_value='text-align: right;', cls_name='no-wrap')
+        return series_table
+
     @classmethod
     def title(cls, action, data, records):
         return '%s - %s - %s' % (
@@ -483,6 +915,13 @@ class OpenMoveLinesReport(DominateReport):
         container = div()
         if data.get('output_format') != 'pdf':
             container.add(cls.header(action, data, records))
+        if data['parameters'].get('cutoff_dates'):
+            container.add(cls.show_series(data['records'],
+                    data['parameters']['cutoff_dates']))
+            return container
+        if data['parameters'].get('aging'):
+            container.add(cls.show_aging(data['records']))
+            return container
         container.add(cls.show_detail(
             data['records'],
             data['parameters'].get('show_description', True)))
@@ -495,17 +934,23 @@ class OpenMoveLinesXlsxReport(XlsxReport, metaclass=PoolMeta):
     @classmethod
     def get_content(cls, ids, data):
         pool = Pool()
+        Company = pool.get('company.company')
         Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, OpenMoveLinesReport.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = OpenMoveLinesReport.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -515,7 +960,10 @@ class OpenMoveLinesXlsxReport(XlsxReport, metaclass=PoolMeta):
                 timeout - int((end_prepare - start_prepare).total_seconds()))
 
         with Transaction().set_context(**context):
-            return cls._build_workbook(records, parameters)
+            content = cls._build_workbook(records, parameters)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
@@ -541,6 +989,31 @@ class OpenMoveLinesXlsxReport(XlsxReport, metaclass=PoolMeta):
             ws.append([_('All Accounts')])
         ws.append([])
 
+        if parameters.get('cutoff_dates'):
+            ws.append([_('Account'), _('Party')] + parameters['cutoff_dates'])
+            totals = [_ZERO] * len(parameters['cutoff_dates'])
+            for record in records.values():
+                for i, value in enumerate(record['balances']):
+                    totals[i] += value
+                ws.append([record['code'], record['party'] or record['account']]
+                    + [xls(v) for v in record['balances']])
+            ws.append([_('Total'), ''] + [xls(v) for v in totals])
+            return save_workbook(wb)
+
+        if parameters.get('aging'):
+            labels = OpenMoveLinesReport._aging_labels()
+            ws.append([_('Account'), _('Party')] + labels + [_('Balance')])
+            totals = [_ZERO] * len(labels)
+            for record in records.values():
+                for i, value in enumerate(record['buckets']):
+                    totals[i] += value
+                ws.append([record['code'], record['party'] or record['account']]
+                    + [xls(v) for v in record['buckets']]
+                    + [xls(record['total_balance'])])
+            ws.append([_('Total'), ''] + [xls(v) for v in totals]
+                + [xls(sum(totals))])
+            return save_workbook(wb)
+
         ws.append([
             _('Date'),
             _('Maturity Date'),
@@ -565,30 +1038,15 @@ class OpenMoveLinesXlsxReport(XlsxReport, metaclass=PoolMeta):
                 xls(record['total_balance']),
                 ])
             for line_info in record['lines']:
-                line = line_info['line']
-                if line.move and line.move.number:
-                    number = line.move.number
-                elif line.move:
-                    number = '(#%s)' % line.move.id
-                else:
-                    number = ''
-                description = ''
-                if line_info['ref']:
-                    description += line_info['ref']
-                if (line_info['ref'] and show_description
-                        and (line.description or line.move_description_used)):
-                    description += ' // '
-                if show_description and line.description:
-                    description += line.description
-                elif show_description and line.move_description_used:
-                    description += line.move_description_used
                 ws.append([
-                    html_render(line.date),
-                    html_render(line.maturity_date) if line.maturity_date else '',
-                    number,
-                    description,
-                    (html_render(line.reconciliation.date)
-                        if line.reconciliation else ''),
+                    html_render(line_info['date']),
+                    (html_render(line_info['maturity_date'])
+                        if line_info['maturity_date'] else ''),
+                    line_info['number'],
+                    OpenMoveLinesReport._line_description(
+                        line_info, show_description),
+                    (html_render(line_info['reconciliation_date'])
+                        if line_info['reconciliation_date'] else ''),
                     xls(line_info['debit']),
                     xls(line_info['credit']),
                     xls(line_info['balance']),
@@ -2,6 +2,11 @@
 # copyright notices and license terms.
 from datetime import datetime
 from decimal import Decimal
+from sql import Literal, Null
+from sql.aggregate import Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.operators import Like
+
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.model import ModelView, fields
@@ -10,10 +15,12 @@ from trytond.pyson import Eval, If, Bool
 from trytond.rpc import RPC
 from trytond.i18n import gettext
 from trytond.modules.html_report.dominate_report import DominateReport
-from trytond.modules.html_report.engine import DualRecord, render as html_render
+from trytond.modules.html_report.engine import render as html_render
 from trytond.modules.html_report.i18n import _
 from trytond.modules.account.exceptions import FiscalYearNotFoundError
-from trytond.modules.account_reports.common import css as common_css
+from trytond.modules.account_reports.common import (
+    CentsTotals, ReportContext, TaxRow, css as common_css, date_ranges_domain,
+    date_ranges_where, ids_in, merge_date_ranges)
 from trytond.modules.account_reports.tools import vat_label
 from trytond.modules.account_reports.xlsx import (
     XlsxReport, save_workbook, convert_str_to_float)
@@ -21,8 +28,6 @@ from openpyxl import Workbook
 from dominate.util import raw
 from dominate.tags import div, header as header_tag, table, thead, tbody, tr, td, th, p, strong
 
-_ZERO = Decimal(0)
-
 
 class PrintTaxesByInvoiceAndPeriodStart(ModelView):
     'Print Taxes by Invoice and Period'
@@ -181,6 +186,7 @@ class PrintTaxesByInvoiceAndPeriod(Wizard):
             'tax_type': self.start.tax_type,
             'taxes': [x.id for x in self.start.taxes],
             }
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             with Transaction().set_context(active_test=False):
@@ -190,6 +196,24 @@ class PrintTaxesByInvoiceAndPeriod(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        '''
+        Estimate the invoice taxes of the report and warn if it may take
+        longer than the default timeout
+        '''
+        pool = Pool()
+        Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.taxes_by_invoice', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.taxes_by_invoice_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            Config(1).default_timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -242,6 +266,146 @@ class TaxesByInvoiceReport(DominateReport):
                 side_margin)
         )
 
+    @classmethod
+    def _get_invoice_taxes_query(cls, data, periods, parties,
+            excluded_parties, start_date, end_date, totals=False):
+        '''
+        Return the query of the invoice taxes of the report in the order they
+        are printed.
+
+        The columns are the invoice tax id, the period of the invoice move,
+        the tax, whether the invoice is excluded from the totals, the company
+        base and amount caches and then the values printed for each line: the
+        invoice id, state, number and date, the move date, the account code,
+        the party, the tax identifier of the invoice, the tax name and the
+        company total amount cache of the invoice.
+
+        If totals is set, the query returns instead one row for each period
+        or tax with the company base and amount, the number of invoice taxes
+        added to the totals and the number of them without cache.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        Invoice = pool.get('account.invoice')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        PartyIdentifier = pool.get('party.identifier')
+        Tax = pool.get('account.tax')
+        invoice_tax = InvoiceTax.__table__()
+        invoice = Invoice.__table__()
+        move = Move.__table__()
+        cancel_move = Move.__table__()
+        period = Period.__table__()
+        account = Account.__table__()
+
+        where = invoice.move != Null
+        if data.get('company'):
+            where &= invoice.company == data['company']
+        if data['partner_type'] == 'customers':
+            where &= invoice.type == 'out'
+        else:
+            where &= invoice.type == 'in'
+        if start_date:
+            where &= move.date >= start_date
+        if end_date:
+            where &= move.date <= end_date
+        if not start_date and not end_date and periods:
+            # The date ranges let the database use the index on the move
+            # date while the period keeps the exact selection
+            where &= ids_in(move.period, [p.id for p in periods])
+            where &= date_ranges_where(move.date, merge_date_ranges(periods))
+        if parties:
+            where &= ids_in(invoice.party, [p.id for p in parties])
+        if excluded_parties:
+            where &= ~ids_in(invoice.party,
+                [p.id for p in excluded_parties])
+        if data['tax_type'] == 'invoiced':
+            where &= invoice_tax.base >= 0
+        elif data['tax_type'] == 'refunded':
+            where &= invoice_tax.base < 0
+        if data['taxes']:
+            where &= ids_in(invoice_tax.tax, data['taxes'])
+
+        # Cancelled invoices are only added to the totals when they are
+        # cancelled by a move originated by another invoice
+        cancelled = ((invoice.state == 'cancelled')
+            & ~Like(Coalesce(cancel_move.origin, ''), 'account.invoice,%'))
+
+        query = invoice_tax.join(invoice,
+                condition=invoice.id == invoice_tax.invoice
+            ).join(move, condition=move.id == invoice.move
+            ).join(period, condition=period.id == move.period
+            ).join(account, condition=account.id == invoice_tax.account
+            ).join(cancel_move, 'LEFT',
+                condition=cancel_move.id == invoice.cancel_move)
+
+        if totals:
+            if data['grouping'] == 'invoice':
+                key = move.period
+                key_order = Min(period.start_date)
+            else:
+                key = invoice_tax.tax
+                key_order = Min(account.code)
+            not_cached = ((invoice_tax.company_base_cache == Null)
+                | (invoice_tax.company_amount_cache == Null))
+            return query.select(
+                key,
+                Sum(Case((cancelled, 0),
+                        else_=invoice_tax.company_base_cache)),
+                Sum(Case((cancelled, 0),
+                        else_=invoice_tax.company_amount_cache)),
+                Sum(Case((cancelled, 0), else_=1)),
+                Sum(Case((not_cached, 1), else_=0)),
+                where=where,
+                group_by=key,
+                order_by=key_order.asc)
+
+        if data['grouping'] == 'invoice':
+            order_by = [period.start_date.asc, period.id.asc,
+                invoice.invoice_date.asc]
+        else:
+            order_by = [account.code.asc, account.name.asc, move.date.asc]
+        order_by += [invoice.number.asc, invoice.id.asc, invoice_tax.id.asc]
+
+        identifier = PartyIdentifier.__table__()
+        tax = Tax.__table__()
+        query = query.join(identifier, 'LEFT',
+                condition=identifier.id == invoice.party_tax_identifier
+            ).join(tax, 'LEFT', condition=tax.id == invoice_tax.tax)
+        return query.select(
+            invoice_tax.id, move.period, invoice_tax.tax,
+            Case((cancelled, Literal(True)),
+                else_=Literal(False)).as_('excluded'),
+            invoice_tax.company_base_cache,
+            invoice_tax.company_amount_cache,
+            invoice.id, invoice.state, invoice.number, invoice.invoice_date,
+            move.date, account.code, invoice.party, identifier.code,
+            tax.name, invoice.company_total_amount_cache,
+            where=where,
+            order_by=order_by)
+
+    @classmethod
+    def _get_currency_rates(cls, currency_dates):
+        '''
+        Return the rate of each (currency id, date) pair.
+
+        The currencies are read once for each date instead of once for each
+        amount to convert.
+        '''
+        pool = Pool()
+        Currency = pool.get('currency.currency')
+
+        currencies_by_date = {}
+        for currency_id, date in currency_dates:
+            currencies_by_date.setdefault(date, set()).add(currency_id)
+        rates = {}
+        for date, currency_ids in currencies_by_date.items():
+            with Transaction().set_context(date=date):
+                for currency in Currency.browse(list(currency_ids)):
+                    rates[(currency.id, date)] = currency.rate
+        return rates
+
     @classmethod
     def prepare(cls, data):
         pool = Pool()
@@ -254,6 +418,7 @@ class TaxesByInvoiceReport(DominateReport):
         AccountInvoiceTax = pool.get('account.invoice.tax')
         InvoiceLine = pool.get('account.invoice.line')
         Currency = pool.get('currency.currency')
+        report_context = ReportContext()
 
         fiscalyear = (FiscalYear(data['fiscalyear']) if data.get('fiscalyear')
             else None)
@@ -329,7 +494,13 @@ class TaxesByInvoiceReport(DominateReport):
                 ]
 
         if not start_date and not end_date and periods:
-            domain += [('invoice.move.period', 'in', periods)]
+            # Like the invoice taxes query, the date ranges let the database
+            # use the index on the move date
+            domain += [
+                ('invoice.move.period', 'in', periods),
+                date_ranges_domain('invoice.move.date',
+                    merge_date_ranges(periods)),
+                ]
 
         if parties:
             domain += [('invoice.party', 'in', parties)]
@@ -338,8 +509,6 @@ class TaxesByInvoiceReport(DominateReport):
         if excluded_parties:
             domain += [('invoice.party', 'not in', excluded_parties)]
 
-        invoice_tax_domain = domain.copy()
-
         # Search all the invoices that have taxes_deductible_rate != 1
         invoice_line_domain = domain.copy()
         invoice_line_domain += [
@@ -347,7 +516,6 @@ class TaxesByInvoiceReport(DominateReport):
             ('taxes_deductible_rate', '!=', 1)]
 
         if data['tax_type'] == 'invoiced':
-            invoice_tax_domain += [('base', '>=', 0)]
             # As the amount field in invoice line has not searcher, but the
             # amount = quantity x unit_price, check this both fields.
             invoice_line_domain += [['OR', [
@@ -355,24 +523,26 @@ class TaxesByInvoiceReport(DominateReport):
                         [('quantity', '<=', 0), ('unit_price', '<=', 0)],
                         ]]]
         elif data['tax_type'] == 'refunded':
-            invoice_tax_domain += [('base', '<', 0)]
             invoice_line_domain += [['OR', [
                         [('quantity', '>', 0), ('unit_price', '<', 0)],
                         [('quantity', '<', 0), ('unit_price', '>', 0)],
                         ]]]
 
         if data['taxes']:
-            invoice_tax_domain += [('tax', 'in', data.get('taxes', []))]
             invoice_line_domain += [('taxes', 'in', data.get('taxes', []))]
 
         records = {}
-        totals = {
-            'total_untaxed': _ZERO,
-            'total_tax': _ZERO,
-            'total': _ZERO,
-            }
+        # The totals are summed as integer cents
+        total_names = ['total_untaxed', 'total_tax', 'total']
+        digits = company.currency.digits if company else 2
+        totals = CentsTotals(total_names, digits)
         fake_taxes = {}
         tax_totals = {}
+
+        def get_tax_totals(key):
+            if key not in tax_totals:
+                tax_totals[key] = CentsTotals(total_names, digits)
+            return tax_totals[key]
         non_deductible_records = {}
         if data['grouping'] == 'invoice':
             order = [
@@ -387,42 +557,116 @@ class TaxesByInvoiceReport(DominateReport):
                 ('invoice', 'ASC'),
                 ]
 
-        taxes = AccountInvoiceTax.search(invoice_tax_domain, order=order)
-        for tax in taxes:
-            key = tax.invoice.move.period if data['grouping'] == 'invoice' else tax.tax
-            records.setdefault(key, []).append(DualRecord(tax))
-
-            # If the invoice is cancelled, do not add its values to the
-            # totals
-            if (tax.invoice.state == 'cancelled' and (
-                    (tax.invoice.cancel_move
-                        and tax.invoice.cancel_move.origin
-                        and not isinstance(tax.invoice.cancel_move.origin, Invoice))
-                    or not tax.invoice.cancel_move
-                    or not tax.invoice.cancel_move.origin)):
-                continue
-
-            # With this we have the total for each tax (total base, total
-            # amount and total)
-            tax_totals.setdefault(key, {
-                    'total_untaxed': 0,
-                    'total_tax': 0,
-                    'total': 0})
-            tax_totals[key]['total_untaxed'] += tax.company_base
-            tax_totals[key]['total_tax'] += tax.company_amount
-            tax_totals[key]['total'] += tax.company_base + tax.company_amount
-
-            # We need this fields in the report
-            totals['total_untaxed'] += tax.company_base
-            totals['total_tax'] += tax.company_amount
-            totals['total'] += tax.company_base + tax.company_amount
+        cursor = Transaction().connection.cursor()
+        totals_rows = None
+        if data['totals_only']:
+            cursor.execute(*cls._get_invoice_taxes_query(data, periods,
+                    parties, excluded_parties, start_date, end_date,
+                    totals=True))
+            totals_rows = cursor.fetchall()
+            if any(r[4] for r in totals_rows):
+                # Some company amounts are not cached, compute them from the
+                # invoice taxes
+                totals_rows = None
+
+        if totals_rows is not None:
+            for key_id, company_base, company_amount, count, _not_cached in (
+                    totals_rows):
+                if data['grouping'] == 'invoice':
+                    key = Period(key_id)
+                else:
+                    key = AccountTax(key_id)
+                records.setdefault(key, [])
+                if not count:
+                    continue
+                for totals_ in [get_tax_totals(key), totals]:
+                    totals_.add('total_untaxed', company_base)
+                    totals_.add('total_tax', company_amount)
+                    totals_.add('total', company_base)
+                    totals_.add('total', company_amount)
+        else:
+            cursor.execute(*cls._get_invoice_taxes_query(data, periods,
+                    parties, excluded_parties, start_date, end_date))
+            rows = cursor.fetchall()
+
+            # The lines are rendered from the projected columns and the
+            # company amounts are read from the cache columns, only the
+            # invoice taxes and invoices without cache use the ORM
+            no_cache = [r[0] for r in rows if r[4] is None or r[5] is None]
+            computed = {t.id: (t.company_base, t.company_amount)
+                for t in AccountInvoiceTax.browse(no_cache)}
+            no_total_cache = list({r[6] for r in rows if r[15] is None})
+            invoice_totals = {i.id: i.company_total_amount
+                for i in Invoice.browse(no_total_cache)}
+            party_infos = {p.id: p for p in report_context.parties(
+                    list({r[12] for r in rows}))}
+            keys = {}
+            for row in rows:
+                (invoice_tax_id, period_id, tax_id, excluded, company_base,
+                    company_amount, invoice_id, state, number, invoice_date,
+                    move_date, account_code, party_id, tax_identifier,
+                    tax_name, company_total_amount) = row
+                if invoice_tax_id in computed:
+                    company_base, company_amount = computed[invoice_tax_id]
+                if invoice_id in invoice_totals:
+                    company_total_amount = invoice_totals[invoice_id]
+                party = party_infos[party_id]
+                if data['grouping'] == 'invoice':
+                    key = keys.setdefault(('period', period_id),
+                        Period(period_id))
+                else:
+                    key = keys.setdefault(('tax', tax_id),
+                        AccountTax(tax_id))
+                records.setdefault(key, []).append(TaxRow(
+                        invoice=invoice_id, state=state, number=number,
+                        invoice_date=invoice_date, move_date=move_date,
+                        account_code=account_code,
+                        party=party.name or '[%s]' % party.code,
+                        tax_identifier=(tax_identifier
+                            or party.tax_identifier or ''),
+                        tax_name=tax_name, company_base=company_base,
+                        company_amount=company_amount,
+                        company_total_amount=company_total_amount))
+
+                # If the invoice is cancelled, do not add its values to the
+                # totals
+                if excluded:
+                    continue
+
+                # With this we have the total for each tax (total base, total
+                # amount and total) and the totals of the report
+                for totals_ in [get_tax_totals(key), totals]:
+                    totals_.add('total_untaxed', company_base)
+                    totals_.add('total_tax', company_amount)
+                    totals_.add('total', company_base)
+                    totals_.add('total', company_amount)
 
         # Tax not deductible
         lines = InvoiceLine.search(invoice_line_domain, order=order)
+        currency_dates = set()
         for line in lines:
-            with Transaction().set_context(_deductible_rate=1):
-                taxes_amount = {t['tax']: t['amount']
+            currency_dates.add(
+                (line.invoice.currency.id, line.invoice.currency_date))
+            currency_dates.add(
+                (line.invoice.company.currency.id, line.invoice.currency_date))
+        rates = cls._get_currency_rates(currency_dates)
+
+        def compute(from_currency, amount, to_currency, date):
+            from_rate = rates.get((from_currency.id, date))
+            to_rate = rates.get((to_currency.id, date))
+            if from_currency == to_currency or not from_rate or not to_rate:
+                # Let Currency.compute round or raise the missing rate error
+                with Transaction().set_context(date=date):
+                    return Currency.compute(from_currency, amount,
+                        to_currency, round=True)
+            return to_currency.round(amount * to_rate / from_rate)
+
+        with Transaction().set_context(_deductible_rate=1):
+            lines_taxes_amount = {line.id: {t['tax']: t['amount']
                     for t in line._get_taxes().values()}
+                for line in lines}
+        for line in lines:
+            taxes_amount = lines_taxes_amount[line.id]
             for tax in line.taxes:
                 if tax.tax_kind != 'vat':
                     continue
@@ -449,37 +693,32 @@ class TaxesByInvoiceReport(DominateReport):
                     Decimal(str(line.quantity or 0))
                     * (line.unit_price or Decimal(0)))
                 amount = taxes_amount[tax.id]
-                with Transaction().set_context(
-                        date=line.invoice.currency_date):
-                    company_base = Currency.compute(line.invoice.currency,
-                        base, line.invoice.company.currency, round=True)
-                    company_amount = Currency.compute(line.invoice.currency,
-                        amount, line.invoice.company.currency, round=True)
+                company_base = compute(line.invoice.currency, base,
+                    line.invoice.company.currency, line.invoice.currency_date)
+                company_amount = compute(line.invoice.currency, amount,
+                    line.invoice.company.currency, line.invoice.currency_date)
                 if fake_line is None:
+                    invoice = line.invoice
                     account = (tax.invoice_account if line.amount >= 0
                         else tax.credit_note_account)
-                    fake_line = AccountInvoiceTax()
-                    fake_line.invoice = line.invoice
-                    fake_line.account = account
-                    fake_line.tax = fake_key
-                    fake_line.base = base
-                    fake_line.amount = amount
-                    fake_line.currency = line.invoice.currency
-                    # Synthetic lines are not stored, so function fields must
-                    # be initialized explicitly instead of relying on lazy load.
-                    fake_line.company_base = company_base
-                    fake_line.company_amount = company_amount
-                    fake_line.company_base_cache = company_base
-                    fake_line.company_amount_cache = company_amount
+                    tax_identifier = (invoice.party_tax_identifier
+                        or invoice.party.tax_identifier)
+                    fake_line = TaxRow(invoice=invoice.id,
+                        state=invoice.state, number=invoice.number,
+                        invoice_date=invoice.invoice_date,
+                        move_date=invoice.move.date,
+                        account_code=account.code if account else None,
+                        party=invoice.party.rec_name,
+                        tax_identifier=(tax_identifier.code
+                            if tax_identifier else ''),
+                        tax_name=fake_key.name, company_base=company_base,
+                        company_amount=company_amount,
+                        company_total_amount=invoice.company_total_amount)
                     grouped_records[record_key] = fake_line
-                    records.setdefault(key, []).append(DualRecord(fake_line))
+                    records.setdefault(key, []).append(fake_line)
                 else:
-                    fake_line.base += base
-                    fake_line.amount += amount
                     fake_line.company_base += company_base
                     fake_line.company_amount += company_amount
-                    fake_line.company_base_cache += company_base
-                    fake_line.company_amount_cache += company_amount
 
                 # If the invoice is cancelled, do not add its values to the
                 # totals
@@ -493,19 +732,44 @@ class TaxesByInvoiceReport(DominateReport):
 
                 # With this we have the total for each tax (total base, total
                 # amount and total)
-                tax_totals.setdefault(key, {
-                        'total_untaxed': 0,
-                        'total_tax': 0,
-                        'total': 0})
-                tax_totals[key]['total_untaxed'] += company_base
-                tax_totals[key]['total'] += company_base + company_amount
-
-        parameters['totals'] = totals
-        parameters['tax_totals'] = tax_totals
+                tax_totals_ = get_tax_totals(key)
+                tax_totals_.add('total_untaxed', company_base)
+                tax_totals_.add('total', company_base)
+                tax_totals_.add('total', company_amount)
+
+        parameters['totals'] = totals.to_dict()
+        parameters['tax_totals'] = {k: t.to_dict()
+            for k, t in tax_totals.items()}
         return records, parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the invoice taxes to estimate the cost'
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Party = pool.get('party.party')
+        Period = pool.get('account.period')
+        start_date = data.get('start_date')
+        end_date = data.get('end_date')
+        periods = []
+        if data.get('periods'):
+            periods = Period.browse(data['periods'])
+        elif not start_date and not end_date and data.get('fiscalyear'):
+            periods = Period.search([
+                    ('fiscalyear', '=', data['fiscalyear']),
+                    ])
+        return cls._get_invoice_taxes_query(data, periods,
+            Party.browse(data.get('parties', [])),
+            Party.browse(data.get('excluded_parties', [])),
+            start_date, end_date)
+
     @classmethod
     def execute(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Execution = pool.get('account_reports.execution')
+
+        start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             records, parameters = cls.prepare(data)
 
@@ -515,13 +779,18 @@ class TaxesByInvoiceReport(DominateReport):
             parameters['records_found'] = False
             records['no_records'] = ''
 
-        return super(TaxesByInvoiceReport, cls).execute([], {
+        result = super(TaxesByInvoiceReport, cls).execute([], {
             'name': 'account_reports.taxes_by_invoice',
             'model': 'account.invoice.tax',
             'records': records,
             'parameters': parameters,
             'output_format': data.get('output_format', 'pdf'),
             })
+        if data.get('company'):
+            Execution.log(cls.__name__, Company(data['company']),
+                data.get('estimated_rows'),
+                (datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def header(cls, action, data, records):
@@ -597,37 +866,30 @@ class TaxesByInvoiceReport(DominateReport):
         row.add(cell)
 
     @classmethod
-    def show_detail_lines(cls, record_lines):
+    def show_detail_lines(cls, record_lines, currency_digits):
         rows = []
         before_invoice_id = None
         for line in record_lines:
-            currency_digits = line.invoice.company.currency.raw.digits
-            total = line.raw.company_base + line.raw.company_amount
-            if before_invoice_id != line.invoice.raw.id:
-                row = tr(cls='grey' if line.invoice.raw.state == 'cancelled' else '')
-                cls._cell(row, line.invoice.move.render.date)
-                cls._cell(row, line.account.render.code)
-                cls._cell(row, line.invoice.party.render.rec_name,
+            base = line.company_base or 0
+            amount = line.company_amount or 0
+            total = base + amount
+            if before_invoice_id != line.invoice:
+                row = tr(cls='grey' if line.state == 'cancelled' else '')
+                cls._cell(row, html_render(line.move_date))
+                cls._cell(row, line.account_code or '')
+                cls._cell(row, line.party,
                     style_value='text-align: left;')
-                tax_id = (line.invoice.party_tax_identifier
-                    and line.invoice.party_tax_identifier.render.code) or (
-                    line.invoice.party.tax_identifier
-                    and line.invoice.party.tax_identifier.render.code) or ''
-                cls._cell(row, tax_id)
+                cls._cell(row, line.tax_identifier)
                 number = '%s%s' % (
-                    '*' if line.invoice.raw.state == 'cancelled' else '',
-                    line.invoice.render.number)
+                    '*' if line.state == 'cancelled' else '',
+                    line.number or '')
                 cls._cell(row, number, cls_name='no-wrap')
-                cls._cell(row, line.invoice.render.invoice_date,
+                cls._cell(row, html_render(line.invoice_date),
                     cls_name='no-wrap')
-                base = (line.raw.company_base
-                    if line.render.base else 0.0)
                 cls._cell(row, html_render(base, digits=currency_digits),
                     style_value='text-align: right;')
-                cls._cell(row, line.tax.raw.name if line.tax else ' --- ',
+                cls._cell(row, line.tax_name or ' --- ',
                     cls_name='no-wrap')
-                amount = (line.raw.company_amount
-                    if line.render.amount else 0.0)
                 cls._cell(row, html_render(amount, digits=currency_digits),
                     style_value='text-align: right;',
                     cls_name='no-wrap')
@@ -635,7 +897,7 @@ class TaxesByInvoiceReport(DominateReport):
                     style_value='text-align: right;',
                     cls_name='no-wrap')
                 cls._cell(row,
-                    html_render(line.invoice.raw.company_total_amount,
+                    html_render(line.company_total_amount,
                         digits=currency_digits),
                     style_value='text-align: right;',
                     cls_name='bold no-wrap')
@@ -643,19 +905,15 @@ class TaxesByInvoiceReport(DominateReport):
                 row = tr()
                 for _idx in range(6):
                     cls._cell(row, '')
-                base = (line.raw.company_base
-                    if line.render.base else 0.0)
                 cls._cell(row, html_render(base, digits=currency_digits))
-                cls._cell(row, line.tax.raw.name if line.tax else ' --- ')
-                amount = (line.raw.company_amount
-                    if line.render.amount else 0.0)
+                cls._cell(row, line.tax_name or ' --- ')
                 cls._cell(row, html_render(amount, digits=currency_digits),
                     style_value='text-align: right;',
                     cls_name='no-wrap')
                 cls._cell(row, html_render(total, digits=currency_digits),
                     style_value='text-align: right;',
                     cls_name='no-wrap')
-            before_invoice_id = line.invoice.raw.id
+            before_invoice_id = line.invoice
             rows.append(row)
         return rows
 
@@ -686,7 +944,7 @@ class TaxesByInvoiceReport(DominateReport):
                         colspan=11)
                 currency_digits = key.company.currency.digits
                 if not data['parameters']['totals_only']:
-                    cls.show_detail_lines(record_lines)
+                    cls.show_detail_lines(record_lines, currency_digits)
                 if data['parameters']['tax_totals'].get(key):
                     total_row = tr(cls='bold')
                     cls._cell(total_row,
@@ -761,6 +1019,11 @@ class TaxesByInvoiceXlsxReport(XlsxReport, metaclass=PoolMeta):
 
     @classmethod
     def get_content(cls, ids, data):
+        pool = Pool()
+        Company = pool.get('company.company')
+        Execution = pool.get('account_reports.execution')
+
+        start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             records, parameters = TaxesByInvoiceReport.prepare(data)
 
@@ -771,7 +1034,12 @@ class TaxesByInvoiceXlsxReport(XlsxReport, metaclass=PoolMeta):
         context = cls._xlsx_context()
 
         with Transaction().set_context(**context):
-            return cls._build_workbook(records, parameters)
+            content = cls._build_workbook(records, parameters)
+        if data.get('company'):
+            Execution.log(cls.__name__, Company(data['company']),
+                data.get('estimated_rows'),
+                (datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
@@ -855,31 +1123,25 @@ class TaxesByInvoiceXlsxReport(XlsxReport, metaclass=PoolMeta):
             if not parameters['totals_only']:
                 before_invoice_id = None
                 for line in record_lines:
-                    total = line.raw.company_base + line.raw.company_amount
-                    base = (line.raw.company_base
-                        if line.render.base else 0.0)
-                    amount = (line.raw.company_amount
-                        if line.render.amount else 0.0)
-                    if before_invoice_id != line.invoice.raw.id:
-                        tax_id = (line.invoice.party_tax_identifier
-                            and line.invoice.party_tax_identifier.render.code) or (
-                            line.invoice.party.tax_identifier
-                            and line.invoice.party.tax_identifier.render.code) or ''
+                    base = line.company_base or 0
+                    amount = line.company_amount or 0
+                    total = base + amount
+                    if before_invoice_id != line.invoice:
                         number = '%s%s' % (
-                            '*' if line.invoice.raw.state == 'cancelled' else '',
-                            line.invoice.render.number)
+                            '*' if line.state == 'cancelled' else '',
+                            line.number or '')
                         ws.append([
-                            line.invoice.move.render.date,
-                            line.account.render.code,
-                            line.invoice.party.render.rec_name,
-                            tax_id,
+                            html_render(line.move_date),
+                            line.account_code or '',
+                            line.party,
+                            line.tax_identifier,
                             number,
-                            line.invoice.render.invoice_date,
+                            html_render(line.invoice_date),
                             xls(base, digits=currency_digits),
-                            line.tax.raw.name if line.tax else ' --- ',
+                            line.tax_name or ' --- ',
                             xls(amount, digits=currency_digits),
                             xls(total, digits=currency_digits),
-                            xls(line.invoice.raw.company_total_amount,
+                            xls(line.company_total_amount,
                                 digits=currency_digits),
                             ])
                     else:
@@ -887,12 +1149,12 @@ class TaxesByInvoiceXlsxReport(XlsxReport, metaclass=PoolMeta):
                             [''] * 6
                             + [
                                 xls(base, digits=currency_digits),
-                                line.tax.raw.name if line.tax else ' --- ',
+                                line.tax_name or ' --- ',
                                 xls(amount, digits=currency_digits),
                                 xls(total, digits=currency_digits),
                                 '',
                                 ])
-                    before_invoice_id = line.invoice.raw.id
+                    before_invoice_id = line.invoice
 
             if parameters['tax_totals'].get(key):
                 total_label = ('Total Period' if parameters['grouping']
@@ -5,13 +5,22 @@
 from trytond.modules.company.tests import CompanyTestMixin
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
+import datetime
 from decimal import Decimal
+from dateutil.relativedelta import relativedelta
+from trytond import backend
+from trytond.exceptions import UserError, UserWarning
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.modules.company.tests import create_company, set_company
 from trytond.modules.account.tests import create_chart, get_fiscalyear
 from trytond.modules.account_invoice.tests import set_invoice_sequences
-from trytond.modules.account_reports.common import TimeoutChecker
+from trytond.modules.account_reports.common import (
+    BalanceRollup, CentsTotals, LedgerRow, MinorUnits, ReportContext,
+    TimeoutChecker, TimeoutException, date_ranges_domain, merge_date_ranges,
+    report_indexes_status)
+from trytond.modules.account_reports.invoice_payment_dates.\
+    invoice_payment_dates import InvoicePaymentDatesReport
 
 class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
     'Test AccountReports module'
@@ -29,6 +38,143 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         content = Report.get_content([], data)
         self.assertTrue(content)
 
+    def test_balance_rollup(self):
+        'Test BalanceRollup sums the accounts into their parents'
+        rollup = BalanceRollup({1: None, 2: 1, 3: 2, 4: 2, 5: 1}, 2)
+        rollup.add_amount(3, 0, Decimal('1.10'))
+        rollup.add_amount(4, 0, Decimal('2.05'))
+        rollup.add_amount(5, 1, Decimal('-0.30'))
+        rollup.add_cents(4, 1, 5)
+        rollup.add_amount(4, 1, 5)
+        rollup.rollup()
+        self.assertEqual(rollup.get(1), [Decimal('3.15'), Decimal('4.75')])
+        self.assertEqual(rollup.get(2), [Decimal('3.15'), Decimal('5.05')])
+        self.assertEqual(rollup.get(3), [Decimal('1.10'), Decimal(0)])
+        self.assertEqual(rollup.get_cents(4), [205, 505])
+
+    def test_ledger_row(self):
+        'Test LedgerRow is read like a dict and keeps only its slots'
+        row = LedgerRow(sequence=1, line=10, debit=Decimal('1.50'))
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEqual(row['debit'], Decimal('1.50'))
+        self.assertIsNone(row['credit'])
+        self.assertEqual(row.get('missing', 0), 0)
+        row['ref'] = 'INV/1'
+        self.assertEqual(row.ref, 'INV/1')
+        self.assertEqual(
+            LedgerRow.from_values(row.values()).values(), row.values())
+        with self.assertRaises(AttributeError):
+            row.missing = 0
+
+    def test_minor_units(self):
+        'Test amounts are summed exactly as integer minor units'
+        units = MinorUnits(2)
+        self.assertEqual(units.to_cents(Decimal('12.34')), 1234)
+        self.assertEqual(units.to_cents(None), 0)
+        self.assertEqual(units.amount(0.1 + 0.2), Decimal('0.30'))
+        self.assertEqual(str(units.to_decimal(0)), '0.00')
+
+        amounts = [Decimal('0.10'), Decimal('0.20'), Decimal('-0.05')] * 100
+        totals = CentsTotals(['debit', 'credit'], 2)
+        for amount in amounts:
+            totals.add('debit', amount)
+            totals.add('credit', float(amount))
+        self.assertEqual(totals['debit'], sum(amounts))
+        self.assertEqual(totals['credit'], sum(amounts))
+        self.assertEqual(totals.to_dict(), {
+                'debit': Decimal('25.00'),
+                'credit': Decimal('25.00'),
+                })
+
+    def test_merge_date_ranges(self):
+        'Test merge_date_ranges joins the contiguous periods'
+        class Period:
+            def __init__(self, month):
+                self.start_date = datetime.date(2024, month, 1)
+                self.end_date = (self.start_date
+                    + relativedelta(day=31))
+        periods = [Period(m) for m in (5, 1, 2, 3, 6)]
+        self.assertEqual(merge_date_ranges(periods), [
+                (datetime.date(2024, 1, 1), datetime.date(2024, 3, 31)),
+                (datetime.date(2024, 5, 1), datetime.date(2024, 6, 30)),
+                ])
+        self.assertEqual(merge_date_ranges([]), [])
+        self.assertEqual(
+            date_ranges_domain('date', merge_date_ranges(periods)), ['OR',
+                [('date', '>=', datetime.date(2024, 1, 1)),
+                    ('date', '<=', datetime.date(2024, 3, 31))],
+                [('date', '>=', datetime.date(2024, 5, 1)),
+                    ('date', '<=', datetime.date(2024, 6, 30))],
+                ])
+
+    @with_transaction()
+    def test_report_indexes(self):
+        'Test the indexes of the reports are created'
+        status = report_indexes_status()
+        self.assertTrue(status)
+        for table, name, state in status:
+            self.assertNotEqual(state, 'missing', msg=name)
+
+    def test_invoice_payment_analytics(self):
+        'Test the payment analytics of invoice payment dates'
+        def record(party, days, amount, late):
+            due_date = datetime.date(2024, 1, 31)
+            payment_date = due_date + datetime.timedelta(
+                days=1 if late else -1)
+            return {
+                'party': party,
+                'payment_type': '30 days',
+                'due_date': due_date,
+                'due_amount': Decimal(amount),
+                'company_amount': Decimal(amount),
+                'payment_date': payment_date,
+                'payment_days': days,
+                'currency_digits': 2,
+                }
+        records = [
+            record('A', 10, 100, False),
+            record('A', 30, 300, True),
+            record('B', 20, 100, False),
+            ]
+        unpaid = record('B', '', 50, False)
+        unpaid['payment_date'] = None
+        records.append(unpaid)
+
+        analytics = InvoicePaymentDatesReport._get_payment_analytics(records,
+            date=datetime.date(2024, 1, 31))
+        party_a, party_b = analytics['parties']
+        self.assertEqual(party_a['name'], 'A')
+        self.assertEqual(party_a['average_days'], Decimal(20))
+        self.assertEqual(party_a['weighted_days'], Decimal(25))
+        self.assertEqual(party_a['median_days'], Decimal(20))
+        self.assertEqual(party_a['late_ratio'], Decimal('0.5'))
+        self.assertEqual(party_b['count'], 2)
+        self.assertEqual(party_b['paid'], 1)
+        self.assertEqual(party_b['due_amount'], Decimal(150))
+        # The unpaid due date is not yet due
+        self.assertEqual(party_b['late_ratio'], Decimal(0))
+        payment_type, = analytics['payment_types']
+        self.assertEqual(payment_type['count'], 4)
+
+        # The unpaid due dates past due are late
+        analytics = InvoicePaymentDatesReport._get_payment_analytics(records,
+            date=datetime.date(2024, 2, 1))
+        party_a, party_b = analytics['parties']
+        self.assertEqual(party_a['late_ratio'], Decimal('0.5'))
+        self.assertEqual(party_b['late_ratio'], Decimal('0.5'))
+
+        # The invoices in another currency are summed in company currency
+        foreign = record('C', 10, 200, False)
+        foreign['company_amount'] = Decimal(100)
+        foreign['currency_digits'] = 0
+        analytics = InvoicePaymentDatesReport._get_payment_analytics(
+            [foreign, record('C', 40, 100, False)], 2,
+            datetime.date(2024, 1, 31))
+        party_c, = analytics['parties']
+        self.assertEqual(party_c['due_amount'], Decimal(200))
+        self.assertEqual(party_c['weighted_days'], Decimal(25))
+        self.assertEqual(party_c['currency_digits'], 2)
+
     def create_fiscalyear_and_chart(self, company=None, fiscalyear=None,
             chart=True):
         'Test fiscalyear'
@@ -269,11 +415,172 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         expense.save()
         return fiscalyear
 
+    @with_transaction()
+    def test_balance_checkpoint(self):
+        'Test the balances read from a fiscal year checkpoint'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        BalanceCheckpoint = pool.get('account_reports.balance_checkpoint')
+
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        date = fiscalyear.end_date
+        accounts = Account.search([('company', '=', company.id)])
+        with Transaction().set_context(date=date):
+            values = Account.html_read_account_vals(accounts, company)
+            party_values = Party.html_get_account_values_by_party(
+                [], [], company)
+        self.assertTrue(values)
+        self.assertTrue(party_values)
+
+        BalanceCheckpoint.build([fiscalyear])
+        self.assertEqual(
+            BalanceCheckpoint.get_checkpoint(company, date)[0], fiscalyear.id)
+        with Transaction().set_context(date=date):
+            self.assertEqual(
+                Account.html_read_account_vals(accounts, company), values)
+            self.assertEqual(
+                Party.html_get_account_values_by_party([], [], company),
+                party_values)
+
+        BalanceCheckpoint.clear([fiscalyear])
+        self.assertIsNone(BalanceCheckpoint.get_checkpoint(company, date))
+
+    @with_transaction()
+    def test_account_vals_by_digits(self):
+        'Test the final accounts values grouped by digits'
+        pool = Pool()
+        Account = pool.get('account.account')
+
+        company = create_company()
+        self.create_moves(company)
+        accounts = self.get_accounts(company)
+        all_accounts = Account.search([('company', '=', company.id)])
+        final_ids = sorted(a.id for a in all_accounts if not a.childs)
+        self.assertEqual(sorted(
+                Account.html_get_final_account_ids(all_accounts, company)),
+            final_ids)
+        self.assertEqual(sorted(
+                Account.html_get_final_account_ids([], company)), final_ids)
+
+        receivable = accounts['receivable']
+        values = Account.html_read_account_vals_by_digits(
+            all_accounts, company, len(receivable.code))
+        self.assertEqual(values[receivable.code]['type'], 'receivable')
+        # The group takes the type of its first final account by code
+        values = Account.html_read_account_vals_by_digits(
+            all_accounts, company, 1)
+        first = min((a for a in all_accounts if not a.childs and a.code
+                    and a.code[:1] == receivable.code[:1]),
+            key=lambda a: a.code)
+        kind = 'other'
+        if first.type and first.type.receivable:
+            kind = 'receivable'
+        elif first.type and first.type.payable:
+            kind = 'payable'
+        self.assertEqual(values[receivable.code[:1]]['type'], kind)
+
+    @with_transaction()
+    def test_report_execution(self):
+        'Test the estimates calibrated with the previous executions'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        GeneralLedgerReport = pool.get(
+            'account_reports.general_ledger', type='report')
+        report = GeneralLedgerReport.__name__
+
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        data = {
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            'start_period': None,
+            'end_period': None,
+            'accounts': [],
+            'parties': [],
+            }
+        # Only PostgreSQL estimates the rows without running the query
+        def assert_estimate(query):
+            rows = Execution.estimate_rows(query)
+            if backend.name == 'postgresql':
+                self.assertIsInstance(rows, int)
+            else:
+                self.assertIsNone(rows)
+
+        assert_estimate(GeneralLedgerReport.get_estimate_query(data))
+
+        # The other wizards estimate their reports the same way
+        JournalReport = pool.get('account_reports.journal', type='report')
+        TrialBalanceReport = pool.get(
+            'account_reports.trial_balance', type='report')
+        TaxesByInvoiceReport = pool.get(
+            'account_reports.taxes_by_invoice', type='report')
+        AbreviatedJournalReport = pool.get(
+            'account_reports.abreviated_journal', type='report')
+        assert_estimate(JournalReport.get_estimate_query(
+                dict(data, journals=[])))
+        assert_estimate(TrialBalanceReport.get_estimate_query(data))
+        assert_estimate(TaxesByInvoiceReport.get_estimate_query(dict(data,
+                    start_date=None, end_date=None, periods=[],
+                    excluded_parties=[], partner_type='customers',
+                    tax_type='all', taxes=[])))
+        assert_estimate(AbreviatedJournalReport.get_estimate_query(data))
+        assert_estimate(InvoicePaymentDatesReport.get_estimate_query(
+                dict(data, start_date=None, end_date=None, periods=[],
+                    invoice_type='out')))
+        Execution.check(report, company, None, 30)
+
+        self.assertIsNone(Execution.seconds_per_row(report, company))
+        Execution.check(report, company, 10 ** 6, 30)
+
+        Execution.log(report, company, 100, 2.)
+        Execution.log(report, company, 300, 6.)
+        self.assertEqual(Execution.seconds_per_row(report, company), 0.02)
+        Execution.check(report, company, 1000, 30)
+        with self.assertRaises(UserWarning):
+            Execution.check(report, company, 2000, 30)
+
+    @with_transaction()
+    def test_report_context(self):
+        'Test the lookup maps shared by the helpers of a report'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        receivable, = Account.search([
+                ('company', '=', company.id),
+                ('type.receivable', '=', True),
+                ])
+        party, = Party.search([], limit=1)
+
+        lookup = ReportContext()
+        account, = lookup.accounts_with_parents([receivable.id])
+        self.assertEqual(account.kind, 'receivable')
+        self.assertEqual(account.code, receivable.code)
+        self.assertEqual(account.parent, receivable.parent.id)
+        self.assertIs(lookup.account(receivable), account)
+        self.assertEqual(lookup.account(account.parent).code,
+            receivable.parent.code)
+        self.assertEqual(lookup.accounts([None, receivable.id]),
+            [None, account])
+        self.assertIsNone(lookup.party(None))
+        self.assertEqual(lookup.party(party.id).name, party.name)
+
+        periods = lookup.get_periods(fiscalyear, None, None)
+        self.assertEqual(periods, fiscalyear.get_periods(None, None))
+        self.assertIs(lookup.get_periods(fiscalyear, None, None), periods)
+        self.assertEqual(lookup.period(periods[-1]).end_date,
+            periods[-1].end_date)
+
     @with_transaction()
     def test_general_ledger(self):
         'Test General Ledger'
         pool = Pool()
         Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
         PrintGeneralLedger = pool.get(
             'account_reports.print_general_ledger', type='wizard')
         GeneralLedgerReport = pool.get(
@@ -297,6 +604,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
         _, data = print_general_ledger.do_print_(None)
@@ -326,14 +634,36 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         credit = sum([line['credit'] for k, m in records.items() for line in m['lines']])
         debit = sum([line['debit'] for k, m in records.items() for line in m['lines']])
         self.assertEqual(credit, debit)
+        sections = GeneralLedgerReport.sections({'records': records})
+        self.assertEqual(
+            [k for section in sections for k in section], list(records))
+        self.assertTrue(all(
+                len({k[0][:1] for k in section}) == 1 for section in sections))
         self.assertEqual(credit, Decimal('730.0'))
-        with_party = [line for k, m in records.items() for line in m['lines'] if not line['line'].party]
+        with_party = [line for k, m in records.items() for line in m['lines'] if not Line(line['line']).party]
         self.assertEqual(len(with_party), 6)
-        dates = sorted(set([line['line'].date for k, m in records.items() for line in m['lines']]))
+        dates = sorted(set([line['date'] for k, m in records.items() for line in m['lines']]))
         for date, expected_value in zip(dates, [period.start_date,
                     last_period.end_date]):
             self.assertEqual(date, expected_value)
 
+        # The second incremental run reuses the snapshot of the first one
+        Snapshot = pool.get('account_reports.general_ledger.snapshot')
+        data_incremental = data.copy()
+        data_incremental['incremental'] = True
+        for i in range(2):
+            incremental_records, incremental_parameters = (
+                GeneralLedgerReport.prepare(data_incremental, checker))
+            self.assertEqual(incremental_parameters['accounts'], '')
+            self.assertEqual(list(incremental_records), list(records))
+            for key, record in records.items():
+                self.assertEqual(
+                    [l['line'] for l in incremental_records[key]['lines']],
+                    [l['line'] for l in record['lines']])
+                self.assertEqual(incremental_records[key]['total_debit'],
+                    record['total_debit'])
+        self.assertEqual(Snapshot.search([], count=True), 1)
+
         # Filtered by periods
         session_id, _, _ = PrintGeneralLedger.create()
         print_general_ledger = PrintGeneralLedger(session_id)
@@ -347,6 +677,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.accounts = []
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
@@ -357,7 +688,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         debit = sum([line['debit'] for k, m in records.items() for line in m['lines']])
         self.assertEqual(credit, debit)
         self.assertEqual(credit, Decimal('380.0'))
-        dates = sorted(set([line['line'].date for k, m in records.items() for line in m['lines']]))
+        dates = sorted(set([line['date'] for k, m in records.items() for line in m['lines']]))
         for date in dates:
             self.assertEqual(date, period.start_date)
 
@@ -374,6 +705,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.accounts = []
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
@@ -384,7 +716,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         debit = sum([line['debit'] for k, m in records.items() for line in m['lines']])
         self.assertEqual(credit, debit)
         self.assertEqual(credit, Decimal('380.0'))
-        dates = sorted(set([line['line'].date for k, m in records.items() for line in m['lines']]))
+        dates = sorted(set([line['date'] for k, m in records.items() for line in m['lines']]))
         for date in dates:
             self.assertEqual(date, period.start_date)
 
@@ -405,6 +737,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.accounts = [e.id for e in expenses]
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
@@ -431,6 +764,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.accounts = []
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
@@ -446,7 +780,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         debit = sum([line['debit'] for k, m in records.items() for line in m['lines'] if m['party'] == ''])
         self.assertEqual(credit, Decimal(0))
         self.assertEqual(debit, Decimal(0))
-        parties = [line for k, m in records.items() for line in m['lines'] if not line['line'].party]
+        parties = [line for k, m in records.items() for line in m['lines'] if not Line(line['line']).party]
         self.assertEqual(len(parties), 0)
 
         # Filter by parties and accounts
@@ -467,6 +801,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_general_ledger.start.output_format = 'pdf'
         print_general_ledger.start.all_accounts = False
         print_general_ledger.start.show_description = True
+        print_general_ledger.start.incremental = False
         print_general_ledger.start.timeout = 30
         checker = TimeoutChecker(print_general_ledger.start.timeout, GeneralLedgerReport.timeout_exception)
         _, data = print_general_ledger.do_print_(None)
@@ -475,7 +810,113 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertEqual(parameters['accounts'], ', '.join([r.code for r in receivables]))
         self.assertEqual(len(records), 1)
         credit = sum([line['credit'] for k, m in records.items() for line in m['lines']])
-        self.assertEqual(True, all([line for k, m in records.items() for line in m['lines'] if line['line'].party]))
+        self.assertEqual(True, all([line for k, m in records.items() for line in m['lines'] if Line(line['line']).party]))
+
+    @with_transaction()
+    def test_general_ledger_incremental_accounts(self):
+        'Test the incremental general ledger keeps the accounts filter'
+        pool = Pool()
+        Move = pool.get('account.move')
+        GeneralLedgerReport = pool.get('account_reports.general_ledger',
+            type='report')
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        period = fiscalyear.periods[0]
+        accounts = self.get_accounts(company)
+        revenue = accounts['revenue']
+        expense = accounts['expense']
+        data = {
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            'start_period': None,
+            'end_period': None,
+            'start_date': None,
+            'end_date': None,
+            'accounts': [revenue.id],
+            'all_accounts': False,
+            'parties': [],
+            'output_format': 'pdf',
+            'timeout': 30,
+            'show_description': True,
+            'incremental': True,
+            }
+        checker = TimeoutChecker(30, GeneralLedgerReport.timeout_exception)
+        records, _ = GeneralLedgerReport.prepare(data, checker)
+        key, = records
+        self.assertEqual(key[0], revenue.code)
+
+        # A move on the filtered account and on another account
+        with set_company(company):
+            Move.create([{
+                        'company': company.id,
+                        'period': period.id,
+                        'journal': self.get_journals()['EXP'].id,
+                        'date': period.start_date,
+                        'lines': [('create', [{
+                                        'account': expense.id,
+                                        'debit': Decimal(10),
+                                        }, {
+                                        'account': revenue.id,
+                                        'credit': Decimal(10),
+                                        }])],
+                        }])
+        refreshed, _ = GeneralLedgerReport.prepare(data, checker)
+        self.assertEqual(list(refreshed), [key])
+        self.assertEqual(len(refreshed[key]['lines']),
+            len(records[key]['lines']) + 1)
+        self.assertEqual(refreshed[key]['total_credit'],
+            records[key]['total_credit'] + Decimal(10))
+        sequences = [l['sequence'] for r in refreshed.values()
+            for l in r['lines']]
+        self.assertEqual(len(set(sequences)), len(sequences))
+
+    @with_transaction()
+    def test_general_ledger_incremental_late_commit(self):
+        'Test the incremental general ledger reads the lines committed late'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Snapshot = pool.get('account_reports.general_ledger.snapshot')
+        GeneralLedgerReport = pool.get('account_reports.general_ledger',
+            type='report')
+        line_table = Line.__table__()
+        cursor = Transaction().connection.cursor()
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        revenue = self.get_accounts(company)['revenue']
+        data = {
+            'company': company.id,
+            'fiscalyear': fiscalyear.id,
+            'start_period': None,
+            'end_period': None,
+            'start_date': None,
+            'end_date': None,
+            'accounts': [revenue.id],
+            'all_accounts': False,
+            'parties': [],
+            'output_format': 'pdf',
+            'timeout': 30,
+            'show_description': True,
+            'incremental': True,
+            }
+        checker = TimeoutChecker(30, GeneralLedgerReport.timeout_exception)
+        records, _ = GeneralLedgerReport.prepare(data, checker)
+        key, = records
+        snapshot, = Snapshot.search([])
+
+        # A line modified by a transaction started before the snapshot keeps
+        # its id and gets a write date older than the watermark
+        line, = Line.search([
+                ('account', '=', revenue.id),
+                ('credit', '>', 0),
+                ], limit=1)
+        cursor.execute(*line_table.update(
+                [line_table.credit, line_table.write_date],
+                [line.credit + Decimal(5),
+                    snapshot.watermark - datetime.timedelta(minutes=1)],
+                where=line_table.id == line.id))
+        refreshed, _ = GeneralLedgerReport.prepare(data, checker)
+        self.assertEqual(refreshed[key]['total_credit'],
+            records[key]['total_credit'] + Decimal(5))
 
     @with_transaction()
     def test_trial_balance_render(self):
@@ -501,6 +942,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_trial_balance.start.comparison_fiscalyear = None
         print_trial_balance.start.comparison_start_period = None
         print_trial_balance.start.comparison_end_period = None
+        print_trial_balance.start.comparison_fiscalyears = []
         print_trial_balance.start.show_digits = 0
         print_trial_balance.start.only_moves = False
         print_trial_balance.start.moves_or_initial = False
@@ -545,6 +987,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_trial_balance.start.comparison_fiscalyear = None
         print_trial_balance.start.comparison_start_period = None
         print_trial_balance.start.comparison_end_period = None
+        print_trial_balance.start.comparison_fiscalyears = []
         print_trial_balance.start.show_digits = 0
         print_trial_balance.start.only_moves = False
         print_trial_balance.start.moves_or_initial = False
@@ -600,6 +1043,7 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_trial_balance.start.comparison_fiscalyear = None
         print_trial_balance.start.comparison_start_period = None
         print_trial_balance.start.comparison_end_period = None
+        print_trial_balance.start.comparison_fiscalyears = []
         print_trial_balance.start.show_digits = 0
         print_trial_balance.start.only_moves = False
         print_trial_balance.start.moves_or_initial = False
@@ -625,6 +1069,103 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         }
         self.assertEqual(party_names, {'customer1', 'supplier1'})
 
+    @with_transaction()
+    def test_trial_balance_comparative(self):
+        'Test Trial Balance with several comparison fiscal years'
+        pool = Pool()
+        PrintTrialBalance = pool.get(
+            'account_reports.print_trial_balance', type='wizard')
+        TrialBalanceReport = pool.get(
+            'account_reports.trial_balance', type='report')
+        TrialBalanceXlsxReport = pool.get(
+            'account_reports.trial_balance_xlsx', type='report')
+        FiscalYear = pool.get('account.fiscalyear')
+        Account = pool.get('account.account')
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        with set_company(company):
+            next_fiscalyear = set_invoice_sequences(get_fiscalyear(company,
+                    today=fiscalyear.end_date + relativedelta(days=1)))
+            next_fiscalyear.save()
+            FiscalYear.create_period([next_fiscalyear])
+        with Transaction().set_context(active_test=False):
+            Account.write(Account.search([
+                        ('type.expense', '=', True),
+                        ('company', '=', company.id),
+                        ]), {'active': True})
+        self.create_moves(company, next_fiscalyear, create_chart=False)
+        accounts = self.get_accounts(company)
+
+        session_id, _, _ = PrintTrialBalance.create()
+        print_trial_balance = PrintTrialBalance(session_id)
+        print_trial_balance.start.company = company
+        print_trial_balance.start.fiscalyear = next_fiscalyear
+        print_trial_balance.start.start_period = next_fiscalyear.periods[0]
+        print_trial_balance.start.end_period = next_fiscalyear.periods[-1]
+        print_trial_balance.start.comparison_fiscalyear = None
+        print_trial_balance.start.comparison_start_period = None
+        print_trial_balance.start.comparison_end_period = None
+        print_trial_balance.start.comparison_fiscalyears = [fiscalyear.id]
+        print_trial_balance.start.show_digits = 0
+        print_trial_balance.start.only_moves = True
+        print_trial_balance.start.moves_or_initial = False
+        print_trial_balance.start.hide_split_parties = False
+        print_trial_balance.start.split_parties = False
+        print_trial_balance.start.add_initial_balance = True
+        print_trial_balance.start.accounts = []
+        print_trial_balance.start.parties = []
+        print_trial_balance.start.output_format = 'pdf'
+        print_trial_balance.start.timeout = 30
+
+        _, data = print_trial_balance.do_print_(None)
+        self.assertEqual([w['name'] for w in data['comparison_windows']],
+            [fiscalyear.name, next_fiscalyear.name])
+        self.assert_report_rendered(TrialBalanceReport, data, 'pdf')
+        data_xlsx = data.copy()
+        data_xlsx['output_format'] = 'xlsx'
+        self.assert_xlsx_report_rendered(TrialBalanceXlsxReport, data_xlsx)
+
+        checker = TimeoutChecker(30, TrialBalanceReport.timeout_exception)
+        records, parameters = TrialBalanceReport.prepare(data, checker)
+        balances = {r['code']: [c['balance'] for c in r['columns']]
+            for r in records}
+        self.assertEqual(balances[accounts['receivable'].code],
+            [Decimal(600), Decimal(1200)])
+        self.assertEqual(balances[accounts['payable'].code],
+            [Decimal(-130), Decimal(-260)])
+
+        # The comparison fiscal years take the same range of periods
+        print_trial_balance.start.end_period = next_fiscalyear.periods[0]
+        _, data = print_trial_balance.do_print_(None)
+        self.assertEqual(
+            [(w['start_period'], w['end_period'])
+                for w in data['comparison_windows']],
+            [(fiscalyear.periods[0].id, fiscalyear.periods[0].id),
+                (next_fiscalyear.periods[0].id,
+                    next_fiscalyear.periods[0].id)])
+        records, parameters = TrialBalanceReport.prepare(data, checker)
+        balances = {r['code']: [c['balance'] for c in r['columns']]
+            for r in records}
+        self.assertEqual(balances[accounts['receivable'].code],
+            [Decimal(300), Decimal(900)])
+        # The header prints the windows instead of the main fiscal year
+        self.assertEqual(parameters['fiscalyear'], '')
+        self.assertEqual(parameters['windows'],
+            [fiscalyear.name, next_fiscalyear.name])
+
+        # The groups by digits are computed by the database
+        receivable_code = accounts['receivable'].code
+        records, _ = TrialBalanceReport.prepare(
+            dict(data, digits=len(receivable_code)), checker)
+        balances = {r['code']: [c['balance'] for c in r['columns']]
+            for r in records}
+        self.assertEqual(balances[receivable_code],
+            [Decimal(300), Decimal(900)])
+
+        print_trial_balance.start.split_parties = True
+        with self.assertRaises(UserError):
+            print_trial_balance.do_print_(None)
+
     @with_transaction()
     def test_taxes_by_invoice_render(self):
         'Test Taxes by Invoice rendering'
@@ -663,6 +1204,9 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         data_xlsx = data.copy()
         data_xlsx['output_format'] = 'xlsx'
         self.assert_xlsx_report_rendered(TaxesByInvoiceXlsxReport, data_xlsx)
+        data_totals = data.copy()
+        data_totals['totals_only'] = True
+        self.assert_report_rendered(TaxesByInvoiceReport, data_totals, 'pdf')
 
     @with_transaction()
     def test_open_move_lines(self):
@@ -758,6 +1302,8 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_open_move_lines.start.accounts = [receivable.id]
         print_open_move_lines.start.output_format = 'pdf'
         print_open_move_lines.start.show_description = True
+        print_open_move_lines.start.aging = False
+        print_open_move_lines.start.month_end_series = False
         print_open_move_lines.start.timeout = 30
         checker = TimeoutChecker(
             print_open_move_lines.start.timeout,
@@ -786,6 +1332,20 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertEqual(record['total_credit'], Decimal('0.0'))
         self.assertEqual(record['total_balance'], Decimal('100.0'))
 
+        data_aging = data.copy()
+        data_aging['aging'] = True
+        self.assert_report_rendered(OpenMoveLinesReport, data_aging, 'pdf')
+        data_aging_xlsx = data_aging.copy()
+        data_aging_xlsx['output_format'] = 'xlsx'
+        self.assert_xlsx_report_rendered(OpenMoveLinesXlsxReport,
+            data_aging_xlsx)
+        records, _ = OpenMoveLinesReport.prepare(data_aging, checker)
+        self.assertEqual(len(records), 1)
+        record = next(iter(records.values()))
+        self.assertEqual(record['party'], customer1.rec_name)
+        self.assertEqual(sum(record['buckets']), Decimal('100.0'))
+        self.assertEqual(record['total_balance'], Decimal('100.0'))
+
         session_id, _, _ = PrintOpenMoveLines.create()
         print_open_move_lines = PrintOpenMoveLines(session_id)
         print_open_move_lines.start.company = company
@@ -794,6 +1354,8 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_open_move_lines.start.accounts = [receivable.id]
         print_open_move_lines.start.output_format = 'pdf'
         print_open_move_lines.start.show_description = True
+        print_open_move_lines.start.aging = False
+        print_open_move_lines.start.month_end_series = False
         print_open_move_lines.start.timeout = 30
         checker = TimeoutChecker(
             print_open_move_lines.start.timeout,
@@ -809,6 +1371,93 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertEqual(record['total_credit'], Decimal('0.0'))
         self.assertEqual(record['total_balance'], Decimal('300.0'))
 
+        data_series = data.copy()
+        data_series['cutoff_dates'] = [period.end_date, last_period.end_date]
+        self.assert_report_rendered(OpenMoveLinesReport, data_series, 'pdf')
+        data_series_xlsx = data_series.copy()
+        data_series_xlsx['output_format'] = 'xlsx'
+        self.assert_xlsx_report_rendered(OpenMoveLinesXlsxReport,
+            data_series_xlsx)
+        records, parameters = OpenMoveLinesReport.prepare(data_series, checker)
+        self.assertEqual(len(parameters['cutoff_dates']), 2)
+        balances = {r['party']: r['balances'] for r in records.values()}
+        self.assertEqual(balances, {
+                customer1.rec_name: [Decimal('100.0'), Decimal('0.0')],
+                customer2.rec_name: [Decimal('0.0'), Decimal('300.0')],
+                })
+
+        self.assertEqual(PrintOpenMoveLines._month_end_dates(
+                datetime.date(2024, 3, 15)), [
+                datetime.date(2024, 1, 31),
+                datetime.date(2024, 2, 29),
+                datetime.date(2024, 3, 15),
+                ])
+
+    @with_transaction()
+    def test_open_move_lines_origin_party(self):
+        'Test Open Move Lines party of invoice tax origins'
+        pool = Pool()
+        Address = pool.get('party.address')
+        Invoice = pool.get('account.invoice')
+        InvoiceTax = pool.get('account.invoice.tax')
+        Move = pool.get('account.move')
+        OpenMoveLinesReport = pool.get(
+            'account_reports.open_move_lines', type='report')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        fiscalyear = self.create_moves(company)
+        period = fiscalyear.periods[0]
+        journals = self.get_journals()
+        accounts = self.get_accounts(company)
+        receivable = accounts['receivable']
+        customer1, customer2, _, _ = self.get_parties()
+
+        with set_company(company):
+            address, = Address.create([{'party': customer2.id}])
+            invoice, = Invoice.create([{
+                        'company': company.id,
+                        'type': 'out',
+                        'party': customer2.id,
+                        'invoice_address': address.id,
+                        'currency': company.currency.id,
+                        'account': receivable.id,
+                        }])
+            tax, = InvoiceTax.create([{
+                        'invoice': invoice.id,
+                        'description': 'VAT',
+                        'account': accounts['revenue'].id,
+                        'base': Decimal(100),
+                        'amount': Decimal(21),
+                        }])
+        move, = Move.create([{
+                    'company': company.id,
+                    'period': period.id,
+                    'journal': journals['REV'].id,
+                    'date': period.end_date,
+                    'lines': [
+                        ('create', [{
+                                    'account': accounts['revenue'].id,
+                                    'credit': Decimal(21),
+                                    }, {
+                                    'party': customer1.id,
+                                    'account': receivable.id,
+                                    'debit': Decimal(21),
+                                    'origin': str(tax),
+                                    }]),
+                        ],
+                    }])
+        line = next(l for l in move.lines if l.account == receivable)
+
+        query = OpenMoveLinesReport._get_open_lines_query(
+            company, period.end_date, [receivable], [])
+        cursor.execute(*query)
+        columns = [c[0] for c in cursor.description]
+        rows = {r['id']: r for r in (dict(zip(columns, r)) for r in cursor)}
+        self.assertEqual(rows[line.id]['party'], customer2.id)
+        self.assertEqual(rows[line.id]['origin_invoice'], invoice.id)
+        self.assertIsNone(rows[line.id]['invoice_line'])
+
     @with_transaction()
     def test_journal(self):
         'Test journal'
@@ -837,6 +1486,8 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_journal.start.open_close_account_moves = False
         print_journal.start.open_move_description = 'Open'
         print_journal.start.close_move_description = 'Close'
+        print_journal.start.totals_only = False
+        print_journal.start.timeout = 30
 
         _, data = print_journal.do_print_(None)
         self.assert_report_rendered(JournalReport, data, 'html')
@@ -865,6 +1516,30 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         self.assertEqual(credit, Decimal('730.0'))
         with_party = [m for m in records if m['party_name']]
         self.assertEqual(len(with_party), 6)
+        self.assertEqual(parameters['total_debit'], Decimal('730.0'))
+        self.assertEqual(parameters['total_credit'], Decimal('730.0'))
+        self.assertEqual(len(parameters['month_totals']), 2)
+        # The lines are checked against the timeout while they are fetched
+        self.assertEqual(data['timeout'], 30)
+        checker = TimeoutChecker(-1, JournalReport.timeout_exception)
+        with self.assertRaises(TimeoutException):
+            JournalReport.prepare(data, checker)
+        data_timeout = data.copy()
+        data_timeout['timeout'] = -1
+        with self.assertRaises(UserError):
+            JournalReport.execute([], data_timeout)
+        with self.assertRaises(UserError):
+            JournalXlsxReport.get_content([], data_timeout)
+        # Totals only
+        data_totals = data.copy()
+        data_totals['totals_only'] = True
+        records, parameters = JournalReport.prepare(data_totals)
+        self.assertEqual(records, [])
+        self.assertEqual(parameters['total_debit'], Decimal('730.0'))
+        self.assertEqual(
+            [t['debit'] for t in parameters['month_totals']],
+            [Decimal('380.0'), Decimal('350.0')])
+        self.assert_report_rendered(JournalReport, data_totals, 'html')
         # Filtering periods
         session_id, _, _ = PrintJournal.create()
         print_journal = PrintJournal(session_id)
@@ -877,6 +1552,8 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_journal.start.open_close_account_moves = False
         print_journal.start.open_move_description = 'Open'
         print_journal.start.close_move_description = 'Close'
+        print_journal.start.totals_only = False
+        print_journal.start.timeout = 30
 
         _, data = print_journal.do_print_(None)
         records, parameters = JournalReport.prepare(data)
@@ -900,6 +1577,8 @@ class AccountReportsTestCase(CompanyTestMixin, ModuleTestCase):
         print_journal.start.open_close_account_moves = False
         print_journal.start.open_move_description = 'Open'
         print_journal.start.close_move_description = 'Close'
+        print_journal.start.totals_only = False
+        print_journal.start.timeout = 30
         _, data = print_journal.do_print_(None)
         records, parameters = JournalReport.prepare(data)
         self.assertNotEqual(parameters['journals'], '')
@@ -103,10 +103,35 @@ class TestInvoicePaymentDates(unittest.TestCase):
         supplier_line.unit_price = Decimal('75')
         supplier_invoice.click('post')
 
+        # An unpaid invoice with a split payment term has one row per
+        # maturity
+        split_term = PaymentTerm(name='40% 10 days, remainder 30 days')
+        line = split_term.lines.new(type='percent', ratio=Decimal('.4'))
+        line.relativedeltas.new(days=10)
+        line = split_term.lines.new(type='remainder')
+        line.relativedeltas.new(days=30)
+        split_term.save()
+
+        split_invoice = Invoice()
+        split_invoice.company = company
+        split_invoice.currency = company.currency
+        split_invoice.account = receivable
+        split_invoice.type = 'out'
+        split_invoice.party = customer
+        split_invoice.invoice_date = today
+        split_invoice.payment_term = split_term
+        split_invoice.payment_term_date = today
+        split_line = split_invoice.lines.new()
+        split_line.account = revenue
+        split_line.quantity = 1
+        split_line.unit_price = Decimal('50')
+        split_invoice.click('post')
+
         customer_invoice = Invoice.find([
                 ('party', '=', customer.id),
                 ('type', '=', 'out'),
                 ('invoice_date', '=', today),
+                ('id', '!=', split_invoice.id),
                 ], limit=1)[0]
         supplier_invoice = Invoice.find([
                 ('party', '=', supplier.id),
@@ -203,21 +228,40 @@ class TestInvoicePaymentDates(unittest.TestCase):
             self.assertEqual(parameters['company'], company.rec_name)
             self.assertEqual(parameters['invoice_type'], 'Customer Invoices')
             self.assertEqual(parameters['periods'], period.rec_name)
-            self.assertEqual(len(records), 1)
+            self.assertEqual(len(records), 3)
             record = records[0]
             self.assertEqual(record['number'], customer_invoice.number)
             self.assertEqual(record['party'], customer_name)
-            self.assertEqual(record['invoice_date'], today.strftime('%d/%m/%Y'))
+            self.assertEqual(record['invoice_date'], today)
             self.assertEqual(record['state'], customer_invoice.state)
             self.assertEqual(record['payment_type'], payment_term_name)
             self.assertEqual(record['due_date'],
-                (today + relativedelta(days=15)).strftime('%d/%m/%Y'))
-            self.assertEqual(record['payment_date'],
-                customer_payment_date.strftime('%d/%m/%Y'))
+                today + relativedelta(days=15))
+            self.assertEqual(record['payment_date'], customer_payment_date)
             self.assertEqual(record['payment_days'], 20)
             self.assertEqual(record['total_amount'], customer_invoice.total_amount)
             self.assertEqual(record['due_amount'], customer_invoice.total_amount)
 
+            # The rows of the invoice move are read once, in maturity order
+            split_records = records[1:]
+            self.assertEqual(
+                [r['number'] for r in split_records],
+                [split_invoice.number] * 2)
+            self.assertEqual(
+                [r['due_date'] for r in split_records],
+                [today + relativedelta(days=10),
+                    today + relativedelta(days=30)])
+            self.assertEqual(
+                [r['due_amount'] for r in split_records],
+                [Decimal('20.00'), Decimal('30.00')])
+            self.assertEqual(
+                [r['payment_date'] for r in split_records], [None, None])
+            self.assertEqual(
+                [r['payment_days'] for r in split_records], ['', ''])
+            self.assertEqual(
+                InvoicePaymentDatesReport._format_date(record['due_date']),
+                (today + relativedelta(days=15)).strftime('%d/%m/%Y'))
+
             session_id, _, _ = PrintInvoicePaymentDates.create()
             print_invoice_payment_dates = PrintInvoicePaymentDates(session_id)
             print_invoice_payment_dates.start.company = company
@@ -244,8 +288,7 @@ class TestInvoicePaymentDates(unittest.TestCase):
             self.assertEqual(record['state'], supplier_invoice.state)
             self.assertEqual(record['payment_type'], payment_term_name)
             self.assertEqual(record['due_date'],
-                (today + relativedelta(days=15)).strftime('%d/%m/%Y'))
-            self.assertEqual(record['payment_date'],
-                supplier_payment_date.strftime('%d/%m/%Y'))
+                today + relativedelta(days=15))
+            self.assertEqual(record['payment_date'], supplier_payment_date)
             self.assertEqual(record['payment_days'], 25)
             self.assertEqual(record['due_amount'], supplier_invoice.total_amount)
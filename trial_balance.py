@@ -13,11 +13,11 @@ from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.modules.account.exceptions import FiscalYearNotFoundError
 from trytond.modules.account_reports.common import (
-    TimeoutException, TimeoutChecker, css as common_css)
+    BalanceRollup, CentsTotals, MinorUnits, ReportContext, TimeoutException,
+    TimeoutChecker, css as common_css, ids_in)
 from trytond.modules.account_reports.tools import vat_label
 from trytond.modules.account_reports.xlsx import (
     XlsxReport, save_workbook, convert_str_to_float)
-from collections import defaultdict
 from trytond.modules.html_report.dominate_report import DominateReport
 from trytond.modules.html_report.engine import render as html_render
 from trytond.modules.html_report.i18n import _
@@ -35,7 +35,17 @@ class PrintTrialBalanceStart(ModelView):
     fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
             required=True)
     comparison_fiscalyear = fields.Many2One('account.fiscalyear',
-            'Fiscal Year')
+            'Fiscal Year',
+        states={
+            'invisible': Bool(Eval('comparison_fiscalyears')),
+            })
+    comparison_fiscalyears = fields.Many2Many('account.fiscalyear', None,
+        None, 'Comparison Fiscal Years',
+        domain=[
+            ('company', '=', Eval('company', -1)),
+            ],
+        help='Print one balance column for the main fiscal year and for '
+        'each of these fiscal years, over the same range of periods.')
     show_digits = fields.Integer('Digits', required=True)
     only_moves = fields.Boolean('Only Accounts With Move',
         states={
@@ -50,8 +60,10 @@ class PrintTrialBalanceStart(ModelView):
     hide_split_parties = fields.Boolean('Hide Split Parties')
     split_parties = fields.Boolean('Split Parties',
         states={
-            'invisible': Bool(Eval('hide_split_parties', False))},
-            depends=['hide_split_parties'])
+            'invisible': (Bool(Eval('hide_split_parties', False))
+                | Bool(Eval('comparison_fiscalyears'))),
+            },
+            depends=['hide_split_parties', 'comparison_fiscalyears'])
     add_initial_balance = fields.Boolean('Add Initial Balance')
     parties = fields.Many2Many('party.party', None, None, 'Parties',
         states={
@@ -83,13 +95,19 @@ class PrintTrialBalanceStart(ModelView):
             ('fiscalyear', '=', Eval('comparison_fiscalyear')),
             ('start_date', '<=', (Eval('comparison_end_period'),
                     'start_date')),
-            ])
+            ],
+        states={
+            'invisible': Bool(Eval('comparison_fiscalyears')),
+            })
     comparison_end_period = fields.Many2One('account.period', 'End Period',
         domain=[
             ('fiscalyear', '=', Eval('comparison_fiscalyear')),
             ('start_date', '>=', (Eval('comparison_start_period'),
                     'start_date'))
-            ])
+            ],
+        states={
+            'invisible': Bool(Eval('comparison_fiscalyears')),
+            })
     output_format = fields.Selection([
             ('pdf', 'PDF'),
             ('html', 'HTML'),
@@ -201,6 +219,18 @@ class PrintTrialBalanceStart(ModelView):
         self.comparison_start_period = None
         self.comparison_end_period = None
 
+    @fields.depends('comparison_fiscalyears', 'split_parties', 'parties')
+    def on_change_comparison_fiscalyears(self):
+        # The comparative trial balance has neither a single comparison fiscal
+        # year nor split parties
+        if self.comparison_fiscalyears:
+            self.comparison_fiscalyear = None
+            self.comparison_start_period = None
+            self.comparison_end_period = None
+            self.split_parties = False
+            if self.parties:
+                self.parties = set()
+
     @classmethod
     def view_attributes(cls):
         return [('/form//label[@id="all_parties"]', 'states',
@@ -274,6 +304,33 @@ class PrintTrialBalance(Wizard):
             'output_format': self.start.output_format,
             'timeout': self.start.timeout,
             }
+        if self.start.comparison_fiscalyears:
+            if (self.start.split_parties
+                    or self.start.comparison_fiscalyear):
+                raise UserError(gettext(
+                        'account_reports.msg_comparative_fiscalyears'))
+            # The comparison fiscal years use the periods at the same
+            # position as the start and end periods of the main fiscal year
+            periods = list(self.start.fiscalyear.periods)
+            start_index = [p.id for p in periods].index(start_period)
+            end_index = [p.id for p in periods].index(end_period)
+            windows = [(self.start.fiscalyear, start_period, end_period)]
+            for fiscalyear in self.start.comparison_fiscalyears:
+                if (fiscalyear == self.start.fiscalyear
+                        or not fiscalyear.periods):
+                    continue
+                periods = fiscalyear.periods
+                windows.append((fiscalyear,
+                        periods[min(start_index, len(periods) - 1)].id,
+                        periods[min(end_index, len(periods) - 1)].id))
+            windows.sort(key=lambda x: x[0].start_date)
+            data['comparison_windows'] = [{
+                    'name': fiscalyear.name,
+                    'start_period': window_start_period,
+                    'end_period': window_end_period,
+                    } for fiscalyear, window_start_period, window_end_period
+                in windows]
+        self.check_estimate(data)
         if self.start.output_format == 'xlsx':
             ActionReport = Pool().get('ir.action.report')
             action_report, = ActionReport.search([
@@ -282,6 +339,20 @@ class PrintTrialBalance(Wizard):
             action = action_report.action.get_action_value()
         return action, data
 
+    def check_estimate(self, data):
+        'Estimate the lines of the report and warn if it may time out'
+        pool = Pool()
+        Execution = pool.get('account_reports.execution')
+        Report = pool.get('account_reports.trial_balance', type='report')
+        if self.start.output_format == 'xlsx':
+            report = 'account_reports.trial_balance_xlsx'
+        else:
+            report = Report.__name__
+        data['estimated_rows'] = Execution.estimate_rows(
+            Report.get_estimate_query(data))
+        Execution.check(report, self.start.company, data['estimated_rows'],
+            self.start.timeout)
+
     def transition_print_(self):
         return 'end'
 
@@ -339,6 +410,214 @@ class TrialBalanceReport(DominateReport):
                 side_margin)
         )
 
+    @classmethod
+    def _get_account_type(cls, account):
+        account_type = 'other'
+        if account.type and account.type.receivable:
+            account_type = 'receivable'
+        elif account.type and account.type.payable:
+            account_type = 'payable'
+        return account_type
+
+    @classmethod
+    def prepare_comparative(cls, data, checker):
+        '''
+        Compute the trial balance with one column for each window of periods
+        in data['comparison_windows'].
+
+        The values of all the windows, including their initial balances, are
+        obtained from a single scan of the moves grouped by period.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+        Account = pool.get('account.account')
+
+        fiscalyear = (FiscalYear(data['fiscalyear']) if data.get('fiscalyear')
+            else None)
+        if not fiscalyear:
+            raise UserError(gettext(
+                'account_reports.msg_missing_fiscalyear'))
+        if data.get('company'):
+            company = Company(data['company'])
+        else:
+            company = fiscalyear.company
+
+        lookup = ReportContext()
+        windows = []
+        for window in data['comparison_windows']:
+            start_period = Period(window['start_period'])
+            end_period = Period(window['end_period'])
+            window_fiscalyear = start_period.fiscalyear
+            windows.append({
+                    'name': window.get('name') or window_fiscalyear.name,
+                    'start_period': start_period,
+                    'end_period': end_period,
+                    'periods': {p.id for p in lookup.get_periods(
+                            window_fiscalyear, start_period, end_period)},
+                    })
+
+        digits = data.get('digits', None)
+        add_initial_balance = data.get('add_initial_balance', False)
+        with_moves = data.get('only_moves', False)
+        with_moves_or_initial = data.get('moves_or_initial', False)
+
+        with Transaction().set_context(active_test=False):
+            all_accounts = Account.search([
+                    ('company', '=', company),
+                    ('parent', '!=', None),
+                    ], order=[('code', 'ASC')])
+            parent_ids = {a.parent.id for a in all_accounts}
+            account_ids = data.get('accounts')
+            accounts = [a for a in all_accounts if a.id not in parent_ids
+                and (not account_ids or a.id in account_ids)]
+            accounts_subtitle = ''
+            if account_ids:
+                accounts_subtitle = ', '.join(a.code for a in accounts[:1])
+                if len(accounts) > 1:
+                    accounts_subtitle += ', ...'
+            period_end_dates = {p.id: p.end_date for p in Period.search([
+                        ('fiscalyear.company', '=', company),
+                        ])}
+
+        end_date = max(w['end_period'].end_date for w in windows)
+        # The values are summed as integer cents
+        units = MinorUnits(company.currency.digits)
+
+        def get_window_values(period_values):
+            '''
+            Split the values of each period in the windows. The initial
+            balance of a window are the periods that end before it starts.
+            '''
+            result = []
+            for window in windows:
+                initial = debit = credit = 0
+                start_date = window['start_period'].start_date
+                for period_id, value in period_values.items():
+                    if period_id in window['periods']:
+                        debit += units.to_cents(value['debit'])
+                        credit += units.to_cents(value['credit'])
+                    elif period_end_dates.get(period_id, end_date) < start_date:
+                        initial += (units.to_cents(value['debit'])
+                            - units.to_cents(value['credit']))
+                result.append([initial, debit, credit])
+            return result
+
+        def add_values(tree, code, name, _type, window_values):
+            node = tree.setdefault(code, {
+                    'name': name,
+                    'type': _type,
+                    'values': [[0, 0, 0] for _ in windows],
+                    })
+            for total, value in zip(node['values'], window_values):
+                for i in range(3):
+                    total[i] += value[i]
+
+        tree = {}
+        if digits:
+            # The database groups the accounts by digits and period
+            with Transaction().set_context(date=end_date):
+                values = Account.html_read_account_vals_by_digits_and_period(
+                    accounts, company, digits,
+                    with_moves=with_moves or with_moves_or_initial)
+            checker.check()
+            for code, group in values.items():
+                add_values(tree, code, group['name'], group['type'],
+                    get_window_values(group['periods']))
+        else:
+            with Transaction().set_context(date=end_date):
+                values = Account.html_read_account_vals_by_period(accounts,
+                    company)
+            checker.check()
+            # The last column counts the final accounts below each account
+            count = 3 * len(windows)
+            rollup = BalanceRollup({a.id: a.parent.id for a in all_accounts},
+                count + 1, company.currency.digits)
+            for account in accounts:
+                if account.id not in values and (with_moves
+                        or with_moves_or_initial):
+                    continue
+                window_values = get_window_values(values.get(account.id, {}))
+                for i, value in enumerate(window_values):
+                    for j in range(3):
+                        rollup.add_cents(account.id, 3 * i + j, value[j])
+                rollup.add_cents(account.id, count, 1)
+            rollup.rollup()
+            for account in all_accounts:
+                if not rollup.get_cents(account.id)[count]:
+                    continue
+                row = rollup.get_cents(account.id)
+                add_values(tree, account.code, account.name,
+                    cls._get_account_type(account),
+                    [row[3 * i:3 * i + 3] for i in range(len(windows))])
+        checker.check()
+
+        max_digits = max(len(a.code or '') for a in accounts) if accounts else None
+        records = []
+        total_columns = [CentsTotals(
+                ['initial_balance', 'debit', 'credit', 'balance'],
+                company.currency.digits)
+            for _ in windows]
+        for code in sorted(tree.keys(), key=lambda c: c or ''):
+            node = tree[code]
+            with_debit_credit = any(v[1] or v[2] for v in node['values'])
+            with_initial = any(v[0] for v in node['values'])
+            if with_moves_or_initial:
+                if not with_debit_credit and not with_initial:
+                    continue
+            elif with_moves and not with_debit_credit:
+                continue
+            columns = []
+            for initial, debit, credit in node['values']:
+                balance = debit - credit
+                if add_initial_balance:
+                    balance += initial
+                columns.append({
+                        'initial_balance': units.to_decimal(initial),
+                        'debit': units.to_decimal(debit),
+                        'credit': units.to_decimal(credit),
+                        'balance': units.to_decimal(balance),
+                        })
+            records.append({
+                    'code': code,
+                    'name': node['name'],
+                    'type': node['type'],
+                    'columns': columns,
+                    })
+            if not digits and len(code or '') != max_digits:
+                continue
+            for total, column in zip(total_columns, columns):
+                for key, value in column.items():
+                    total.add(key, value)
+
+        parameters = {}
+        parameters['windows'] = [w['name'] for w in windows]
+        parameters['window_periods'] = ['%s - %s' % (
+                w['start_period'].name, w['end_period'].name)
+            for w in windows]
+        parameters['total_columns'] = [t.to_dict() for t in total_columns]
+        parameters['second_balance'] = False
+        # The header prints the name and periods of each window instead
+        parameters['fiscalyear'] = ''
+        parameters['comparison_fiscalyear'] = ''
+        parameters['start_period'] = ''
+        parameters['end_period'] = ''
+        parameters['comparison_start_period'] = ''
+        parameters['comparison_end_period'] = ''
+        parameters['company'] = company.rec_name
+        parameters['company_rec_name'] = parameters['company']
+        parameters['company_vat'] = (company.party.tax_identifier
+            and company.party.tax_identifier.code) or ''
+        parameters['company_vat_label'] = (company.party.tax_identifier
+            and vat_label(company.party.tax_identifier) or '')
+        parameters['with_moves_only'] = with_moves or ''
+        parameters['split_parties'] = ''
+        parameters['digits'] = digits or ''
+        parameters['parties'] = ''
+        parameters['accounts'] = accounts_subtitle
+        return records, parameters
+
     @classmethod
     def prepare(cls, data, checker):
         pool = Pool()
@@ -347,6 +626,13 @@ class TrialBalanceReport(DominateReport):
         Period = pool.get('account.period')
         Account = pool.get('account.account')
         Party = pool.get('party.party')
+
+        if data.get('comparison_windows'):
+            return cls.prepare_comparative(data, checker)
+
+        # The accounts, parties and periods are read once for the report
+        lookup = ReportContext()
+
         #TODO: add the "checker.check()" function after and before every
         # function where we make some big calculations
         #
@@ -365,65 +651,53 @@ class TrialBalanceReport(DominateReport):
                 result.extend(flatten_tree(tree[key], prefix + key))
             return result
 
-        def get_account_type(account):
-            account_type = 'other'
-            if account.type and account.type.receivable:
-                account_type = 'receivable'
-            elif account.type and account.type.payable:
-                account_type = 'payable'
-            return account_type
+        def get_account_values(values):
+            '''
+            Obtain the values of the accounts and their parents.
+
+            The values are summed into the parents with BalanceRollup, the
+            root of the chart is not printed.
+            '''
+            parents = {}
+            for account in lookup.accounts_with_parents(list(values)):
+                while account and account.id not in parents:
+                    parents[account.id] = account.parent
+                    account = lookup.account(account.parent)
+            names = ['credit', 'debit', 'balance']
+            rollup = BalanceRollup(parents, len(names),
+                fiscalyear.company.currency.digits)
+            for account_id, account_values in values.items():
+                for column, name in enumerate(names):
+                    rollup.add_amount(account_id, column,
+                        account_values.get(name, _ZERO))
+            rollup.rollup()
 
-        def get_account_parent_name(account, digits):
-            while account and len(account.code) > digits and account.parent:
-                account = account.parent
-            return account.name
+            tree = {}
+            for account_id in parents:
+                account = lookup.account(account_id)
+                if account_id not in values and account.parent is None:
+                    continue
+                node = dict(zip(names, rollup.get(account_id)))
+                node['name'] = account.name
+                node['type'] = account.kind
+                tree[account.code] = node
+            return tree
 
-        def get_account_values(values, digits):
+        def read_account_values(**context):
             '''
-            Obtain the values of the accounts and their parents
-            and group by digits.
+            Obtain the values of the accounts and their parents or, when
+            digits are set, the values grouped by digits computed directly
+            in the database.
             '''
-            def get_parents_account_values(tree, account, credit, debit,
-                    balance):
-                while account and account.parent and account.parent.parent:
-                    account = account.parent
-                    tree[account.code]['name'] = account.name
-                    tree[account.code]['credit'] += credit
-                    tree[account.code]['debit'] += debit
-                    tree[account.code]['balance'] += balance
-                    tree[account.code]['type'] = get_account_type(account)
-
-            if digits:
-                tree = {}
-                for account_id in values:
-                    account = Account(account_id)
-                    if account.code[:digits] not in tree.keys():
-                        tree[account.code[:digits]] = {
-                            'name': get_account_parent_name(account, digits),
-                            'credit': _ZERO,
-                            'debit': _ZERO,
-                            'balance': _ZERO,
-                            'type': get_account_type(account)}
-                    tree[account.code[:digits]]['credit'] += values[account_id]['credit']
-                    tree[account.code[:digits]]['debit'] += values[account_id]['debit']
-                    tree[account.code[:digits]]['balance'] += values[account_id]['balance']
-            else:
-                tree = defaultdict(lambda: {'credit': _ZERO, 'debit': _ZERO,
-                    'balance': _ZERO})
-                for account_id, account_values in values.items():
-                    account = Account(account_id)
-                    tree[account.code] = {
-                        'name': account.name,
-                        'credit': account_values.get('credit', _ZERO),
-                        'debit': account_values.get('debit', _ZERO),
-                        'balance': account_values.get('balance', _ZERO),
-                        'type': get_account_type(account),
-                    }
-                    get_parents_account_values(tree, account,
-                        values[account_id]['credit'],
-                        values[account_id]['debit'],
-                        values[account_id]['balance'])
-            return tree
+            with Transaction().set_context(**context):
+                if digits:
+                    return Account.html_read_account_vals_by_digits(accounts,
+                        fiscalyear.company, digits, with_moves=with_moves,
+                        exclude_party_moves=exclude_party_moves)
+                values = Account.html_read_account_vals(accounts,
+                    fiscalyear.company, with_moves=with_moves,
+                    exclude_party_moves=exclude_party_moves)
+            return get_account_values(values)
 
         def get_account_party_values(values):
             """
@@ -434,12 +708,13 @@ class TrialBalanceReport(DominateReport):
             Identifier is the same.
             """
             tree = {}
-            for account_id, account_values in values.items():
-                account = Account(account_id)
+            lookup.parties({p for v in values.values() for p in v})
+            for account in lookup.accounts(list(values)):
+                account_values = values[account.id]
                 party_tree = {}
                 for party_id, value in account_values.items():
-                    party = Party(party_id)
-                    key = (party.name or '') + (" [" + party.tax_identifier.code + "]"
+                    party = lookup.party(party_id)
+                    key = (party.name or '') + (" [" + party.tax_identifier + "]"
                         if party.tax_identifier else '')
                     if key in party_tree:
                         party_tree[key]['debit'] += value.get('debit')
@@ -480,7 +755,7 @@ class TrialBalanceReport(DominateReport):
             end_period = Period.find(company, fiscalyear.end_date,
                 test_state=True)
         initial_balance_date = start_period.start_date - timedelta(days=1)
-        periods = [x.id for x in fiscalyear.get_periods(start_period,
+        periods = [x.id for x in lookup.get_periods(fiscalyear, start_period,
             end_period)]
 
         if comparison_fiscalyear:
@@ -496,9 +771,9 @@ class TrialBalanceReport(DominateReport):
                     comparison_fiscalyear.end_date, test_state=True)
             init_comparison_date = (comparison_start_period.start_date -
                 timedelta(days=1))
-            comparison_periods = [x.id for x in
-                comparison_fiscalyear.get_periods(
-                    comparison_start_period, comparison_end_period)]
+            comparison_periods = [x.id for x in lookup.get_periods(
+                    comparison_fiscalyear, comparison_start_period,
+                    comparison_end_period)]
 
         # Possible parties selected
         split_parties = data.get('split_parties', False)
@@ -569,17 +844,8 @@ class TrialBalanceReport(DominateReport):
 
         exclude_party_moves = True if party_ids else False
         # Obtain main fiscal year values based on accounts and digits.
-        with Transaction().set_context(periods=periods):
-            values = Account.html_read_account_vals(accounts,
-                fiscalyear.company, with_moves=with_moves,
-                exclude_party_moves=exclude_party_moves)
-        with Transaction().set_context(date=initial_balance_date):
-            init_values = Account.html_read_account_vals(accounts,
-                fiscalyear.company, with_moves=with_moves,
-                exclude_party_moves=exclude_party_moves)
-
-        init_main_tree = get_account_values(init_values, digits)
-        main_tree = get_account_values(values, digits)
+        main_tree = read_account_values(periods=periods)
+        init_main_tree = read_account_values(date=initial_balance_date)
         checker.check()
 
         # Obtain comparison fiscal year values based on accounts and
@@ -587,17 +853,9 @@ class TrialBalanceReport(DominateReport):
         init_comparison_tree = {}
         comparison_tree = {}
         if comparison_fiscalyear:
-            with Transaction().set_context(periods=comparison_periods):
-                comparison_values = Account.html_read_account_vals(
-                    accounts, fiscalyear.company, with_moves=with_moves,
-                    exclude_party_moves=exclude_party_moves)
-            with Transaction().set_context(date=init_comparison_date):
-                init_comparison_values = Account.html_read_account_vals(
-                    accounts, fiscalyear.company, with_moves=with_moves,
-                    exclude_party_moves=exclude_party_moves)
-            init_comparison_tree = get_account_values(
-                init_comparison_values, digits)
-            comparison_tree = get_account_values(comparison_values, digits)
+            comparison_tree = read_account_values(periods=comparison_periods)
+            init_comparison_tree = read_account_values(
+                date=init_comparison_date)
             checker.check()
 
         init_party_tree = {}
@@ -837,43 +1095,54 @@ class TrialBalanceReport(DominateReport):
         parameters['parties'] = parties_subtitle or ''
         parameters['accounts'] = accounts_subtitle or ''
         # Totals
-        parameters['total_period_initial_balance'] = 0
-        parameters['total_period_debit'] = 0
-        parameters['total_period_credit'] = 0
-        parameters['total_period_balance'] = 0
-        parameters['total_initial_balance'] = 0
-        parameters['total_debit'] = 0
-        parameters['total_credit'] = 0
-        parameters['total_balance'] = 0
-        totals_gropued = {}
+        names = ['period_initial_balance', 'period_debit', 'period_credit',
+            'period_balance', 'initial_balance', 'debit', 'credit', 'balance']
+        totals = CentsTotals(['total_%s' % n for n in names],
+            company.currency.digits)
         for record in records:
             if not digits and len(record.get('code', '')) != max_digits:
                 continue
-
-            digit = record.get('code', '')[0]
-            if digit not in totals_gropued:
-                totals_gropued[digit] = {
-                    'initial': 0,
-                    'debit': 0,
-                    'credit': 0,
-                    'balance': 0
-                    }
-            totals_gropued[digit]['initial'] += record.get('period_initial_balance')
-            totals_gropued[digit]['debit'] += record.get('period_debit')
-            totals_gropued[digit]['credit'] += record.get('period_credit')
-            totals_gropued[digit]['balance'] += record.get('period_balance')
-
-            parameters['total_period_initial_balance'] += (
-                record['period_initial_balance'])
-            parameters['total_period_debit'] += record['period_debit']
-            parameters['total_period_credit'] += record['period_credit']
-            parameters['total_period_balance'] += record['period_balance']
-            parameters['total_initial_balance'] += record['initial_balance']
-            parameters['total_debit'] += record['debit']
-            parameters['total_credit'] += record['credit']
-            parameters['total_balance'] += record['balance']
+            for name in names:
+                totals.add('total_%s' % name, record[name])
+        parameters.update(totals.to_dict())
         return records, parameters
 
+    @classmethod
+    def get_estimate_query(cls, data):
+        'Return the query of the lines to estimate the cost of the report'
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        line = Line.__table__()
+        move = Move.__table__()
+
+        ranges = [(data['fiscalyear'], data.get('start_period'),
+                data.get('end_period'))]
+        if data.get('comparison_fiscalyear'):
+            ranges.append((data['comparison_fiscalyear'],
+                    data.get('comparison_start_period'),
+                    data.get('comparison_end_period')))
+        for window in data.get('comparison_windows', []):
+            start_period = Period(window['start_period'])
+            ranges.append((start_period.fiscalyear.id, start_period.id,
+                    window['end_period']))
+        periods = set()
+        for fiscalyear, start_period, end_period in ranges:
+            periods.update(p.id for p in FiscalYear(fiscalyear).get_periods(
+                    Period(start_period) if start_period else None,
+                    Period(end_period) if end_period else None))
+
+        where = ((move.company == data['company'])
+            & ids_in(move.period, periods))
+        if data.get('accounts'):
+            where &= ids_in(line.account, data['accounts'])
+        if data.get('parties'):
+            where &= ids_in(line.party, data['parties'])
+        return line.join(move, condition=move.id == line.move
+            ).select(line.id, where=where)
+
     @classmethod
     def timeout_exception(cls):
         raise TimeoutException
@@ -881,17 +1150,23 @@ class TrialBalanceReport(DominateReport):
     @classmethod
     def execute(cls, ids, data):
         pool = Pool()
+        Company = pool.get('company.company')
         Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, cls.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = cls.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext(
                     'account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
@@ -902,13 +1177,16 @@ class TrialBalanceReport(DominateReport):
                 (end_prepare - start_prepare).total_seconds())
 
         with Transaction().set_context(**context):
-            return super().execute(ids, {
+            result = super().execute(ids, {
                 'name': 'account_reports.trial_balance',
                 'model': 'account.move.line',
                 'records': records,
                 'parameters': parameters,
                 'output_format': data.get('output_format', 'pdf'),
                 })
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return result
 
     @classmethod
     def header(cls, action, data, records):
@@ -928,10 +1206,15 @@ class TrialBalanceReport(DominateReport):
                             raw(html_render(datetime.now()))
             with table():
                 with tbody():
-                    with tr():
-                        td(_('Main Balance %s: From: %s To: %s')
-                            % (p['fiscalyear'], p['start_period'],
-                                p['end_period']))
+                    if not p.get('windows'):
+                        with tr():
+                            td(_('Main Balance %s: From: %s To: %s')
+                                % (p['fiscalyear'], p['start_period'],
+                                    p['end_period']))
+                    for name, window in zip(p.get('windows', []),
+                            p.get('window_periods', [])):
+                        with tr():
+                            td(_('Balance %s: %s') % (name, window))
                     if p['comparison_fiscalyear'] != '':
                         with tr():
                             td(_('Comparision Balance %s: From: %s To: %s')
@@ -952,8 +1235,34 @@ class TrialBalanceReport(DominateReport):
                             td(_('All Parties'))
         return container
 
+    @classmethod
+    def show_comparative_detail(cls, records, parameters):
+        detail_table = table()
+        with detail_table:
+            with tr():
+                th(_('Code'))
+                th(_('Account'))
+                for name in parameters['windows']:
+                    th(name, style='text-align: right;')
+            for record in records:
+                with tr():
+                    td(record['code'])
+                    td(record['name'])
+                    for column in record['columns']:
+                        td(html_render(column['balance']),
+                            style='text-align: right;')
+            with tr():
+                td('')
+                td('')
+                for column in parameters['total_columns']:
+                    td(html_render(column['balance']),
+                        style='text-align: right;')
+        return detail_table
+
     @classmethod
     def show_detail(cls, records, parameters):
+        if parameters.get('windows'):
+            return cls.show_comparative_detail(records, parameters)
         comparison = parameters['comparison_fiscalyear'] != ''
         detail_table = table()
         with detail_table:
@@ -1045,17 +1354,23 @@ class TrialBalanceXlsxReport(XlsxReport, metaclass=PoolMeta):
     @classmethod
     def get_content(cls, ids, data):
         pool = Pool()
+        Company = pool.get('company.company')
         Config = pool.get('account.configuration')
+        Execution = pool.get('account_reports.execution')
 
         config = Config(1)
         timeout = data.get('timeout') or config.default_timeout or 300
         checker = TimeoutChecker(timeout, TrialBalanceReport.timeout_exception)
+        company = Company(data['company'])
 
         start_prepare = datetime.now()
         with Transaction().set_context(active_test=False):
             try:
                 records, parameters = TrialBalanceReport.prepare(data, checker)
             except TimeoutException:
+                Execution.log(cls.__name__, company,
+                    data.get('estimated_rows'), checker.elapsed,
+                    timed_out=True)
                 raise UserError(gettext('account_reports.msg_timeout_exception'))
         end_prepare = datetime.now()
 
@@ -1064,7 +1379,10 @@ class TrialBalanceXlsxReport(XlsxReport, metaclass=PoolMeta):
             context['timeout_report'] = (
                 timeout - int((end_prepare - start_prepare).total_seconds()))
         with Transaction().set_context(**context):
-            return cls._build_workbook(records, parameters)
+            content = cls._build_workbook(records, parameters)
+        Execution.log(cls.__name__, company, data.get('estimated_rows'),
+            (datetime.now() - start_prepare).total_seconds())
+        return content
 
     @classmethod
     def _build_workbook(cls, records, parameters):
@@ -1080,6 +1398,19 @@ class TrialBalanceXlsxReport(XlsxReport, metaclass=PoolMeta):
             html_render(datetime.now())])
         ws.append(['%s: %s' % (
             parameters['company_vat_label'], parameters['company_vat'])])
+        if parameters.get('windows'):
+            for name, window in zip(parameters['windows'],
+                    parameters['window_periods']):
+                ws.append([_('Balance %s: %s') % (name, window)])
+            ws.append([])
+            ws.append([_('Code'), _('Account')] + parameters['windows'])
+            for record in records:
+                ws.append([record['code'], record['name']]
+                    + [xls(c['balance']) for c in record['columns']])
+            ws.append(['', '']
+                + [xls(c['balance']) for c in parameters['total_columns']])
+            return save_workbook(wb)
+
         ws.append([_('Main Balance %s: From: %s To: %s')
             % (parameters['fiscalyear'], parameters['start_period'],
                 parameters['end_period'])])